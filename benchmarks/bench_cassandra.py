@@ -0,0 +1,36 @@
+from benchmarks.systems import EngineBenchmark
+
+
+class TimeCassandra(EngineBenchmark):
+    engine = 'cassandra'
+
+    def setup(self, systems, system, n):
+        super(TimeCassandra, self).setup(systems, system, n)
+        from commpare.cassandra import cassandra_utils
+        self.cass = cassandra_utils
+        self.py2, self.fraglib_setup, self.cassandra = \
+                cassandra_utils.detect_cassandra_binaries()
+        self.inp_file, self.output, self.mcf_files, self.pdb_files = \
+                cassandra_utils.write_cassandra_inputs(self.structure)
+        self.run_fraglib_setup()
+        cassandra_utils.run_cassandra(self.cassandra, self.inp_file, '.')
+
+    def run_fraglib_setup(self):
+        self.cass.run_fraglib_setup(self.py2, self.fraglib_setup, 
+                self.cassandra, self.inp_file, self.mcf_files,
+                self.pdb_files, '.')
+
+    def time_write_inputs(self, systems, system, n):
+        self.cass.write_cassandra_inputs(self.structure)
+
+    def time_fraglib_setup(self, systems, system, n):
+        self.run_fraglib_setup()
+
+    def time_run(self, systems, system, n):
+        self.cass.run_cassandra(self.cassandra, self.inp_file, '.')
+
+    def time_parse(self, systems, system, n):
+        self.cass.get_cassandra_energy(self.output + '.log')
+
+    def time_total(self, systems, system, n):
+        self.cass.build_run_measure_cassandra(self.structure)
@@ -0,0 +1,40 @@
+import os
+
+from benchmarks.systems import EngineBenchmark
+
+
+class TimeGromacs(EngineBenchmark):
+    engine = 'gromacs'
+
+    def setup(self, systems, system, n):
+        super(TimeGromacs, self).setup(systems, system, n)
+        from commpare.gromacs import gromacs_utils
+        self.gmx = gromacs_utils
+        # Stages are re-run in place, overwrite instead of backing up
+        os.environ['GMX_MAXBACKUP'] = '-1'
+        self.grompp, self.mdrun = gromacs_utils.detect_gmx_binaries()
+        self.write_inputs()
+        gromacs_utils.run_grompp(self.grompp, 'grompp.mdp',
+                'structure.gro', 'structure.top', output='out')
+        gromacs_utils.run_mdrun(self.mdrun, output='out')
+
+    def write_inputs(self):
+        self.structure.save('structure.gro', overwrite=True)
+        self.gmx.write_gmx_top(self.structure, 'structure.top')
+        self.gmx.write_gmx_mdp()
+
+    def time_write_inputs(self, systems, system, n):
+        self.write_inputs()
+
+    def time_grompp(self, systems, system, n):
+        self.gmx.run_grompp(self.grompp, 'grompp.mdp',
+                'structure.gro', 'structure.top', output='out')
+
+    def time_mdrun(self, systems, system, n):
+        self.gmx.run_mdrun(self.mdrun, output='out')
+
+    def time_parse(self, systems, system, n):
+        self.gmx.get_gmx_energy('out.edr')
+
+    def time_total(self, systems, system, n):
+        self.gmx.build_run_measure_gromacs(self.structure)
@@ -0,0 +1,31 @@
+from benchmarks.systems import EngineBenchmark
+
+HOOMD_KWARGS = {'ref_distance': 10, 'ref_energy': 1/4.184}
+
+
+class TimeHoomd(EngineBenchmark):
+    engine = 'hoomd'
+
+    def setup(self, systems, system, n):
+        super(TimeHoomd, self).setup(systems, system, n)
+        import hoomd
+        from commpare.hoomd import hoomd_utils
+        self.hoomd_utils = hoomd_utils
+        hoomd.util.quiet_status()
+        self.sim_context, self.all_group = \
+                hoomd_utils.prepare_hoomd_simulation(self.structure,
+                                                    **HOOMD_KWARGS)
+
+    def time_prepare_simulation(self, systems, system, n):
+        self.hoomd_utils.prepare_hoomd_simulation(self.structure,
+                                                **HOOMD_KWARGS)
+
+    def time_energies(self, systems, system, n):
+        with self.sim_context:
+            force_groups = self.hoomd_utils.get_hoomd_force_groups()
+            self.hoomd_utils.get_hoomd_energies(force_groups, 
+                                                self.all_group)
+
+    def time_total(self, systems, system, n):
+        self.hoomd_utils.build_run_measure_hoomd(self.structure, 
+                                                **HOOMD_KWARGS)
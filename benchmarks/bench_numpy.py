@@ -0,0 +1,17 @@
+from benchmarks.systems import EngineBenchmark
+
+
+class TimeNumpy(EngineBenchmark):
+    engine = 'numpy'
+
+    def setup(self, systems, system, n):
+        super(TimeNumpy, self).setup(systems, system, n)
+        from commpare.reference import reference_utils
+        self.reference = reference_utils
+
+    def time_total(self, systems, system, n):
+        self.reference.build_run_measure_numpy(self.structure)
+
+    def time_total_pme(self, systems, system, n):
+        self.reference.build_run_measure_numpy(self.structure, cutoff=20,
+                coulomb='pme')
@@ -0,0 +1,37 @@
+from benchmarks.systems import EngineBenchmark
+
+
+class TimeOpenMM(EngineBenchmark):
+    engine = 'openmm'
+
+    def setup(self, systems, system, n):
+        super(TimeOpenMM, self).setup(systems, system, n)
+        import simtk.unit as unit
+        from commpare.openmm import openmm_utils
+        from commpare.structure_arrays import get_structure_arrays
+        self.omm = openmm_utils
+        self.positions = (get_structure_arrays(self.structure).coordinates
+                            * unit.angstrom)
+        self.system = openmm_utils.create_omm_system(self.structure)
+        self.context = openmm_utils.create_omm_context(self.system,
+                self.positions, platform='Reference')
+        self.force_groups = openmm_utils.get_omm_force_groups(self.system)
+
+    def time_create_system(self, systems, system, n):
+        self.omm.create_omm_system(self.structure)
+
+    def time_write_inputs(self, systems, system, n):
+        import simtk.openmm as openmm
+        with open('system.xml', 'w') as f:
+            f.write(openmm.XmlSerializer.serialize(self.system))
+
+    def time_create_context(self, systems, system, n):
+        self.omm.create_omm_context(self.system, self.positions, 
+                platform='Reference')
+
+    def time_energies(self, systems, system, n):
+        self.omm.get_omm_energies(self.force_groups, self.context)
+
+    def time_total(self, systems, system, n):
+        self.omm.build_run_measure_openmm(self.structure, 
+                platform='Reference')
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import commpare
+
+# Systems of increasing size, built like the mosdef tests:
+# a single alkane chain of n carbons, and a box of n ethanes
+SYSTEMS = ['alkane', 'ethane_box']
+SIZES = [10, 100, 1000]
+
+# Ethane liquid number density (molecules/nm^3)
+ETHANE_DENSITY = 10.9
+# Smallest box edge (nm), over twice the 2 nm nonbonded cutoff
+MIN_BOX_LENGTH = 4.2
+
+def build_alkane(forcefield, n):
+    from mbuild.examples import Alkane
+    compound = Alkane(n=n)
+    structure = forcefield.apply(compound)
+    # Enlarge box to avoid cutoff issues
+    lengths = np.array(compound.boundingbox.lengths) * 10
+    if any(lengths < 10):
+        lengths = np.array([100, 100, 100])
+    structure.box = [lengths[0], lengths[1], lengths[2], 90, 90, 90]
+    structure.combining_rule = 'geometric'
+    return structure
+
+def build_ethane_box(forcefield, n):
+    import mbuild as mb
+    from mbuild.examples import Ethane
+    length = max(MIN_BOX_LENGTH, (n / ETHANE_DENSITY) ** (1 / 3))
+    compound = mb.fill_box(Ethane(), n_compounds=n, 
+                        box=[length, length, length], seed=12345)
+    structure = forcefield.apply(compound)
+    structure.box = [length * 10, length * 10, length * 10, 90, 90, 90]
+    structure.combining_rule = 'geometric'
+    return structure
+
+def build_systems():
+    """ Every (system, size) structure, built once per benchmark class """
+    import foyer
+    forcefield = foyer.Forcefield(name='oplsaa')
+    builders = {'alkane': build_alkane, 'ethane_box': build_ethane_box}
+    return {(system, n): builders[system](forcefield, n)
+            for system in SYSTEMS for n in SIZES}
+
+
+class EngineBenchmark(object):
+    """ Base of the per-engine benchmarks
+
+    Each `time_` method times one stage of an engine's path from a
+    parmed.Structure to canonical energies, and `time_total` times
+    the whole path. Benchmarks run in a scratch directory, and are
+    skipped when the engine is not available
+    """
+    engine = None
+    params = (SYSTEMS, SIZES)
+    param_names = ['system', 'n']
+    timeout = 600
+    # Engine runs take seconds, a few samples are enough
+    number = 1
+    repeat = (1, 5, 60.0)
+
+    def setup_cache(self):
+        return build_systems()
+
+    def setup(self, systems, system, n):
+        if self.engine not in commpare.identify_engines():
+            raise NotImplementedError("{} not available".format(self.engine))
+        self.structure = systems[(system, n)]
+        self._cwd = os.getcwd()
+        self._tmpdir = tempfile.mkdtemp()
+        os.chdir(self._tmpdir)
+
+    def teardown(self, systems, system, n):
+        os.chdir(self._cwd)
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
@@ -2,3 +2,9 @@ from .mm_engines import *
 from .reference_systems import *
 from .conversion import *
 from .forcefields import *
+from .cache import *
+from .structure_arrays import *
+from .runner import *
+from .timing import *
+from .comparison import *
+from .result_store import *
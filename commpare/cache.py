@@ -0,0 +1,339 @@
+import collections
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+import weakref
+
+from commpare.utils import default_cache_dir
+from commpare.structure_arrays import get_structure_arrays
+
+# Persistent caches for energies evaluated by the MM engines
+# and for the engine inputs prepared from a topology
+
+def structure_hash(structure, coordinates=True):
+    """ Content hash of a parmed.Structure
+
+    Parameters
+    ----------
+    structure : parmed.Structure or commpare.StructureArrays
+    coordinates : bool
+        Include coordinates and box. If False, only the topology and
+        force field parameters are hashed
+
+    Returns
+    -------
+    digest : str
+        Hex digest, identical for structures that any engine
+        would treat identically
+    """
+    # Re-extracted, so parameters edited in place are never missed
+    arrays = get_structure_arrays(structure, refresh=True)
+    return arrays.hash(coordinates=coordinates)
+
+def topology_hash(structure):
+    """ Content hash of a parmed.Structure, ignoring coordinates and box """
+    return structure_hash(structure, coordinates=False)
+
+def settings_hash(engine, settings=None):
+    """ Hash of an engine's name, version, source, and run settings
+
+    Parameters
+    ----------
+    engine : str
+    settings : dict, optional
+        Anything that changes how the engine evaluates energies,
+        e.g. mdp text, hoomd_kwargs, or cutoffs.
+        Values that are not JSON-serializable are hashed by their repr
+
+    Notes
+    -----
+    The source of the commpare code that drives the engine is included
+    (see `commpare.get_engine_source_hash`), so energies cached before
+    a change to commpare are not returned as current results
+    """
+    from commpare.mm_engines import get_engine_version, get_engine_source_hash
+    payload = json.dumps({'engine': engine,
+                        'version': get_engine_version(engine),
+                        'source': get_engine_source_hash(engine),
+                        'settings': settings or {}},
+                        sort_keys=True, default=repr)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def file_hash(path):
+    """ Content hash of a file, e.g. an engine binary
+
+    Memoized on the path, size, and modification time,
+    so each file is only read once per process
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return _file_hash(path, stat.st_size, stat.st_mtime_ns)
+
+@functools.lru_cache(maxsize=None)
+def _file_hash(path, size, mtime):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, 2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def source_hash(*modules):
+    """ Hash of the Python source of modules or packages, found
+    without importing them. Tests within packages are skipped.
+    Empty if none of the modules can be found
+    """
+    import importlib.util
+    files = []
+    for module in modules:
+        try:
+            spec = importlib.util.find_spec(module)
+        except (ImportError, ValueError):
+            spec = None
+        if spec is None:
+            continue
+        if spec.submodule_search_locations:
+            for location in spec.submodule_search_locations:
+                for root, dirnames, filenames in os.walk(location):
+                    dirnames[:] = sorted(name for name in dirnames
+                                        if name not in ('tests', '__pycache__'))
+                    files.extend(os.path.join(root, name)
+                                for name in sorted(filenames)
+                                if name.endswith('.py'))
+        elif spec.origin and spec.origin.endswith('.py'):
+            files.append(spec.origin)
+    if len(files) == 0:
+        return ''
+    digest = hashlib.sha256()
+    for filename in files:
+        digest.update(os.path.basename(filename).encode())
+        with open(filename, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """ Temporary path to write a file or directory to, moved to `path`
+    once the block completes
+
+    Readers never see a partially written `path`, and the temporary
+    path is removed if the block raises. A directory already at `path`,
+    e.g. stored by a concurrent run, is kept
+
+    Examples
+    --------
+    >>> with atomic_path('system.xml') as tmp, open(tmp, 'w') as f:
+    ...     f.write(xml)
+    """
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        yield tmp
+        if os.path.isdir(tmp):
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                pass
+        else:
+            os.replace(tmp, path)
+    finally:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp, ignore_errors=True)
+        elif os.path.exists(tmp):
+            os.remove(tmp)
+
+def open_artifact_cache(input_cache):
+    """ An ArtifactCache, from an ArtifactCache, a directory, or True
+    for the default location. None if `input_cache` is None or False """
+    if input_cache is None or input_cache is False:
+        return None
+    if input_cache is True:
+        return ArtifactCache()
+    if isinstance(input_cache, str):
+        return ArtifactCache(input_cache)
+    return input_cache
+
+class EnergyCache(object):
+    """ SQLite-backed store of canonicalized energies
+
+    Entries are keyed by a hash of the structure (parameters,
+    coordinates, box) combined with `settings_hash` (engine name,
+    engine version, commpare source, and run settings), so any change to the inputs
+    results in a cache miss rather than a stale hit
+
+    Parameters
+    ----------
+    path : str, optional
+        SQLite database file, defaults to `energies.sqlite` in
+        `commpare.utils.default_cache_dir()`
+    max_entries : int, optional
+        Evict least-recently-used entries beyond this count
+    max_age : float, optional
+        Evict entries older than this many seconds
+    """
+    def __init__(self, path=None, max_entries=None, max_age=None):
+        if path is None:
+            path = os.path.join(default_cache_dir(), 'energies.sqlite')
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._connection = sqlite3.connect(path)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS energies ("
+                "key TEXT PRIMARY KEY, engine TEXT, energies TEXT, "
+                "created REAL, accessed REAL)")
+        self.evict()
+
+    def key(self, structure, engine, settings=None, digest=None):
+        """ Cache key of a structure evaluated with an engine and settings.
+        `digest` is the structure's `structure_hash`, if already known """
+        if digest is None:
+            digest = structure_hash(structure)
+        return hashlib.sha256((digest + settings_hash(engine, settings)
+                            ).encode()).hexdigest()
+
+    def get(self, key):
+        """ Cached energies as a dictionary, or None on a miss """
+        row = self._connection.execute(
+                "SELECT energies, created FROM energies WHERE key = ?",
+                (key,)).fetchone()
+        if row is None:
+            return None
+        energies, created = row
+        now = time.time()
+        if self.max_age is not None and now - created > self.max_age:
+            return None
+        with self._connection:
+            self._connection.execute(
+                "UPDATE energies SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(energies)
+
+    def put(self, key, engine, energies):
+        """ Store a dictionary of canonicalized energies """
+        now = time.time()
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO energies VALUES (?, ?, ?, ?, ?)",
+                (key, engine, json.dumps(energies), now, now))
+        self.evict()
+
+    def evict(self):
+        """ Drop entries beyond `max_age` or `max_entries` """
+        with self._connection:
+            if self.max_age is not None:
+                self._connection.execute(
+                    "DELETE FROM energies WHERE created < ?",
+                    (time.time() - self.max_age,))
+            if self.max_entries is not None:
+                self._connection.execute(
+                    "DELETE FROM energies WHERE key NOT IN ("
+                    "SELECT key FROM energies ORDER BY accessed DESC "
+                    "LIMIT ?)", (self.max_entries,))
+
+    def clear(self):
+        with self._connection:
+            self._connection.execute("DELETE FROM energies")
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        return self._connection.execute(
+                "SELECT COUNT(*) FROM energies").fetchone()[0]
+
+
+class ArtifactCache(object):
+    """ Prepared engine inputs, keyed by topology hash
+
+    Most workloads only change coordinates between calls, so inputs
+    that depend only on the topology (a GROMACS tpr, a serialized
+    OpenMM System, an initialized HOOMD simulation) can be built once
+    and reused
+
+    Parameters
+    ----------
+    directory : str, optional
+        Root directory for on-disk artifacts, defaults to `artifacts`
+        in `commpare.utils.default_cache_dir()`
+    max_memory_entries : int
+        Number of in-process objects kept by `remember`, least
+        recently used objects are dropped first
+    """
+    def __init__(self, directory=None, max_memory_entries=64):
+        if directory is None:
+            directory = os.path.join(default_cache_dir(), 'artifacts')
+        self.directory = directory
+        self.max_memory_entries = max_memory_entries
+        self._memory = collections.OrderedDict()
+        self._topologies = weakref.WeakKeyDictionary()
+
+    def key(self, structure, *settings, digest=None):
+        """ Cache key of a structure's topology and any extra settings.
+        `structure` may be None for artifacts that only depend on
+        the settings. `digest` is the structure's `topology_hash`,
+        if already known, see also `known_topology` """
+        if structure is None:
+            topology = None
+        elif digest is not None:
+            topology = digest
+        else:
+            topology = self._topologies.get(structure)
+            if topology is None:
+                topology = topology_hash(structure)
+        payload = json.dumps([topology, settings],
+                            sort_keys=True, default=repr)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    @contextlib.contextmanager
+    def known_topology(self, structure, digest):
+        """ Use `digest` as the topology hash of `structure` within the
+        block, so engines keying their inputs do not hash it again """
+        self._topologies[structure] = digest
+        try:
+            yield
+        finally:
+            self._topologies.pop(structure, None)
+
+    def path(self, kind, key, filename):
+        """ Location of an on-disk artifact, which may not exist yet """
+        dirname = os.path.join(self.directory, kind, key)
+        os.makedirs(dirname, exist_ok=True)
+        return os.path.join(dirname, filename)
+
+    def store(self, kind, key, filename, source):
+        """ Copy a file into the cache, atomically """
+        destination = self.path(kind, key, filename)
+        with atomic_path(destination) as tmp:
+            shutil.copyfile(source, tmp)
+        return destination
+
+    def recall(self, kind, key):
+        """ In-process object stored by `remember`, or None """
+        value = self._memory.get((kind, key))
+        if value is not None:
+            self._memory.move_to_end((kind, key))
+        return value
+
+    def remember(self, kind, key, value):
+        self._memory[(kind, key)] = value
+        self._memory.move_to_end((kind, key))
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def __getstate__(self):
+        # In-process objects (e.g. HOOMD contexts) stay in their process
+        state = self.__dict__.copy()
+        state['_memory'] = collections.OrderedDict()
+        del state['_topologies']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._topologies = weakref.WeakKeyDictionary()
@@ -1,49 +1,223 @@
 import shutil
 import tempfile
 import contextlib
-import subprocess
+import hashlib
 import os
 
+import numpy as np
 import pandas as pd
-import mdtraj
-import mbuild as mb
 
 from mbuild.formats.cassandramcf import write_mcf
 
-def build_run_measure_cassandra(structure):
+from commpare.runner import run_command
+from commpare.mm_engines import CASSANDRA_EXEC_NAMES
+from commpare.timing import timed
+from commpare.cache import atomic_path, file_hash
+from commpare.structure_arrays import (get_structure_arrays, find_molecules,
+                                    unique_molecules)
+
+CASSANDRA_INP = """! Input file for testing energies
+
+# Run_Name
+{output}
+!------------------------------------------------------------------------------
+
+# Sim_Type
+nvt_mc
+!------------------------------------------------------------------------------
+
+# Nbr_Species
+{nbr_species}
+!------------------------------------------------------------------------------
+
+# VDW_Style
+lj cut {cutoff}
+!------------------------------------------------------------------------------
+
+# Charge_Style
+coul ewald {cutoff} 1e-5
+!------------------------------------------------------------------------------
+
+# Seed_Info
+1 2
+!------------------------------------------------------------------------------
+
+# Rcutoff_Low
+0.5
+!------------------------------------------------------------------------------
+
+# Molecule_Files
+{molecule_files}
+!------------------------------------------------------------------------------
+
+# Box_Info
+1
+{box_info}
+!------------------------------------------------------------------------------
+
+# Temperature_Info
+300.0
+!------------------------------------------------------------------------------
+
+# Move_Probability_Info
+!------------------------------------------------------------------------------
+!-------------------------Choices don't matter for the single frame energy calc
+
+# Prob_Translation
+1
+1.0
+
+# Done_Probability_Info
+!------------------------------------------------------------------------------
+
+# Start_Type
+read_config {counts} structure.xyz
+!------------------------------------------------------------------------------
+
+# Run_Type
+production   1
+!------------------------------------------------------------------------------
+
+# Simulation_Length_Info
+units        sweeps
+prop_freq    1
+coord_freq   1
+run          0
+!------------------------------------------------------------------------------
+
+# Property_Info 1
+energy_total
+!------------------------------------------------------------------------------
+
+# Fragment_Files
+!------------------------------------------------------------------------------
+!-----------------------------------library_setup.py will autofill this section
+
+END"""
+
+# Box edge (angstrom) of structures without a box
+CASSANDRA_DEFAULT_BOX = 100.
+
+# LJ and Ewald real space cutoff (angstrom), matching rvdw/rcoulomb of
+# the gromacs mdp. Cassandra refuses cutoffs over half the box, so
+# smaller boxes use a cutoff just under half their shortest edge
+CASSANDRA_CUTOFF = 19.99
+
+# Input file sections that change the fragment library library_setup.py
+# builds for a species, along with the species' MCF file. Molecule counts
+# and the other species do not
+FRAGLIB_INP_SECTIONS = ['VDW_Style', 'Charge_Style', 'Mixing_Rule',
+        'Rcutoff_Low', 'Temperature_Info']
+
+def build_run_measure_cassandra(structure, input_cache=None, timer=None,
+        **kwargs):
+    """ Build and run a Cassandra simulation from a parmed.Structure
+
+    Parameters
+    ----------
+    structure : parmed.Structure
+    input_cache : commpare.ArtifactCache, optional
+        Reuse the fragment libraries of previously seen molecules,
+        running library_setup.py only for new ones, see
+        `prepare_cassandra_fraglib`
+    timer : commpare.StageTimer, optional
+        Times the 'write_inputs', 'fraglib_setup', 'run', and
+        'parse' stages
+    """
 
     py2, fraglib_setup, cassandra = detect_cassandra_binaries()
     workdir = os.getcwd()
-    mcf_file = 'structure.mcf'
-    xyz_file = 'structure.xyz'
-    pdb_file = 'structure.pdb'
 
     with temporary_directory() as tmp_dir:
         with temporary_cd(tmp_dir):
-            # Guess dihedral type...from contents of structure
-            if len(structure.dihedrals) > 0:
-                dihedral_style = 'charmm'
-            else:
-                dihedral_style = 'opls'
-            write_mcf(structure,mcf_file,angle_style='harmonic',
-                    dihedral_style=dihedral_style)
-            mb.load(structure).save(xyz_file)
-            mb.load(structure).to_trajectory().save_pdb(pdb_file)
-
-            inp_file,output = write_cassandra_inp()
-            successful_fraglib = run_fraglib_setup(py2, fraglib_setup,
-                                 cassandra, inp_file, mcf_file, pdb_file,
-                                 workdir)
-            if successful_fraglib:
+            with timed(timer, 'write_inputs'):
+                inp_file, output, mcf_files, pdb_files = \
+                        write_cassandra_inputs(structure)
+            with timed(timer, 'fraglib_setup'):
+                prepare_cassandra_fraglib(py2, fraglib_setup, cassandra, 
+                        inp_file, mcf_files, pdb_files, workdir,
+                        input_cache=input_cache)
+            with timed(timer, 'run'):
                 run_cassandra(cassandra, inp_file, workdir)
+            with timed(timer, 'parse'):
                 energies = get_cassandra_energy(output + '.log')
-            else:
-                print("Cassandra failed due to unsuccessful fragment generation")
 
     df = pd.DataFrame.from_dict(energies, orient='index')
 
     return df
 
+def write_cassandra_inputs(structure):
+    """ Write the MCF and PDB of each species, the starting 
+    configuration, and the input file to the current directory
+
+    Returns
+    -------
+    inp_file, output : str
+        See `write_cassandra_inp`
+    mcf_files, pdb_files : list of str
+        One per species
+    """
+    species = cassandra_species(structure)
+    mcf_files, pdb_files = [], []
+    for i, (molecule, _, _) in enumerate(species):
+        mcf_file = 'species{}.mcf'.format(i + 1)
+        pdb_file = 'species{}.pdb'.format(i + 1)
+        # Guess dihedral type...from contents of structure
+        if len(molecule.dihedrals) > 0:
+            dihedral_style = 'charmm'
+        else:
+            dihedral_style = 'opls'
+        write_mcf(molecule, mcf_file, angle_style='harmonic',
+                dihedral_style=dihedral_style)
+        molecule.save(pdb_file, overwrite=True)
+        mcf_files.append(mcf_file)
+        pdb_files.append(pdb_file)
+
+    order = np.concatenate([atoms for _, _, atoms in species])
+    write_cassandra_xyz(structure, 'structure.xyz', order)
+    inp_file, output = write_cassandra_inp(
+            [(mcf_file, count) for mcf_file, (_, count, _) 
+                in zip(mcf_files, species)],
+            box=structure.box)
+    return inp_file, output, mcf_files, pdb_files
+
+def cassandra_species(structure):
+    """ Split a structure into Cassandra species, one per unique
+    molecule, see `commpare.unique_molecules`
+
+    Returns
+    -------
+    species : list of (parmed.Structure, int, np.ndarray)
+        The first copy of each unique molecule, its number of copies,
+        and the atom indices of every copy, in order of first appearance.
+        If molecules can not be told apart, the whole structure is
+        a single species
+    """
+    molecules = unique_molecules(structure)
+    if molecules is None:
+        return [(structure, 1, np.arange(len(structure.atoms)))]
+    labels = find_molecules(structure)
+    species = []
+    for atoms, copies in molecules:
+        selection = np.zeros(len(structure.atoms), dtype=bool)
+        selection[atoms] = True
+        species.append((structure[selection.tolist()], len(copies),
+                        np.flatnonzero(np.isin(labels, copies))))
+    return species
+
+def write_cassandra_xyz(structure, filename, order=None):
+    """ Write the starting configuration, atoms in `order` """
+    xyz = get_structure_arrays(structure).coordinates
+    if order is None:
+        order = np.arange(len(xyz))
+    atoms = structure.atoms
+    with open(filename, 'w') as f:
+        f.write('{}\n\n'.format(len(order)))
+        for i in order:
+            f.write('{} {:.6f} {:.6f} {:.6f}\n'.format(
+                    atoms[i].element_name, *xyz[i]))
+    return filename
+
 def get_cassandra_energy(prpfile):
     """ Parse and canonicalize energies from cassandra prp file
 
@@ -89,51 +263,191 @@ def get_cassandra_energy(prpfile):
 
     return cassandra_force_groups
 
-def run_fraglib_setup(py2, fraglib_setup,cassandra,inp_file,mcf_file,pdb_file,workdir):
-    fraglib_cmd = ('{python2} {fraglib_setup} {cassandra} '.format(python2=py2,
-                                                                  fraglib_setup=fraglib_setup,
-                                                                  cassandra=cassandra) +
-                   '{inp_file} {pdb_file}'.format(inp_file=inp_file, pdb_file= pdb_file))
-    p = subprocess.Popen(fraglib_cmd,
-            shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            universal_newlines=True)
-    out,err = p.communicate()
-    with open (workdir+'/casssandra_fraglib.out', 'w') as fraglib_out:
-        fraglib_out.write(out)
-    with open (workdir+'/casssandra_fraglib.err', 'w') as fraglib_err:
-        fraglib_err.write(err)
-    if p.returncode != 0:
-        print('Cassandra fragment library generation failed, '
-              'see cassandra_fraglib.err')
-        return False
+def prepare_cassandra_fraglib(py2, fraglib_setup, cassandra, inp_file,
+        mcf_files, pdb_files, workdir, input_cache=None, timeout=None):
+    """ Generate the fragment libraries, or reuse cached ones
+
+    A species' fragment library only depends on its MCF file, the
+    `FRAGLIB_INP_SECTIONS` of the input file, and the library_setup.py
+    and Cassandra binaries, not on the coordinates, the number of
+    molecules, or the other species. Libraries are cached per species,
+    and library_setup.py only runs for the species that are not cached.
+    Species directories are written to the current directory and the
+    input file's Fragment_Files section is filled in, as library_setup.py
+    does
+    """
+    if input_cache is None:
+        return run_fraglib_setup(py2, fraglib_setup, cassandra, inp_file,
+                mcf_files, pdb_files, workdir, timeout=timeout)
+
+    if isinstance(mcf_files, str):
+        mcf_files = [mcf_files]
+    if isinstance(pdb_files, str):
+        pdb_files = [pdb_files]
+    binaries = [_binary_hash(fraglib_setup), _binary_hash(cassandra)]
+    cached = [input_cache.path('cassandra', input_cache.key(None, 'fraglib',
+                fraglib_hash(inp_file, mcf_file), *binaries), 'fraglib')
+                for mcf_file in mcf_files]
+    missing = [i for i, path in enumerate(cached) if not os.path.isdir(path)]
+    if len(missing) > 0:
+        build_species_fraglibs(py2, fraglib_setup, cassandra, inp_file,
+                missing, pdb_files, [cached[i] for i in missing], workdir,
+                timeout=timeout)
+
+    # Fragments are numbered across all species
+    fragment_files = []
+    for i, path in enumerate(cached):
+        species_dir = 'species{}'.format(i + 1)
+        shutil.copytree(os.path.join(path, 'species'), species_dir)
+        with open(os.path.join(path, 'fragment_files')) as f:
+            for fragment_file in f.read().splitlines():
+                fragment_files.append('{}/{} {}'.format(species_dir,
+                        fragment_file, len(fragment_files) + 1))
+    set_inp_section(inp_file, 'Fragment_Files', '\n'.join(fragment_files))
     return True
 
-def run_cassandra(cassandra, inp_file, workdir):
-    cassandra_cmd = ('{cassandra} {inp_file}'.format(cassandra=cassandra,
-                                                     inp_file=inp_file))
-    p = subprocess.Popen(cassandra_cmd,
-            shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            universal_newlines=True)
-    out,err = p.communicate()
-    with open (workdir+'/casssandra.out', 'w') as fout:
-        fout.write(out)
-    with open (workdir+'/casssandra.err', 'w') as ferr:
-        ferr.write(err)
-    if p.returncode != 0:
-        print('Cassandra failed, see cassandra.err')
+def build_species_fraglibs(py2, fraglib_setup, cassandra, inp_file,
+        species, pdb_files, destinations, workdir, timeout=None):
+    """ Run library_setup.py for some of the species of an input file,
+    storing each species' library in its destination directory
+
+    Parameters
+    ----------
+    species : list of int
+        Indices of the species to build libraries for
+    pdb_files : list of str
+        PDB file of every species in the input file
+    destinations : list of str
+        Directory each library is stored in, as the species' directory
+        (`species`) and its fragment files relative to it
+        (`fragment_files`)
+    """
+    workdir = os.path.abspath(workdir)
+    molecule_files = get_inp_section(inp_file, 'Molecule_Files').splitlines()
+    start_type = get_inp_section(inp_file, 'Start_Type').split()
+    build_dir = os.path.abspath('fraglib_setup')
+    os.makedirs(build_dir)
+    for i in species:
+        for filename in [molecule_files[i].split()[0], pdb_files[i]]:
+            shutil.copy(filename, build_dir)
+    with open(inp_file) as f:
+        inp = f.read()
+    with temporary_cd(build_dir):
+        with open(inp_file, 'w') as f:
+            f.write(inp)
+        set_inp_section(inp_file, 'Nbr_Species', str(len(species)))
+        set_inp_section(inp_file, 'Molecule_Files',
+                '\n'.join(molecule_files[i] for i in species))
+        set_inp_section(inp_file, 'Start_Type', ' '.join([start_type[0]] +
+                [start_type[i + 1] for i in species] + start_type[-1:]))
+        run_fraglib_setup(py2, fraglib_setup, cassandra, inp_file,
+                [molecule_files[i].split()[0] for i in species],
+                [os.path.basename(pdb_files[i]) for i in species],
+                workdir, timeout=timeout)
+        fragment_files = get_inp_section(inp_file, 'Fragment_Files')
+
+    for j, destination in enumerate(destinations):
+        species_dir = 'species{}'.format(j + 1)
+        species_files = [line.split()[0][len(species_dir) + 1:]
+                        for line in fragment_files.splitlines()
+                        if line.startswith(species_dir + '/')]
+        with atomic_path(destination) as tmp:
+            os.makedirs(tmp)
+            shutil.copytree(os.path.join(build_dir, species_dir),
+                            os.path.join(tmp, 'species'))
+            with open(os.path.join(tmp, 'fragment_files'), 'w') as f:
+                f.write('\n'.join(species_files))
+    shutil.rmtree(build_dir)
+
+def fraglib_hash(inp_file, mcf_file):
+    """ Hash of everything a species' fragment library depends on:
+    the `FRAGLIB_INP_SECTIONS` of the input file and its MCF file """
+    digest = hashlib.sha256()
+    for section in FRAGLIB_INP_SECTIONS:
+        content = get_inp_section(inp_file, section)
+        digest.update('{}\n{}\n'.format(section, content).encode())
+    with open(mcf_file, 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+def _binary_hash(binary):
+    """ Content hash of an executable, or its name if it is not found """
+    path = shutil.which(binary) or binary
+    if not os.path.isfile(path):
+        return binary
+    return file_hash(path)
+
+def get_inp_section(inp_file, section):
+    """ Content of a '# <section>' of a Cassandra input file,
+    without comments and blank lines """
+    lines = []
+    in_section = False
+    with open(inp_file) as f:
+        for line in f:
+            stripped = line.strip()
+            if stripped.startswith('#') or stripped == 'END':
+                in_section = (stripped.lstrip('#').strip() == section)
+                continue
+            if in_section and stripped and not stripped.startswith('!'):
+                lines.append(stripped)
+    return '\n'.join(lines)
+
+def set_inp_section(inp_file, section, content):
+    """ Replace the content of a '# <section>' of a Cassandra input file,
+    keeping its comments """
+    with open(inp_file) as f:
+        lines = f.read().splitlines()
+    output = []
+    in_section = False
+    for line in lines:
+        stripped = line.strip()
+        if in_section and (stripped.startswith('#') or stripped == 'END'):
+            in_section = False
+        if in_section and stripped and not stripped.startswith('!'):
+            continue
+        output.append(line)
+        if stripped.lstrip('#').strip() == section and \
+                stripped.startswith('#'):
+            in_section = True
+            if content:
+                output.append(content)
+    with open(inp_file, 'w') as f:
+        f.write('\n'.join(output) + '\n')
+
+def run_fraglib_setup(py2, fraglib_setup,cassandra,inp_file,mcf_files,pdb_files,workdir,
+        timeout=None):
+    """ Generate the fragment library, logging to cassandra_fraglib.out/err
+    in `workdir`. `pdb_files` holds one PDB (str or list of str) per species
+
+    Raises
+    ------
+    commpare.runner.EngineCommandError
+        If library_setup.py fails or takes longer than `timeout` seconds
+    """
+    if isinstance(pdb_files, str):
+        pdb_files = [pdb_files]
+    fraglib_cmd = [py2, fraglib_setup, cassandra, inp_file] + list(pdb_files)
+    run_command(fraglib_cmd, timeout=timeout,
+            log_prefix=os.path.join(workdir, 'cassandra_fraglib')).check()
+    return True
 
-def detect_cassandra_binaries():
+def run_cassandra(cassandra, inp_file, workdir, timeout=None):
+    """ Run Cassandra, logging to cassandra.out/err in `workdir`
+
+    Raises
+    ------
+    commpare.runner.EngineCommandError
+        If Cassandra fails or takes longer than `timeout` seconds
+    """
+    cassandra_cmd = [cassandra, inp_file]
+    run_command(cassandra_cmd, timeout=timeout,
+            log_prefix=os.path.join(workdir, 'cassandra')).check()
 
-    cassandra_exec_names = [ 'cassandra.exe',
-                             'cassandra_gfortran.exe',
-                             'cassandra_pgfortran.exe',
-                             'cassandra_gfortran_openMP.exe',
-                             'cassandra_pgfortran_openMP.exe',
-                             'cassandra_intel_openMP.exe' ]
+def detect_cassandra_binaries():
 
     py2_exec_names = [ 'python2', 'python2.7' ]
 
-    for name in cassandra_exec_names:
+    for name in CASSANDRA_EXEC_NAMES:
         cassandra = shutil.which(name)
         if cassandra is not None:
             break
@@ -158,92 +472,58 @@ def detect_cassandra_binaries():
 
     return py2, fraglib_setup, cassandra
 
-def write_cassandra_inp():
+def write_cassandra_inp(species=None, box=None):
+    """ Write the Cassandra input file
+
+    Parameters
+    ----------
+    species : list of (str, int), optional
+        MCF file and number of molecules of each species,
+        defaults to a single molecule in structure.mcf
+    box : list of float, optional
+        Box lengths and angles (angstrom, degrees), e.g. `structure.box`.
+        Defaults to a `CASSANDRA_DEFAULT_BOX` cubic box.
+        The cutoffs are clamped to fit the box, see `cassandra_cutoff`
+
+    Returns
+    -------
+    filename, output : str
+        The input file, and the run name of the outputs
+    """
     filename = 'enertest.inp'
     output = 'enertest.out'
+    if species is None:
+        species = [('structure.mcf', 1)]
     with open(filename, 'w') as inpfile:
-        inpfile.write("""! Input file for testing energies
-
-# Run_Name
-{output}
-!------------------------------------------------------------------------------
-
-# Sim_Type
-nvt_mc
-!------------------------------------------------------------------------------
-
-# Nbr_Species
-1
-!------------------------------------------------------------------------------
-
-# VDW_Style
-lj cut 19.99
-!------------------------------------------------------------------------------
-
-# Charge_Style
-coul ewald 19.99 1e-5
-!------------------------------------------------------------------------------
-
-# Seed_Info
-1 2
-!------------------------------------------------------------------------------
-
-# Rcutoff_Low
-0.5
-!------------------------------------------------------------------------------
-
-# Molecule_Files
-structure.mcf 1
-!------------------------------------------------------------------------------
-
-# Box_Info
-1
-cubic
-100.
-!------------------------------------------------------------------------------
-
-# Temperature_Info
-300.0
-!------------------------------------------------------------------------------
-
-# Move_Probability_Info
-!------------------------------------------------------------------------------
-!-------------------------Choices don't matter for the single frame energy calc
-
-# Prob_Translation
-1
-1.0
-
-# Done_Probability_Info
-!------------------------------------------------------------------------------
-
-# Start_Type
-read_config 1 structure.xyz
-!------------------------------------------------------------------------------
-
-# Run_Type
-production   1
-!------------------------------------------------------------------------------
-
-# Simulation_Length_Info
-units        sweeps
-prop_freq    1
-coord_freq   1
-run          0
-!------------------------------------------------------------------------------
-
-# Property_Info 1
-energy_total
-!------------------------------------------------------------------------------
-
-# Fragment_Files
-!------------------------------------------------------------------------------
-!-----------------------------------library_setup.py will autofill this section
-
-END""".format(output=output))
+        inpfile.write(CASSANDRA_INP.format(output=output,
+            nbr_species=len(species),
+            molecule_files='\n'.join('{} {}'.format(mcf_file, count)
+                                    for mcf_file, count in species),
+            box_info=_cassandra_box_info(box),
+            cutoff=cassandra_cutoff(box),
+            counts=' '.join(str(count) for _, count in species)))
 
     return filename,output
 
+def cassandra_cutoff(box=None):
+    """ LJ and Ewald cutoff (angstrom) for a box, `CASSANDRA_CUTOFF` or
+    just under half the shortest box length, whichever is smaller """
+    if box is None:
+        box = [CASSANDRA_DEFAULT_BOX] * 3
+    half = min(float(length) for length in box[:3]) / 2
+    return min(CASSANDRA_CUTOFF, round(half - 0.01, 2))
+
+def _cassandra_box_info(box):
+    if box is None:
+        return 'cubic\n{}'.format(CASSANDRA_DEFAULT_BOX)
+    lengths, angles = box[:3], box[3:]
+    if not np.allclose(angles, 90):
+        raise ValueError("Cassandra energies are only measured in "
+                        "orthogonal boxes, got angles {}".format(list(angles)))
+    if np.allclose(lengths, lengths[0]):
+        return 'cubic\n{}'.format(lengths[0])
+    return 'orthogonal\n{} {} {}'.format(*lengths)
+
 @contextlib.contextmanager
 def temporary_cd(dir_path):
     import os
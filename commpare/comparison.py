@@ -0,0 +1,176 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from commpare.conversion import CANONICAL_COLUMNS
+
+# Per-term (absolute kJ/mol, relative) tolerances of `compare_energies`.
+# A deviation is flagged if it exceeds atol + rtol * max(|a|, |b|)
+DEFAULT_TOLERANCES = {'bond': (0.01, 1e-4),
+                    'angle': (0.01, 1e-4),
+                    'dihedral': (0.01, 1e-4),
+                    'LJ': (0.1, 1e-3),
+                    'QQ': (0.1, 1e-3),
+                    'nonbond': (0.1, 1e-3),
+                    'all': (0.1, 1e-3)}
+
+def compare_energies(energies, terms=None, reference=None, tolerances=None):
+    """ Pairwise deviations between engines, for every structure and term
+
+    Parameters
+    ----------
+    energies : pandas.DataFrame
+        Indexed by (structure, engine) as returned by `collect_energies`,
+        or by engine as returned by `spawn_engine_simulations`
+    terms : list of str, optional
+        Energy columns to compare, defaults to the canonical terms present
+    reference : str, optional
+        Only compare each engine against this engine,
+        instead of every pair of engines
+    tolerances : dict, optional
+        term : (atol, rtol), or term : atol with no relative tolerance.
+        Updates `DEFAULT_TOLERANCES`
+
+    Returns
+    -------
+    deviations : pandas.DataFrame
+        One row per (structure, term, engine pair), with the energies of
+        both engines, `abs_deviation`, `rel_deviation` (relative to the
+        larger magnitude), the `tolerance`, `excess` (deviation over
+        tolerance), and `flagged` where the deviation exceeds the
+        tolerance. Pairs with a missing energy (a failed engine, or a
+        term an engine does not report) are left out
+
+    Notes
+    -----
+    Energies are arranged in a (structures, terms, engines) array, and all
+    pairs are computed at once
+    """
+    energies = _by_structure_and_engine(energies)
+    if terms is None:
+        terms = [term for term in CANONICAL_COLUMNS if term in energies]
+    atol, rtol = _tolerances(terms, tolerances)
+
+    values = energies[terms].apply(pd.to_numeric, errors='coerce')
+    cube = values.unstack('engine')
+    engines = list(cube.columns.get_level_values('engine').unique())
+    cube = cube.reindex(columns=pd.MultiIndex.from_product([terms, engines]))
+    n_structures, n_terms, n_engines = len(cube), len(terms), len(engines)
+    array = cube.to_numpy(dtype=np.float64).reshape(n_structures, n_terms,
+                                                    n_engines)
+
+    if reference is not None:
+        if reference not in engines:
+            raise ValueError("Reference engine {} not in {}".format(
+                                reference, engines))
+        pairs = [(engines.index(reference), j) for j in range(n_engines)
+                    if engines[j] != reference]
+    else:
+        pairs = list(itertools.combinations(range(n_engines), 2))
+    first = np.array([i for i, _ in pairs], dtype=np.intp)
+    second = np.array([j for _, j in pairs], dtype=np.intp)
+
+    # (structures, terms, pairs)
+    a = array[:, :, first]
+    b = array[:, :, second]
+    abs_deviation = np.abs(a - b)
+    magnitude = np.maximum(np.abs(a), np.abs(b))
+    tolerance = atol[:, None] + rtol[:, None] * magnitude
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel_deviation = np.where(magnitude > 0, abs_deviation / magnitude, 0)
+        excess = np.where(tolerance > 0, abs_deviation / tolerance,
+                        np.where(abs_deviation > 0, np.inf, 0))
+
+    keep = ~np.isnan(abs_deviation).ravel()
+    n_pairs = len(pairs)
+    structure_codes = np.repeat(np.arange(n_structures), n_terms * n_pairs)
+    term_codes = np.tile(np.repeat(np.arange(n_terms), n_pairs), n_structures)
+    pair_codes = np.tile(np.arange(n_pairs), n_structures * n_terms)
+    engine_names = pd.Index(engines)
+
+    deviations = pd.DataFrame({
+        'structure': pd.Categorical.from_codes(structure_codes[keep],
+                                                cube.index),
+        'term': pd.Categorical.from_codes(term_codes[keep], terms),
+        'engine': pd.Categorical.from_codes(first[pair_codes[keep]],
+                                            engine_names),
+        'other_engine': pd.Categorical.from_codes(second[pair_codes[keep]],
+                                                engine_names),
+        'energy': a.ravel()[keep],
+        'other_energy': b.ravel()[keep],
+        'abs_deviation': abs_deviation.ravel()[keep],
+        'rel_deviation': rel_deviation.ravel()[keep],
+        'tolerance': tolerance.ravel()[keep],
+        'excess': excess.ravel()[keep],
+        })
+    deviations['flagged'] = deviations['excess'].to_numpy() > 1
+    return deviations
+
+def worst_offenders(deviations, n=20, flagged_only=True):
+    """ Largest deviations relative to their tolerance
+
+    Parameters
+    ----------
+    deviations : pandas.DataFrame
+        As returned by `compare_energies`
+    n : int, optional
+        Number of rows, None for all
+    flagged_only : bool
+        Only include deviations over tolerance
+
+    Returns
+    -------
+    offenders : pandas.DataFrame
+        Sorted by `excess`, then `abs_deviation`, largest first
+    """
+    if flagged_only:
+        deviations = deviations[deviations['flagged'].to_numpy()]
+    offenders = deviations.sort_values(['excess', 'abs_deviation'],
+                                        ascending=False, kind='stable')
+    if n is not None:
+        offenders = offenders.head(n)
+    return offenders.reset_index(drop=True)
+
+def summarize_deviations(deviations):
+    """ Tolerance report per engine pair and term
+
+    Returns
+    -------
+    summary : pandas.DataFrame
+        Indexed by (engine, other_engine, term), with the number of
+        structures `compared` and `flagged`, and the largest and median
+        absolute deviations
+    """
+    grouped = deviations.groupby(['engine', 'other_engine', 'term'],
+                                observed=True)
+    summary = grouped.agg(compared=('abs_deviation', 'size'),
+                        flagged=('flagged', 'sum'),
+                        max_abs_deviation=('abs_deviation', 'max'),
+                        median_abs_deviation=('abs_deviation', 'median'),
+                        max_rel_deviation=('rel_deviation', 'max'))
+    summary['flagged'] = summary['flagged'].astype(int)
+    return summary
+
+def _by_structure_and_engine(energies):
+    """ Energies indexed by (structure, engine) """
+    if isinstance(energies.index, pd.MultiIndex):
+        energies = energies.copy(deep=False)
+        energies.index = energies.index.set_names(['structure', 'engine'])
+        return energies
+    if 'structure' in energies and 'engine' in energies:
+        return energies.set_index(['structure', 'engine'])
+    # A single structure, indexed by engine
+    return pd.concat({0: energies}, names=['structure', 'engine'])
+
+def _tolerances(terms, tolerances=None):
+    merged = dict(DEFAULT_TOLERANCES)
+    merged.update(tolerances or {})
+    atol, rtol = [], []
+    for term in terms:
+        tolerance = merged.get(term, (0.0, 0.0))
+        if np.isscalar(tolerance):
+            tolerance = (tolerance, 0.0)
+        atol.append(tolerance[0])
+        rtol.append(tolerance[1])
+    return np.array(atol, dtype=np.float64), np.array(rtol, dtype=np.float64)
@@ -1,39 +1,465 @@
+import concurrent.futures
+import contextlib
+import functools
+import multiprocessing
+import traceback
+import os
+
 import pandas as pd
 import commpare
+from commpare.structure_arrays import round_structure, get_structure_arrays
+from commpare.cache import structure_hash, topology_hash, open_artifact_cache
+from commpare.runner import EngineCommandError
+from commpare.mm_engines import get_engine
+from commpare.timing import StageTimer, timed
+from commpare.result_store import open_result_store
+
+CANONICAL_COLUMNS = ['bond', 'angle', 'dihedral', 'LJ', 'QQ', 'nonbond', 'all']
 
 def spawn_engine_simulations(structure, engines=None,
-        round_decimal=None, hoomd_kwargs={}):
-    simulate_engine = {}
+        round_decimal=None,
+        hoomd_kwargs={}, openmm_kwargs={}, numpy_kwargs={},
+        parallel=False, max_workers=None,
+        cache=None, bypass_cache=False, input_cache=None,
+        timings=False, timing_hook=None, result_store=None):
+    """ Measure the energy of a parmed.Structure with each MM engine
+
+    Parameters
+    ----------
+    structure : parmed.Structure
+    engines : list of str, optional
+        Engines to evaluate, defaults to `commpare.identify_engines()`.
+        Repeated engines are evaluated once
+    round_decimal : int, optional
+        Round coordinates to this many decimals before evaluation.
+        A rounded copy is evaluated, `structure` is left unchanged
+    hoomd_kwargs : dict
+        Passed to `commpare.hoomd.build_run_measure_hoomd`
+    openmm_kwargs : dict
+        Passed to `commpare.openmm.build_run_measure_openmm`, e.g.
+        {'platform': 'CPU', 'platform_properties': {'Threads': 2}}
+        to limit the cores OpenMM uses alongside other engines
+    numpy_kwargs : dict
+        Passed to `commpare.reference.build_run_measure_numpy`,
+        e.g. {'cutoff': 20} for a nonbonded cutoff in angstroms
+    parallel : bool
+        Evaluate each engine in its own worker process.
+        Engines are independent, so wall time is roughly that of the
+        slowest engine. Separate processes also isolate global engine
+        state, such as `hoomd.context`
+    max_workers : int, optional
+        Cap on the number of worker processes when `parallel=True`
+    cache : commpare.EnergyCache, str, or bool, optional
+        Persistent energy cache consulted before running each engine.
+        A str is the path of the cache database, True uses the
+        default location, and the database is closed on return.
+        Successful results are stored back
+    bypass_cache : bool
+        Ignore cached energies and re-run every engine.
+        Fresh results are still written to `cache`
+    input_cache : commpare.ArtifactCache, str, or bool, optional
+        Cache of engine inputs prepared from the topology (GROMACS tpr,
+        OpenMM System, HOOMD simulation, Cassandra fragment library), 
+        so that structures differing only in coordinates skip straight
+        to evaluation.
+        A str is the cache directory, True uses the default location
+    timings : bool
+        Add the wall and CPU time (seconds) of each engine's stages as
+        `time_<stage>_wall` and `time_<stage>_cpu` columns, e.g.
+        `time_grompp_wall`, with `time_total_*` covering the whole engine.
+        Energies answered from `cache` have no timings
+    timing_hook : callable, optional
+        Called as `timing_hook(engine, stage, wall, cpu)` as each stage
+        ends. In parallel mode it is called in the worker processes,
+        so it must be picklable
+    result_store : commpare.ResultStore, str, or bool, optional
+        Append each engine's result, with the structure and settings
+        hashes and the engine version, to this Parquet result history.
+        A str is the dataset directory, True uses the default location.
+        Rows are labelled by `structure.title`. Pass a ResultStore with
+        {'forcefield': name} `metadata` to query rows by forcefield.
+        A ResultStore passed in is not flushed, close it when done
+
+    Returns
+    -------
+    energies : pandas.DataFrame
+        Indexed by engine with canonicalized energy columns.
+        In parallel mode, an engine that raises is reported as a row of
+        NaN energies with the exception message in an `error` column.
+        Failed or timed out engine binaries (`EngineCommandError`) are
+        reported this way in serial mode too
+    """
     if engines is None:
         import commpare
         engines = commpare.identify_engines()
+    # Each engine is evaluated once, in order of first appearance
+    engines = list(dict.fromkeys(engines))
+
+    structure = round_structure(structure, round_decimal)
+
+    engine_kwargs = {'hoomd': hoomd_kwargs, 'openmm': openmm_kwargs,
+                    'numpy': numpy_kwargs}
+    close_cache = cache is True or isinstance(cache, str)
+    cache = _open_cache(cache)
+    try:
+        return _spawn_engine_simulations(structure, engines, engine_kwargs,
+                parallel, max_workers, cache, bypass_cache,
+                open_artifact_cache(input_cache),
+                {'timings': timings, 'timing_hook': timing_hook},
+                result_store)
+    finally:
+        if close_cache:
+            cache.close()
 
-    if round_decimal is not None:
-        for atom in structure.atoms:
-            atom.xx = round(atom.xx,round_decimal)
-            atom.xy = round(atom.xy,round_decimal)
-            atom.xz = round(atom.xz,round_decimal)
+def _spawn_engine_simulations(structure, engines, engine_kwargs, parallel,
+        max_workers, cache, bypass_cache, input_cache, timing, result_store):
+    store = open_result_store(result_store)
+    digest, topology = _structure_digests(structure,
+            cache is not None or input_cache is not None or store is not None)
+
+    frames = {}
+    keys = {engine: _cache_key(cache, structure, engine, engine_kwargs,
+                                digest=digest)
+            for engine in engines}
+    if not bypass_cache:
+        for engine in engines:
+            frames[engine] = _cached_frame(cache, keys[engine], engine)
+    to_run = [engine for engine in engines if frames.get(engine) is None]
 
     # For each identified engine, measure energy, store in dataframe
-    energies = pd.DataFrame()
-    for engine in engines:
-        if engine == 'cassandra':
-            import commpare.cassandra
-            energies = energies.append(
-                    commpare.cassandra.build_run_measure_cassandra(structure))
-        if engine == 'gromacs':
-            import commpare.gromacs
-            energies = energies.append(
-                    commpare.gromacs.build_run_measure_gromacs(structure))
-        if engine == 'openmm':
-            import commpare.openmm
-            energies = energies.append(
-                    commpare.openmm.build_run_measure_openmm(structure))
-        if engine == 'hoomd':
-            import commpare.hoomd
-            energies = energies.append(
-                    commpare.hoomd.build_run_measure_hoomd(structure,
-                                                        **hoomd_kwargs))
-
-    return energies
+    if parallel:
+        results = _run_engines_parallel(structure, to_run, engine_kwargs,
+                max_workers=max_workers, input_cache=input_cache, **timing)
+    else:
+        with _known_topology(input_cache, structure, topology):
+            results = [_run_engine(engine, structure, input_cache=input_cache,
+                                **timing, **engine_kwargs.get(engine, {}))
+                        for engine in to_run]
+    for engine, df in zip(to_run, results):
+        _store_frame(cache, keys[engine], engine, df)
+        frames[engine] = df
+
+    if store is not None:
+        for engine in engines:
+            _store_result(store, frames[engine], structure.title or None,
+                        engine, digest, engine_kwargs)
+        if store is not result_store:
+            store.close()
+
+    frames = [frames[engine] for engine in engines 
+                if frames[engine] is not None]
+    if len(frames) == 0:
+        return pd.DataFrame()
+
+    return pd.concat(frames, sort=False)
+
+def spawn_engine_simulations_batch(structures, engines=None,
+        round_decimal=None,
+        hoomd_kwargs={}, openmm_kwargs={}, numpy_kwargs={},
+        parallel=False, max_workers=None,
+        cache=None, bypass_cache=False, input_cache=None,
+        timings=False, timing_hook=None, result_store=None):
+    """ Measure energies of many structures, streaming one record at a time
+
+    Parameters
+    ----------
+    structures : iterable or dict
+        parmed.Structure objects, (label, parmed.Structure) pairs, or a
+        dictionary of label : parmed.Structure.
+        Bare structures are labelled by their position in the iterable.
+        The iterable is consumed lazily
+    engines, round_decimal, hoomd_kwargs, openmm_kwargs, numpy_kwargs, cache,
+    bypass_cache, input_cache, timings, timing_hook, result_store :
+        See `spawn_engine_simulations`, rows are labelled as the records
+    parallel : bool
+        Evaluate each (structure, engine) pair in a pool of worker
+        processes, yielding records as they finish
+    max_workers : int, optional
+        Cap on the number of worker processes, defaults to the CPU count
+
+    Yields
+    ------
+    record : dict
+        'structure' label, 'engine' name, and the canonicalized energies.
+        In parallel mode, a failed evaluation yields NaN energies and
+        an 'error' message, as does a failed engine binary in serial mode
+
+    Notes
+    -----
+    No DataFrame is built here, so records can be written out as they
+    arrive. Use `collect_energies` to assemble a DataFrame at the end
+    """
+    if engines is None:
+        import commpare
+        engines = commpare.identify_engines()
+    # Each engine is evaluated once, in order of first appearance
+    engines = list(dict.fromkeys(engines))
+    engine_kwargs = {'hoomd': hoomd_kwargs, 'openmm': openmm_kwargs,
+                    'numpy': numpy_kwargs}
+    close_cache = cache is True or isinstance(cache, str)
+    cache = _open_cache(cache)
+    input_cache = open_artifact_cache(input_cache)
+    timing = {'timings': timings, 'timing_hook': timing_hook}
+    store = open_result_store(result_store)
+
+    if isinstance(structures, dict):
+        labelled = iter(structures.items())
+    else:
+        labelled = (item if isinstance(item, tuple) else (i, item)
+                    for i, item in enumerate(structures))
+
+    def tasks():
+        for label, structure in labelled:
+            structure = round_structure(structure, round_decimal)
+            digest, topology = _structure_digests(structure,
+                    cache is not None or input_cache is not None
+                    or store is not None)
+            for engine in engines:
+                key = _cache_key(cache, structure, engine, engine_kwargs,
+                                digest=digest)
+                df = None
+                if not bypass_cache:
+                    df = _cached_frame(cache, key, engine)
+                yield label, engine, structure, (key, digest, topology), df
+
+    def record(label, engine, keys, df):
+        _store_result(store, df, label, engine, keys[1], engine_kwargs)
+        return _frame_to_record(label, engine, df)
+
+    try:
+        if not parallel:
+            for label, engine, structure, keys, df in tasks():
+                if df is None:
+                    with _known_topology(input_cache, structure, keys[2]):
+                        df = _run_engine(engine, structure,
+                                input_cache=input_cache,
+                                **timing, **engine_kwargs.get(engine, {}))
+                    _store_frame(cache, keys[0], engine, df)
+                if df is not None:
+                    yield record(label, engine, keys, df)
+        else:
+            for item in _run_tasks_parallel(tasks(), engine_kwargs,
+                    max_workers, input_cache, timing, cache):
+                yield record(*item)
+    finally:
+        if store is not None and store is not result_store:
+            store.close()
+        if close_cache:
+            cache.close()
+
+def _run_tasks_parallel(task_iter, engine_kwargs, max_workers, input_cache,
+        timing, cache):
+    """ Evaluate (label, engine, structure, keys, df) tasks in a process
+    pool, yielding (label, engine, keys, df) as they finish """
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, max_workers)
+
+    mp_context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+            mp_context=mp_context) as executor:
+        # Only keep a bounded number of structures in flight
+        pending = {}
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < 2 * max_workers:
+                task = next(task_iter, None)
+                if task is None:
+                    exhausted = True
+                    break
+                label, engine, structure, keys, df = task
+                if df is not None:
+                    yield label, engine, keys, df
+                    continue
+                future = executor.submit(_run_engine, engine, structure,
+                                        input_cache=input_cache, **timing,
+                                        **engine_kwargs.get(engine, {}))
+                pending[future] = (label, engine, keys)
+            if not pending:
+                continue
+
+            done, _ = concurrent.futures.wait(pending,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                label, engine, keys = pending.pop(future)
+                try:
+                    df = future.result()
+                except Exception as e:
+                    df = _error_frame(engine, e)
+                _store_frame(cache, keys[0], engine, df)
+                if df is not None:
+                    yield label, engine, keys, df
+
+def collect_energies(records):
+    """ Assemble streamed energy records into a single DataFrame
+
+    Parameters
+    ----------
+    records : iterable of dict
+        As yielded by `spawn_engine_simulations_batch`
+
+    Returns
+    -------
+    energies : pandas.DataFrame
+        Indexed by (structure, engine)
+    """
+    df = pd.DataFrame.from_records(list(records))
+    if len(df) == 0:
+        return df
+    return df.set_index(['structure', 'engine'])
+
+def _frame_to_record(label, engine, df):
+    """ Flatten a single-engine energy DataFrame into a plain dict """
+    record = {'structure': label, 'engine': engine}
+    record.update(df.iloc[0].to_dict())
+    return record
+
+def _open_cache(cache):
+    if cache is None or cache is False:
+        return None
+    from commpare.cache import EnergyCache
+    if cache is True:
+        return EnergyCache()
+    if isinstance(cache, str):
+        return EnergyCache(cache)
+    return cache
+
+def _engine_settings(engine, engine_kwargs):
+    """ Run settings that affect an engine's energies, for cache keys """
+    settings = {'kwargs': engine_kwargs.get(engine, {})}
+    if engine == 'gromacs':
+        from commpare.gromacs.gromacs_utils import GMX_MDP
+        settings['mdp'] = GMX_MDP
+    elif engine == 'openmm':
+        from commpare.openmm.openmm_utils import OMM_NONBONDED_CUTOFF
+        settings['cutoff'] = OMM_NONBONDED_CUTOFF
+    elif engine == 'cassandra':
+        from commpare.cassandra.cassandra_utils import CASSANDRA_INP
+        settings['inp'] = CASSANDRA_INP
+    return settings
+
+def _structure_digests(structure, needed=True):
+    """ Structure and topology hashes of a structure, from a single
+    extraction of its parameters. (None, None) if not `needed` """
+    if not needed:
+        return None, None
+    # Re-extracted once, the engines then reuse these arrays
+    arrays = get_structure_arrays(structure, refresh=True)
+    return structure_hash(arrays), topology_hash(arrays)
+
+def _known_topology(input_cache, structure, topology):
+    if input_cache is None or topology is None:
+        return contextlib.nullcontext()
+    return input_cache.known_topology(structure, topology)
+
+def _cache_key(cache, structure, engine, engine_kwargs, digest=None):
+    if cache is None:
+        return None
+    try:
+        settings = _engine_settings(engine, engine_kwargs)
+    except ImportError:
+        # Engine is not installed, nothing will be cached for it
+        return None
+    return cache.key(structure, engine, settings=settings, digest=digest)
+
+def _cached_frame(cache, key, engine):
+    if cache is None or key is None:
+        return None
+    energies = cache.get(key)
+    if energies is None:
+        return None
+    return pd.DataFrame.from_dict({engine: energies}, orient='index')
+
+def _store_frame(cache, key, engine, df):
+    if cache is None or key is None or df is None or 'error' in df:
+        return
+    # Timings describe one run, only energies are cached
+    cache.put(key, engine, {column: value 
+                            for column, value in df.iloc[0].items()
+                            if not str(column).startswith('time_')})
+
+def _store_result(store, df, label, engine, digest, engine_kwargs):
+    """ Append an engine's result to a ResultStore, with the hashes
+    and engine version identifying how it was obtained """
+    if store is None or df is None:
+        return
+    from commpare.cache import settings_hash
+    from commpare.mm_engines import get_engine_version
+    try:
+        settings = _engine_settings(engine, engine_kwargs)
+    except ImportError:
+        settings = None
+    store.append(_frame_to_record(label, engine, df), structure_hash=digest,
+                settings_hash=settings_hash(engine, settings),
+                engine_version=get_engine_version(engine))
+
+def _run_engine(engine, structure, input_cache=None, timings=False,
+        timing_hook=None, **kwargs):
+    """ Build, run, and measure a single MM engine
+
+    The engine is looked up with `commpare.mm_engines.get_engine` and
+    imported on first use. Returns None for engines that are not
+    supported. A failed or timed out engine binary is reported as an
+    error frame. With `timings` or a `timing_hook`, a StageTimer is 
+    passed to the engine as `timer` """
+    build_run_measure = get_engine(engine)
+    if build_run_measure is None:
+        return None
+    timer = None
+    if timings or timing_hook is not None:
+        hook = None
+        if timing_hook is not None:
+            hook = functools.partial(timing_hook, engine)
+        timer = StageTimer(hook=hook)
+        kwargs['timer'] = timer
+    try:
+        with timed(timer, 'total'):
+            df = build_run_measure(structure, input_cache=input_cache,
+                                    **kwargs)
+    except EngineCommandError as e:
+        df = _error_frame(engine, e)
+    if timings and df is not None:
+        for column, value in timer.columns().items():
+            df[column] = value
+    return df
+
+def _run_engines_parallel(structure, engines, engine_kwargs, max_workers=None,
+        input_cache=None, timings=False, timing_hook=None):
+    """ Fan engines out to a process pool, one task per engine
+
+    Results are collected as they finish, then returned in the
+    same order as `engines`
+    """
+    if len(engines) == 0:
+        return []
+    if max_workers is None:
+        max_workers = len(engines)
+    max_workers = max(1, min(max_workers, len(engines)))
+
+    results = {}
+    # Fresh interpreters, so no engine inherits another's global state
+    mp_context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+            mp_context=mp_context) as executor:
+        futures = {executor.submit(_run_engine, engine, structure,
+                                    input_cache=input_cache, 
+                                    timings=timings, timing_hook=timing_hook,
+                                    **engine_kwargs.get(engine, {})): engine
+                    for engine in engines}
+        for future in concurrent.futures.as_completed(futures):
+            engine = futures[future]
+            try:
+                results[engine] = future.result()
+            except Exception as e:
+                results[engine] = _error_frame(engine, e)
+
+    return [results[engine] for engine in engines]
 
+def _error_frame(engine, exception):
+    """ Placeholder row for an engine that failed to produce energies """
+    error = ''.join(traceback.format_exception_only(type(exception),
+                                                    exception)).strip()
+    df = pd.DataFrame(index=[engine], columns=CANONICAL_COLUMNS, dtype=float)
+    df['error'] = error
+    return df
@@ -1,15 +1,183 @@
-import importlib
+import collections.abc
+import glob
+import hashlib
+import importlib.util
+import os
+import pickle
+import warnings
 
-def identify_forcefields():
-    forcefields = {}
-    try: 
-        foyer = importlib.import_module('foyer')
-        if 'load_GAFF' in dir(foyer.forcefields):
-            forcefields['GAFF'] = foyer.forcefields.load_GAFF()
-        if 'load_OPLSAA' in dir(foyer.forcefields):
-            forcefields['OPLSAA'] = foyer.forcefields.load_OPLSAA()
+from commpare.cache import atomic_path, open_artifact_cache
 
-        return forcefields
-    except ModuleNotFoundError:
-        return forcefields
+# Forcefields shipped with foyer: name : xml file.
+# Forcefields are parsed on first use and memoized for the process
+FOYER_FORCEFIELDS = {'GAFF': 'gaff.xml', 'OPLSAA': 'oplsaa.xml'}
 
+_forcefields = {}
+
+def identify_forcefields(cache=None):
+    """ Forcefields available for parametrizing reference systems
+
+    Parameters
+    ----------
+    cache : commpare.ArtifactCache, str, or bool, optional
+        Persist parsed forcefields, keyed by the hash of their XML file,
+        so later processes skip parsing.
+        A str is the cache directory, True uses the default location
+
+    Returns
+    -------
+    forcefields : ForcefieldRegistry
+        Mapping of name : foyer.Forcefield. Listing the names parses
+        nothing, each forcefield is loaded when first looked up
+    """
+    return ForcefieldRegistry(cache=cache)
+
+def get_forcefield(name, cache=None):
+    """ A foyer.Forcefield by name, parsed once per process
+
+    Parameters
+    ----------
+    name : str
+        A key of `FOYER_FORCEFIELDS`, e.g. 'OPLSAA'
+    cache : commpare.ArtifactCache, str, or bool, optional
+        See `identify_forcefields`
+    """
+    if name not in _forcefields:
+        if name not in FOYER_FORCEFIELDS:
+            raise KeyError("Unknown forcefield {}, available forcefields "
+                        "are {}".format(name, list(FOYER_FORCEFIELDS)))
+        _forcefields[name] = _load_forcefield(name, open_artifact_cache(cache))
+    return _forcefields[name]
+
+def forcefield_xml(name):
+    """ Path of a foyer forcefield's XML file, found without importing
+    foyer, or None if it is not installed """
+    spec = None
+    try:
+        spec = importlib.util.find_spec('foyer')
+    except (ImportError, ValueError):
+        pass
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    filename = FOYER_FORCEFIELDS[name]
+    for location in spec.submodule_search_locations:
+        found = sorted(glob.glob(os.path.join(location, 'forcefields', '**',
+                                            filename), recursive=True))
+        if found:
+            return found[0]
+    return None
+
+
+class ForcefieldRegistry(collections.abc.Mapping):
+    """ Read-only mapping of forcefield name : foyer.Forcefield,
+    loading each forcefield on first lookup with `get_forcefield`.
+    The installed forcefields are found once, on creation """
+    def __init__(self, cache=None):
+        self.cache = cache
+        self._names = [name for name in FOYER_FORCEFIELDS
+                    if forcefield_xml(name) is not None]
+
+    def __getitem__(self, name):
+        if name not in self._names:
+            raise KeyError(name)
+        return get_forcefield(name, cache=self.cache)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._names
+
+def parametrize_smiles(smiles, forcefield, cache=None):
+    """ Atom type a molecule given by SMILES with a foyer forcefield
+
+    Loading the SMILES and atom typing are usually much slower than
+    evaluating the energy, so with a cache the parametrized structure
+    is stored on disk and later calls skip both
+
+    Parameters
+    ----------
+    smiles : str
+    forcefield : str
+        A key of `FOYER_FORCEFIELDS`, e.g. 'OPLSAA'
+    cache : commpare.ArtifactCache, str, or bool, optional
+        Keyed by the SMILES, the forcefield name and XML hash, and the
+        foyer and mbuild versions. See `identify_forcefields`
+
+    Returns
+    -------
+    structure : parmed.Structure
+        With a box ten times the molecule's bounding box,
+        or 100 if that is smaller than 10 along any axis
+    """
+    import foyer
+    import mbuild as mb
+    cache = open_artifact_cache(cache)
+    path = None
+    if cache is not None:
+        key = cache.key(None, 'smiles', smiles, forcefield,
+                        _forcefield_version(forcefield),
+                        getattr(foyer, '__version__', ''),
+                        getattr(mb, '__version__', ''))
+        path = cache.path('smiles', key, 'structure.pkl')
+        structure = _load_pickle(path)
+        if structure is not None:
+            return structure
+
+    compound = mb.load(smiles, smiles=True)
+    structure = get_forcefield(forcefield, cache=cache).apply(compound)
+    # Enlarge box to avoid cutoff issues
+    bbox = compound.boundingbox
+    bbox.lengths *= 10
+    if any(bbox.lengths < 10):
+        bbox.lengths = [100, 100, 100]
+    structure.box = [bbox.lengths[0], bbox.lengths[1], bbox.lengths[2],
+                    90, 90, 90]
+
+    if path is not None:
+        _dump_pickle(structure, path, smiles)
+    return structure
+
+def _load_forcefield(name, cache=None):
+    import foyer
+    xml = forcefield_xml(name)
+    if cache is None:
+        return foyer.Forcefield(forcefield_files=xml)
+
+    key = cache.key(None, 'forcefield', name, _forcefield_version(name),
+                    getattr(foyer, '__version__', ''))
+    path = cache.path('forcefields', key, 'forcefield.pkl')
+    forcefield = _load_pickle(path)
+    if forcefield is None:
+        forcefield = foyer.Forcefield(forcefield_files=xml)
+        _dump_pickle(forcefield, path, name)
+    return forcefield
+
+def _forcefield_version(name):
+    """ Hash of a forcefield's XML file, None if it is not found """
+    xml = forcefield_xml(name)
+    if xml is None:
+        return None
+    with open(xml, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _load_pickle(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        # Stale or truncated pickle, build again
+        return None
+
+def _dump_pickle(value, path, name):
+    """ Pickle atomically, warn rather than fail """
+    try:
+        with atomic_path(path) as tmp, open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        warnings.warn("Could not cache {}: {}".format(name, e))
@@ -1 +1,3 @@
 from .gromacs_utils import *
+from .edr import *
+from .topology import *
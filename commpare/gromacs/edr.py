@@ -0,0 +1,244 @@
+import struct
+
+import numpy as np
+
+# Streaming reader of GROMACS energy (edr) files.
+# edr files are XDR encoded (big-endian): a header with the energy term
+# names, then one record per frame with a small header, the energies,
+# and optional data blocks. Only the requested terms are decoded and
+# frames are read one at a time, so memory use does not grow with
+# the number of frames
+
+ENX_VERSION = 5
+
+_NAMES_MAGIC = -55555
+_FRAME_MAGIC = -7777777
+# First real of every frame header, written in the file's precision
+_FIRST_REAL = -2e10
+
+# Bytes per element of the block data types
+# int, float, double, int64, char (padded to 4), string (variable)
+_BLOCK_ITEM_SIZE = [4, 4, 8, 8, 4, None]
+
+def read_edr_names(edrfile):
+    """ Names of the energy terms in a GROMACS edr file """
+    with EdrReader(edrfile) as reader:
+        return list(reader.names)
+
+def iter_edr_frames(edrfile, terms=None):
+    """ Stream selected energy terms of a GROMACS edr file frame by frame
+
+    Parameters
+    ----------
+    edrfile : str
+    terms : list of str, optional
+        Energy term names, e.g. ['Bond', 'LJ (SR)', 'Potential'].
+        Terms missing from the file are skipped, see `EdrReader.terms`.
+        Defaults to every term
+
+    Yields
+    ------
+    time : float
+        Frame time (ps)
+    energies : np.ndarray
+        (n_terms,) values of the terms found in the file (kJ/mol)
+    """
+    with EdrReader(edrfile, terms=terms) as reader:
+        for time, energies in reader:
+            yield time, energies
+
+
+class EdrReader(object):
+    """ Sequential reader of selected terms from a GROMACS edr file
+
+    Parameters
+    ----------
+    edrfile : str
+    terms : list of str, optional
+        Energy term names to decode, defaults to every term
+
+    Attributes
+    ----------
+    names : list of str
+        Every energy term in the file
+    terms : list of str
+        Requested terms present in the file, the order of the
+        values yielded for each frame
+
+    Notes
+    -----
+    Single and double precision files are both supported, the
+    precision is detected from the first frame header.
+    Pre-4.0 (version 1) edr files are not supported
+    """
+    def __init__(self, edrfile, terms=None):
+        self._file = open(edrfile, 'rb')
+        self._real = None
+        try:
+            self.names = self._read_names()
+        except Exception:
+            self._file.close()
+            raise
+        if terms is None:
+            terms = self.names
+        position = {name: i for i, name in enumerate(self.names)}
+        self.terms = [term for term in terms if term in position]
+        self._indices = np.array([position[term] for term in self.terms],
+                                dtype=int)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __iter__(self):
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def read(self, max_frames=None):
+        """ Read the remaining frames, or at most `max_frames`
+
+        Returns
+        -------
+        times : np.ndarray
+            (n_frames,)
+        energies : np.ndarray
+            (n_frames, n_terms)
+        """
+        times, energies = [], []
+        for time, values in self:
+            times.append(time)
+            energies.append(values)
+            if max_frames is not None and len(times) >= max_frames:
+                break
+        return (np.array(times, dtype=np.float64),
+                np.array(energies, dtype=np.float64).reshape(
+                    -1, len(self.terms)))
+
+    def read_frame(self):
+        """ Next (time, energies) frame, or None at the end of the file.
+        Frames without energies (only data blocks, e.g. distance or
+        orientation restraints) are skipped """
+        while True:
+            header = self._read_frame_header()
+            if header is None:
+                return None
+            time, nre, nsum, blocks = header
+
+            # Each energy is followed by its average and sum when nsum > 0
+            per_energy = 3 if nsum > 0 else 1
+            size = nre * per_energy * self._real.itemsize
+            values = np.frombuffer(self._read(size), dtype=self._real)
+
+            for block_type, count in blocks:
+                self._skip_block(block_type, count)
+
+            if nre > 0:
+                energies = values[::per_energy][self._indices]
+                return time, energies.astype(np.float64)
+
+    def _read_names(self):
+        magic, = self._unpack('>i')
+        if magic > 0:
+            raise ValueError("Old (version 1) edr files are not supported")
+        if magic != _NAMES_MAGIC:
+            raise ValueError("Energy names magic number mismatch, "
+                            "this is not a GROMACS edr file")
+        file_version, nre = self._unpack('>2i')
+        if file_version > ENX_VERSION:
+            raise ValueError("Reading edr file version {} with version {} "
+                            "implementation".format(file_version, ENX_VERSION))
+        names = []
+        for _ in range(nre):
+            names.append(self._read_string())
+            if file_version >= 2:
+                # Unit
+                self._read_string()
+        return names
+
+    def _read_frame_header(self):
+        first = self._file.read(4)
+        if len(first) == 0:
+            return None
+        if len(first) < 4:
+            raise EOFError("Truncated edr frame")
+        if self._real is None:
+            self._real = self._detect_precision(first)
+        if self._real.itemsize == 8:
+            first += self._read(4)
+
+        magic, file_version = self._unpack('>2i')
+        if magic != _FRAME_MAGIC:
+            raise ValueError("Energy header magic number mismatch, "
+                            "this is not a GROMACS edr file")
+        if file_version > ENX_VERSION:
+            raise ValueError("Reading edr file version {} with version {} "
+                            "implementation".format(file_version, ENX_VERSION))
+        time, _, nsum = self._unpack('>dqi')
+        if file_version >= 3:
+            # nsteps
+            self._unpack('>q')
+        if file_version >= 5:
+            # dt
+            self._unpack('>d')
+        nre, ndisre, nblock = self._unpack('>3i')
+
+        blocks = []
+        real_type = 2 if self._real.itemsize == 8 else 1
+        if file_version < 4 and ndisre > 0:
+            # Instantaneous and time averaged distance restraints
+            blocks += [(real_type, ndisre), (real_type, ndisre)]
+        for _ in range(nblock):
+            if file_version < 4:
+                # A single subblock of reals
+                nr, = self._unpack('>i')
+                blocks.append((real_type, nr))
+                continue
+            _, nsub = self._unpack('>2i')
+            for _ in range(nsub):
+                blocks.append(self._unpack('>2i'))
+        # e_size, and two reserved ints
+        self._unpack('>3i')
+        return time, nre, nsum, blocks
+
+    def _detect_precision(self, first):
+        if np.isclose(struct.unpack('>f', first)[0], _FIRST_REAL):
+            return np.dtype('>f4')
+        peek = first + self._file.read(4)
+        self._file.seek(4 - len(peek), 1)
+        if (len(peek) == 8 and
+                np.isclose(struct.unpack('>d', peek)[0], _FIRST_REAL)):
+            return np.dtype('>f8')
+        raise ValueError("Energy frame header not recognized, this is not "
+                        "a GROMACS edr file, or a version 1 edr file")
+
+    def _skip_block(self, block_type, count):
+        if block_type < 0 or block_type >= len(_BLOCK_ITEM_SIZE):
+            raise ValueError("Reading unknown block data type: this file "
+                            "is corrupted or from the future")
+        if _BLOCK_ITEM_SIZE[block_type] is None:
+            for _ in range(count):
+                self._read_string()
+        else:
+            self._read(count * _BLOCK_ITEM_SIZE[block_type])
+
+    def _read_string(self):
+        length, = self._unpack('>i')
+        data = self._read(length + (-length % 4))
+        return data[:length].decode('ascii')
+
+    def _unpack(self, fmt):
+        return struct.unpack(fmt, self._read(struct.calcsize(fmt)))
+
+    def _read(self, size):
+        data = self._file.read(size)
+        if len(data) < size:
+            raise EOFError("Truncated edr file")
+        return data
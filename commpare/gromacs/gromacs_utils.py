@@ -1,119 +1,34 @@
+import os
+import shlex
 import shutil
 import tempfile
-import subprocess
 
+import numpy as np
 import pandas as pd
-import panedr
 
-from commpare.utils import temporary_directory, temporary_cd
+from commpare.utils import (temporary_directory, temporary_cd, 
+                            get_frame_coordinates)
+from commpare.runner import run_command
+from commpare.gromacs.edr import EdrReader
+from commpare.gromacs.topology import write_gmx_top
+from commpare.structure_arrays import get_structure_arrays
+from commpare.timing import timed
 
-def build_run_measure_gromacs(structure):
-    with temporary_directory() as tmpdir:
-        with temporary_cd(tmpdir):
-
-            gro_file = 'structure.gro'
-            top_file = 'structure.top'
-
-            structure.save(gro_file, overwrite=True)
-            structure.save(top_file, overwrite=True)
-
-            mdp_file = write_gmx_mdp()
-            grompp, mdrun = detect_gmx_binaries()
-            output = run_grompp(grompp, mdp_file, gro_file, top_file, 
-                    output='out')
-            output = run_mdrun(mdrun, output=output)
-
-            energies  = get_gmx_energy(output + ".edr")
-
-            df = pd.DataFrame.from_dict(energies, orient='index')
-
-            df = df[['bond', 'angle', 'dihedral', 'LJ', 'QQ', 'nonbond', 'all']]
-
-    return df 
-
-def get_gmx_energy(edrfile):
-    """ Parse and canonicalize energies from gromacs edr file 
-    
-    Notes
-    -----
-    gromacs energy units are kJ/mol
-    """
-    gmx_force_groups = {'gromacs': {}}
-    key_to_col = {'bond':['Bond'], 
-            'angle':['Angle'], 
-            'dihedral':['Proper Dih.', 'Ryckaert-Bell.'],
-            'LJ': ['LJ-14', 'LJ (SR)'],
-            'QQ': ['Coulomb-14', 'Coulomb (SR)'],
-            'nonbond':['LJ-14', 'Coulomb-14', 'LJ (SR)', 'Coulomb (SR)'],
-            'all':['Potential']}
-
-    edr_df = panedr.edr_to_df(edrfile) # From the edr
-
-    for canonical_name, df_cols in key_to_col.items():
-        gmx_force_groups['gromacs'][canonical_name] = sum([
-                                    edr_df.iloc[0][col] for col in df_cols
-                                    if col in edr_df.columns])
-
-    return gmx_force_groups
-
-def run_mdrun(mdrun, output='out'):
-    mdrun_cmd = '{mdrun} -deffnm {output}'.format(mdrun=mdrun, output=output)
-    p = subprocess.Popen(mdrun_cmd,
-            shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            universal_newlines=True)
-    out, err = p.communicate()
-    with open('gmx_mdrun.out', 'w') as mdrun_out: 
-        with open('gmx_mdrun.err', 'w') as mdrun_err:
-            mdrun_out.write(out)
-            mdrun_err.write(err)
-            if p.returncode != 0:
-                mdrun_err.write("gmx mdrun command {} failed".format(mdrun_cmd) +
-                ", see gmx_mdrun.err")
-
-    return output
-
-def run_grompp(grompp, mdp_file, gro_file, top_file, output='out'):
-    grompp_cmd = ('{grompp} -f {mdp_file} '.format(grompp=grompp,
-                                                        mdp_file=mdp_file) +
-            '-c {gro_file} -p {top_file} '.format(gro_file=gro_file,
-                                                top_file=top_file) +
-            '-o {output} -maxwarn 5'.format(output=output))
-    p = subprocess.Popen(grompp_cmd,
-            shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            universal_newlines=True)
-    out, err = p.communicate()
-    with open('gmx_grompp.out', 'w') as grompp_out:
-        with open('gmx_grompp.err', 'w') as grompp_err:
-            grompp_out.write(out)
-            grompp_err.write(err)
-            if p.returncode != 0:
-                grompp_err.write("gmx grompp command {} ".format(grompp_cmd) +
-                "failed , see gmx_grommpp.err")
-
-    return output
+# edr energy terms summed into each canonical energy
+GMX_CANONICAL_TERMS = {'bond': ['Bond'],
+        'angle': ['Angle'],
+        'dihedral': ['Proper Dih.', 'Ryckaert-Bell.'],
+        'LJ': ['LJ-14', 'LJ (SR)'],
+        'QQ': ['Coulomb-14', 'Coulomb (SR)'],
+        'nonbond': ['LJ-14', 'Coulomb-14', 'LJ (SR)', 'Coulomb (SR)'],
+        'all': ['Potential']}
+# The only terms read from the edr
+GMX_ENERGY_TERMS = ['Bond', 'Angle', 'Proper Dih.', 'Ryckaert-Bell.',
+        'LJ-14', 'Coulomb-14', 'LJ (SR)', 'Coulomb (SR)', 'Potential']
 
-
-def detect_gmx_binaries():
-    grompp = None
-    mdrun = None
-
-    if shutil.which('gmx'):
-        grompp = 'gmx grompp '
-        mdrun = 'gmx mdrun '
-    elif shutil.which('gmx_d'):
-        grompp = 'gmx_d grompp'
-        mdrun = 'gmx_d mdrun'
-    if grompp is None or mdrun is None:
-        raise ValueError("Error detecting gromacs binaries")
-
-    return grompp, mdrun
-
-def write_gmx_mdp():
-    filename = 'grompp.mdp'
-    with open(filename, 'w') as mdpfile:
-        # Taken from
-        # https://github.com/ctk3b/validate/blob/master/validate/tests/gromacs/grompp.mdp
-        mdpfile.write("""; RUN CONTROL PARAMETERS =
+# Taken from
+# https://github.com/ctk3b/validate/blob/master/validate/tests/gromacs/grompp.mdp
+GMX_MDP = """; RUN CONTROL PARAMETERS =
 integrator               = md
 ; start time and timestep in ps =
 tinit                    = 0
@@ -165,7 +80,264 @@ constraints              = none
 
 ; GENERATE VELOCITIES FOR STARTUP RUN =
 gen_vel                  = no
-continuation             = yes """)
+continuation             = yes """
+
+def build_run_measure_gromacs(structure, input_cache=None, timer=None,
+        **kwargs):
+    """ Build and run a GROMACS simulation from a parmed.Structure
+
+    Parameters
+    ----------
+    structure : parmed.Structure
+    input_cache : commpare.ArtifactCache, optional
+        If provided, the tpr is built once per topology and reused,
+        and the coordinates are evaluated with `mdrun -rerun`
+    timer : commpare.StageTimer, optional
+        Times the 'write_inputs', 'grompp', 'mdrun', and 'parse' stages
+    """
+    if input_cache is not None:
+        df = build_run_measure_gromacs_frames(structure, 
+                    get_structure_arrays(structure).coordinates,
+                    input_cache=input_cache, timer=timer)
+        df.index = ['gromacs']
+        return df
+
+    with temporary_directory() as tmpdir:
+        with temporary_cd(tmpdir):
+
+            gro_file = 'structure.gro'
+            top_file = 'structure.top'
+
+            with timed(timer, 'write_inputs'):
+                structure.save(gro_file, overwrite=True)
+                write_gmx_top(structure, top_file)
+                mdp_file = write_gmx_mdp()
+
+            grompp, mdrun = detect_gmx_binaries()
+            with timed(timer, 'grompp'):
+                output = run_grompp(grompp, mdp_file, gro_file, top_file, 
+                        output='out')
+            with timed(timer, 'mdrun'):
+                output = run_mdrun(mdrun, output=output)
+
+            with timed(timer, 'parse'):
+                energies  = get_gmx_energy(output + ".edr")
+
+            df = pd.DataFrame.from_dict(energies, orient='index')
+
+            df = df[['bond', 'angle', 'dihedral', 'LJ', 'QQ', 'nonbond', 'all']]
+
+    return df 
+
+def build_run_measure_gromacs_frames(structure, frames, input_cache=None,
+        timer=None):
+    """ Measure GROMACS energies for many frames of one topology
+
+    The topology is written and grompp is run once, then a single
+    `mdrun -rerun` evaluates every frame from a TRR trajectory
+
+    Parameters
+    ----------
+    structure : parmed.Structure
+        Topology and parameters shared by every frame
+    frames : array-like or mdtraj.Trajectory
+        Coordinates of shape (n_frames, n_atoms, 3) in Angstrom,
+        or an mdtraj.Trajectory
+    input_cache : commpare.ArtifactCache, optional
+        Reuse the tpr of a previously seen topology instead of 
+        writing the topology and running grompp
+    timer : commpare.StageTimer, optional
+        Times the 'write_inputs', 'grompp', 'mdrun', and 'parse' stages
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Indexed by frame with canonicalized energy columns
+    """
+    xyz, boxes = get_frame_coordinates(frames)
+    if xyz.shape[1] != len(structure.atoms):
+        raise ValueError("Frames have {} atoms, structure has {}".format(
+                            xyz.shape[1], len(structure.atoms)))
+    if boxes is None and structure.box is None:
+        boxes = _default_gmx_boxes(xyz)
+    elif boxes is None:
+        boxes = np.tile(np.asarray(structure.box, dtype=float), 
+                        (xyz.shape[0], 1))
+
+    with temporary_directory() as tmpdir:
+        with temporary_cd(tmpdir):
+
+            trr_file = 'frames.trr'
+            with timed(timer, 'write_inputs'):
+                write_gmx_trr(trr_file, xyz, boxes)
+
+            grompp, mdrun = detect_gmx_binaries()
+            output = prepare_gmx_tpr(structure, grompp, 
+                    input_cache=input_cache, output='out', timer=timer)
+            with timed(timer, 'mdrun'):
+                output = run_mdrun(mdrun, output=output, rerun=trr_file)
+
+            with timed(timer, 'parse'):
+                energies = get_gmx_energy(output + ".edr", all_frames=True)
+
+            df = pd.DataFrame.from_dict(energies, orient='index')
+
+            df = df[['bond', 'angle', 'dihedral', 'LJ', 'QQ', 'nonbond', 'all']]
+            df.index.name = 'frame'
+
+    return df
+
+def prepare_gmx_tpr(structure, grompp, input_cache=None, output='out',
+        timer=None):
+    """ Write the topology and run grompp, or reuse a cached tpr
+
+    The tpr is written to `output`.tpr in the current directory.
+    Cached tprs are keyed by the structure's topology and box, the mdp,
+    and the grompp binary, so the coordinates they contain are stale and
+    they are only meant for `mdrun -rerun`. The box is part of the key
+    because grompp fixes the PME grid from it.
+    `timer` times the 'write_inputs' and 'grompp' stages
+
+    Returns
+    -------
+    output : str
+        Output name to pass to `run_mdrun`
+    """
+    if input_cache is not None:
+        key = _tpr_key(input_cache, structure, grompp)
+        cached_tpr = input_cache.path('gromacs', key, 'topol.tpr')
+        if os.path.exists(cached_tpr):
+            shutil.copyfile(cached_tpr, output + '.tpr')
+            return output
+
+    gro_file = 'structure.gro'
+    top_file = 'structure.top'
+
+    with timed(timer, 'write_inputs'):
+        structure.save(gro_file, overwrite=True)
+        write_gmx_top(structure, top_file)
+        mdp_file = write_gmx_mdp()
+    with timed(timer, 'grompp'):
+        output = run_grompp(grompp, mdp_file, gro_file, top_file, 
+                output=output)
+
+    if input_cache is not None and os.path.exists(output + '.tpr'):
+        input_cache.store('gromacs', key, 'topol.tpr', output + '.tpr')
+
+    return output
+
+def _tpr_key(input_cache, structure, grompp):
+    box = None
+    if structure.box is not None:
+        box = [round(float(value), 6) for value in structure.box]
+    return input_cache.key(structure, GMX_MDP, grompp, box)
+
+def _default_gmx_boxes(xyz):
+    # Box parmed writes to a gro without a box: the extent of the
+    # coordinates plus 5 Angstrom, rectangular
+    lengths = xyz.max(axis=1) - xyz.min(axis=1) + 5
+    angles = np.full_like(lengths, 90.0)
+    return np.hstack([lengths, angles])
+
+def write_gmx_trr(filename, xyz, boxes):
+    """ Write frames to a TRR trajectory for `mdrun -rerun`
+
+    Parameters
+    ----------
+    filename : str
+    xyz : np.ndarray, shape (n_frames, n_atoms, 3)
+        Coordinates in Angstrom
+    boxes : np.ndarray, shape (n_frames, 6)
+        Box lengths (Angstrom) and angles (degrees)
+    """
+    import mdtraj
+    box_vectors = np.stack(mdtraj.utils.lengths_and_angles_to_box_vectors(
+                            *(boxes / [10, 10, 10, 1, 1, 1]).T), axis=1)
+    with mdtraj.formats.TRRTrajectoryFile(filename, 'w') as trr:
+        trr.write(xyz / 10, time=np.arange(len(xyz), dtype=np.float32),
+                step=np.arange(len(xyz), dtype=np.int32), box=box_vectors)
 
     return filename
 
+def get_gmx_energy(edrfile, all_frames=False):
+    """ Parse and canonicalize energies from gromacs edr file 
+
+    Parameters
+    ----------
+    edrfile : str
+    all_frames : bool
+        If False, only the first frame is returned, keyed by 'gromacs'.
+        If True, every frame is returned, keyed by frame number
+    
+    Notes
+    -----
+    gromacs energy units are kJ/mol.
+    Only `GMX_ENERGY_TERMS` are decoded, one frame at a time
+    """
+    with EdrReader(edrfile, terms=GMX_ENERGY_TERMS) as reader:
+        # Sum the edr terms of each canonical group
+        groups = {canonical_name: [reader.terms.index(term) for term in terms
+                                    if term in reader.terms]
+                for canonical_name, terms in GMX_CANONICAL_TERMS.items()}
+        def canonicalize(energies):
+            return {canonical_name: float(energies[idx].sum())
+                    for canonical_name, idx in groups.items()}
+
+        if not all_frames:
+            frame = reader.read_frame()
+            return {'gromacs': canonicalize(frame[1])}
+        return {i: canonicalize(energies)
+                for i, (_, energies) in enumerate(reader)}
+
+def run_mdrun(mdrun, output='out', rerun=None, timeout=None):
+    """ Run mdrun on `output`.tpr, logging to gmx_mdrun.out/err
+
+    Raises
+    ------
+    commpare.runner.EngineCommandError
+        If mdrun fails or takes longer than `timeout` seconds
+    """
+    mdrun_cmd = shlex.split(mdrun) + ['-deffnm', output]
+    if rerun is not None:
+        mdrun_cmd += ['-rerun', rerun]
+    run_command(mdrun_cmd, timeout=timeout, log_prefix='gmx_mdrun').check()
+
+    return output
+
+def run_grompp(grompp, mdp_file, gro_file, top_file, output='out',
+        timeout=None):
+    """ Run grompp to write `output`.tpr, logging to gmx_grompp.out/err
+
+    Raises
+    ------
+    commpare.runner.EngineCommandError
+        If grompp fails or takes longer than `timeout` seconds
+    """
+    grompp_cmd = shlex.split(grompp) + ['-f', mdp_file, '-c', gro_file,
+            '-p', top_file, '-o', output, '-maxwarn', '5']
+    run_command(grompp_cmd, timeout=timeout, log_prefix='gmx_grompp').check()
+
+    return output
+
+
+def detect_gmx_binaries():
+    grompp = None
+    mdrun = None
+
+    if shutil.which('gmx'):
+        grompp = 'gmx grompp '
+        mdrun = 'gmx mdrun '
+    elif shutil.which('gmx_d'):
+        grompp = 'gmx_d grompp'
+        mdrun = 'gmx_d mdrun'
+    if grompp is None or mdrun is None:
+        raise ValueError("Error detecting gromacs binaries")
+
+    return grompp, mdrun
+
+def write_gmx_mdp():
+    filename = 'grompp.mdp'
+    with open(filename, 'w') as mdpfile:
+        mdpfile.write(GMX_MDP)
+
+    return filename
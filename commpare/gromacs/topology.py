@@ -0,0 +1,36 @@
+import numpy as np
+from parmed.gromacs import GromacsTopologyFile
+
+from commpare.structure_arrays import unique_molecules
+
+# Compact GROMACS topologies, with one moleculetype per unique molecule
+# and a [ molecules ] count, so that topology size and grompp time
+# follow the number of distinct molecules rather than the number of atoms
+
+def write_gmx_top(structure, filename):
+    """ Write a GROMACS topology, each unique molecule written once
+
+    Parameters
+    ----------
+    structure : parmed.Structure
+    filename : str
+    """
+    top = CompactGromacsTopologyFile.from_structure(structure)
+    top.write(filename)
+    return filename
+
+
+class CompactGromacsTopologyFile(GromacsTopologyFile):
+    """ GromacsTopologyFile that finds repeated molecules with
+    `unique_molecules`, instead of comparing molecules atom by atom.
+    Falls back to parmed's `split` for structures it does not handle """
+    def split(self):
+        molecules = unique_molecules(self)
+        if molecules is None:
+            return super(CompactGromacsTopologyFile, self).split()
+        split = []
+        for atoms, copies in molecules:
+            selection = np.zeros(len(self.atoms), dtype=bool)
+            selection[atoms] = True
+            split.append((self[selection.tolist()], set(copies)))
+        return split
@@ -2,33 +2,109 @@ import warnings
 import pandas as pd
 
 from mbuild.formats.hoomd_simulation import create_hoomd_simulation
+from mbuild.utils.geometry import coord_shift
 import hoomd
 import hoomd.md
 
+from commpare.structure_arrays import get_structure_arrays
+from commpare.timing import timed
 
-def build_run_measure_hoomd(structure, **kwargs):
-    """ Build and run a HOOMD simulation from a parmed.Structure """
+
+def build_run_measure_hoomd(structure, input_cache=None, timer=None,
+        **kwargs):
+    """ Build and run a HOOMD simulation from a parmed.Structure 
+    
+    Parameters
+    ----------
+    structure : parmed.Structure
+    input_cache : commpare.ArtifactCache, optional
+        Reuse the initialized simulation (snapshot and force setup)
+        of a previously seen topology and box, only updating positions
+    timer : commpare.StageTimer, optional
+        Times the 'create_simulation', 'compute_forces', and
+        'energies' stages
+    **kwargs
+        Passed to `create_hoomd_simulation`
+    """
     hoomd.util.quiet_status()
-    hoomd.context.initialize("--msg-file=hoomd.out")
-    create_hoomd_simulation(structure, **kwargs)
+    sim_context, all_group = prepare_hoomd_simulation(structure, 
+            input_cache=input_cache, timer=timer, **kwargs)
 
-    all_group = hoomd.group.all()
-    # Arbitrary small simulation
-    hoomd.md.integrate.mode_standard(dt=0.00001)
-    hoomd.md.integrate.nve(all_group, limit=0.001)
-    hoomd.run(1)
-
-    hoomd_force_groups = get_hoomd_force_groups()
-    energies = {'hoomd': {key: get_hoomd_energy(key, 
-                                                hoomd_force_groups, 
-                                                all_group) 
-                                                for key in hoomd_force_groups}}
+    with sim_context, timed(timer, 'energies'):
+        hoomd_force_groups = get_hoomd_force_groups()
+        energies = {'hoomd': get_hoomd_energies(hoomd_force_groups, 
+                                                all_group)}
     df = pd.DataFrame.from_dict(energies, orient='index')
 
     df = df[['bond', 'angle', 'dihedral', 'LJ', 'QQ', 'nonbond', 'all']]
 
     return df
 
+def prepare_hoomd_simulation(structure, input_cache=None, timer=None,
+        **kwargs):
+    """ Initialize a HOOMD simulation, or reuse one for a known topology
+
+    On return, forces have been evaluated at the structure's coordinates.
+    No integration step is taken.
+    `timer` times the 'create_simulation' and 'compute_forces' stages
+
+    Returns
+    -------
+    sim_context : hoomd.context.SimulationContext
+    all_group : hoomd.group
+    """
+    key = None
+    if input_cache is not None:
+        box = None if structure.box is None else list(structure.box)
+        key = input_cache.key(structure, box, kwargs)
+        cached = input_cache.recall('hoomd', key)
+        if cached is not None:
+            sim_context, system, snapshot, ref_values, all_group = cached
+            arrays = get_structure_arrays(structure)
+            xyz = arrays.coordinates.copy()
+            # Shifted as in `create_hoomd_simulation`
+            if kwargs.get('shift_coords', True) and arrays.box is not None:
+                xyz = coord_shift(xyz, arrays.box[:3])
+            snapshot.particles.position[:] = xyz / ref_values.distance
+            with sim_context, timed(timer, 'compute_forces'):
+                system.restore_snapshot(snapshot)
+                recompute_hoomd_forces()
+            return sim_context, all_group
+
+    with timed(timer, 'create_simulation'):
+        sim_context = hoomd.context.initialize("--msg-file=hoomd.out")
+        hoomd_objects, ref_values = create_hoomd_simulation(structure, 
+                                                            **kwargs)
+
+    all_group = hoomd.group.all()
+    # The integrator is never stepped, but hoomd.run needs one to
+    # push force coefficients and compute the initial forces
+    with timed(timer, 'compute_forces'):
+        hoomd.md.integrate.mode_standard(dt=0.00001)
+        hoomd.md.integrate.nve(all_group, limit=0.001)
+        hoomd.run(0)
+
+    if key is not None:
+        system = hoomd.data.system_data(sim_context.system_definition)
+        snapshot = system.take_snapshot()
+        input_cache.remember('hoomd', key, 
+                (sim_context, system, snapshot, ref_values, all_group))
+
+    return sim_context, all_group
+
+def recompute_hoomd_forces():
+    """ Re-evaluate every force at the current timestep
+
+    HOOMD only recomputes forces when the timestep advances, so after
+    positions are changed in place (e.g. by restoring a snapshot),
+    neighbor lists and forces are forced to update without a run
+    """
+    timestep = hoomd.get_step()
+    for nlist in hoomd.context.current.neighbor_lists:
+        nlist.cpp_nlist.forceUpdate()
+    for force in hoomd.context.current.forces:
+        force.cpp_force.forceCompute(timestep)
+
 def get_hoomd_force_groups():
     """ Get various hoomd force objects 
     
@@ -67,6 +143,25 @@ def get_hoomd_force_groups():
 
     return hoomd_force_groups
 
+def get_hoomd_energies(hoomd_force_groups, calc_group):
+    """ Calculate energies of all force groups, querying each force once
+
+    Parameters
+    ---------
+    hoomd_force_groups : dictionary 
+        str : list of Hoomd forces
+    calc_group : hoomd.group
+    
+    Returns
+    -------
+    energies : dictionary
+        str : float, summed over the forces in each group
+    """
+    force_energies = {force: force.get_energy(calc_group)
+                        for force in hoomd_force_groups['all']}
+    return {key: sum(force_energies[force] for force in forces)
+            for key, forces in hoomd_force_groups.items()}
+
 def get_hoomd_energy(key, hoomd_force_groups, calc_group):
     """ Calculate energy for a list of hoomd forces 
     
@@ -1,8 +1,49 @@
 import shutil
+import functools
 import importlib
+import importlib.metadata
+import importlib.util
+import subprocess
+
+# Entry point group of third-party engines. Each entry point names a
+# callable `build_run_measure(structure, input_cache=None, **kwargs)`
+# returning a DataFrame of canonical energies indexed by the engine name
+ENGINE_ENTRY_POINT_GROUP = 'commpare.engines'
+
+# Built-in engines, imported on first use
+BUILTIN_ENGINES = {
+    'gromacs': 'commpare.gromacs:build_run_measure_gromacs',
+    'openmm': 'commpare.openmm:build_run_measure_openmm',
+    'hoomd': 'commpare.hoomd:build_run_measure_hoomd',
+    'cassandra': 'commpare.cassandra:build_run_measure_cassandra',
+    'numpy': 'commpare.reference:build_run_measure_numpy',
+}
+
+# Modules every built-in engine relies on to read a parmed.Structure
+# and canonicalize its energies
+SHARED_ENGINE_MODULES = ['commpare.structure_arrays', 'commpare.utils',
+                        'commpare.conversion']
+
+CASSANDRA_EXEC_NAMES = ['cassandra.exe',
+                        'cassandra_gfortran.exe',
+                        'cassandra_pgfortran.exe',
+                        'cassandra_gfortran_openMP.exe',
+                        'cassandra_pgfortran_openMP.exe',
+                        'cassandra_intel_openMP.exe']
+
+_registered_engines = {}
 
 #### Identify the local MD engines available to test against
 def identify_engines():
+    """ Names of the engines available in this environment
+
+    Detection only looks up module specs and binaries on the PATH,
+    nothing is imported. The result is cached for the process
+    """
+    return list(_identify_engines())
+
+@functools.lru_cache(maxsize=None)
+def _identify_engines():
     engines = []
     if detect_gromacs():
         engines.append('gromacs')
@@ -16,43 +57,47 @@ def identify_engines():
         engines.append("desmond")
     if detect_cassandra():
         engines.append("cassandra")
+    if detect_numpy():
+        engines.append("numpy")
+    for name, entry_point in _engine_entry_points().items():
+        if name not in engines and module_available(
+                entry_point.value.split(':')[0]):
+            engines.append(name)
+
+    return tuple(engines)
 
-    return engines
+@functools.lru_cache(maxsize=None)
+def module_available(name):
+    """ Whether a module can be imported, without importing it
+
+    Only the top-level package is looked up
+    """
+    name = name.split('.')[0]
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+@functools.lru_cache(maxsize=None)
+def binary_available(*names):
+    """ Whether any of the executables is on the PATH """
+    return any(shutil.which(name) for name in names)
 
 def detect_gromacs():
-    if shutil.which('gmx'):
-        return True
-    if shutil.which('gmx_d'):
-        return True
-    return False
+    return binary_available('gmx', 'gmx_d')
 
 def detect_openmm():
-    try: 
-        importlib.import_module('simtk')
-        return True
-    except ModuleNotFoundError:
-        return False
+    return module_available('simtk')
 
 def detect_hoomd():
-    try:
-        importlib.import_module('hoomd')
-        return True
-    except ModuleNotFoundError:
-        return False
+    return module_available('hoomd')
 
 def detect_cassandra():
-    cassandra_exec_names = [ 'cassandra.exe',
-                             'cassandra_gfortran.exe',
-                             'cassandra_pgfortran.exe',
-                             'cassandra_gfortran_openMP.exe',
-                             'cassandra_pgfortran_openMP.exe',
-                             'cassandra_intel_openMP.exe' ]
+    return binary_available(*CASSANDRA_EXEC_NAMES)
 
-    for name in cassandra_exec_names:
-        if shutil.which(name):
-            return True
-
-    return False
+def detect_numpy():
+    # Built-in reference engine, only needs numpy
+    return module_available('numpy')
 
 def detect_amber():
     # Not a supported engine
@@ -62,3 +107,132 @@ def detect_desmond():
     # Not a supported engine
     return False
 
+def register_engine(name, build_run_measure):
+    """ Register an engine for `spawn_engine_simulations`
+
+    Parameters
+    ----------
+    name : str
+    build_run_measure : callable or str
+        `build_run_measure(structure, input_cache=None, **kwargs)`,
+        returning a DataFrame of canonical energies indexed by `name`.
+        A 'module:function' str is imported on first use
+
+    Notes
+    -----
+    Registrations are per process. With `parallel=True`, engines run in
+    fresh worker processes, so register the engine in an imported
+    module or as an `ENGINE_ENTRY_POINT_GROUP` entry point instead
+    """
+    _registered_engines[name] = build_run_measure
+    get_engine.cache_clear()
+    get_engine_source_hash.cache_clear()
+
+@functools.lru_cache(maxsize=None)
+def get_engine(name):
+    """ The build_run_measure callable of an engine, imported on first use
+
+    Engines registered with `register_engine` take precedence over
+    `ENGINE_ENTRY_POINT_GROUP` entry points, then `BUILTIN_ENGINES`
+
+    Returns
+    -------
+    build_run_measure : callable or None
+        None if no engine of this name is known
+    """
+    if name in _registered_engines:
+        engine = _registered_engines[name]
+    elif name in _engine_entry_points():
+        return _engine_entry_points()[name].load()
+    elif name in BUILTIN_ENGINES:
+        engine = BUILTIN_ENGINES[name]
+    else:
+        return None
+    if isinstance(engine, str):
+        module, _, attr = engine.partition(':')
+        engine = getattr(importlib.import_module(module), attr)
+    return engine
+
+@functools.lru_cache(maxsize=None)
+def _engine_entry_points():
+    entry_points = importlib.metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=ENGINE_ENTRY_POINT_GROUP)
+    else:
+        entry_points = entry_points.get(ENGINE_ENTRY_POINT_GROUP, [])
+    return {entry_point.name: entry_point for entry_point in entry_points}
+
+@functools.lru_cache(maxsize=None)
+def get_engine_version(engine):
+    """ Version string of an MM engine, empty if it cannot be determined
+
+    Used to key cached energies, so results are invalidated
+    when an engine is upgraded
+    """
+    if engine == 'gromacs':
+        for gmx in ['gmx', 'gmx_d']:
+            if shutil.which(gmx):
+                p = subprocess.run([gmx, '--version'],
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                        universal_newlines=True)
+                for line in p.stdout.splitlines():
+                    if 'GROMACS version' in line:
+                        return '{}:{}'.format(gmx, line.split(':')[-1].strip())
+        return ''
+    if engine == 'cassandra':
+        # Cassandra does not report a version, the binary is hashed
+        from commpare.cache import file_hash
+        for name in CASSANDRA_EXEC_NAMES:
+            path = shutil.which(name)
+            if path:
+                return '{}:{}'.format(name, file_hash(path)[:16])
+        return ''
+    if engine == 'numpy':
+        # The built-in reference engine, versioned by its own source
+        # and the libraries it evaluates energies with
+        from commpare.cache import source_hash
+        return 'commpare.reference:{} numpy:{} scipy:{}'.format(
+                source_hash('commpare.reference')[:16],
+                _package_version('numpy'), _package_version('scipy'))
+    packages = {'openmm': ['openmm', 'OpenMM'], 'hoomd': ['hoomd']}
+    for package in packages.get(engine, [engine]):
+        version = _package_version(package)
+        if version:
+            return version
+    modules = {'openmm': 'simtk.openmm.version'}
+    try:
+        module = importlib.import_module(modules.get(engine, engine))
+    except ImportError:
+        return ''
+    return str(getattr(module, 'version', getattr(module, '__version__', '')))
+
+def _package_version(package):
+    try:
+        return importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
+        return ''
+
+@functools.lru_cache(maxsize=None)
+def get_engine_source_hash(engine):
+    """ Hash of the commpare source implementing an engine
+
+    For built-in engines, the engine's package and
+    `SHARED_ENGINE_MODULES`. For other engines, the module defining
+    `build_run_measure`. Empty if the source cannot be found
+
+    Used to key cached energies, so results are invalidated
+    when the code producing them changes
+    """
+    from commpare.cache import source_hash
+    if engine in _registered_engines:
+        engine_spec = _registered_engines[engine]
+        if not isinstance(engine_spec, str):
+            engine_spec = getattr(engine_spec, '__module__', None) or ''
+        return source_hash(engine_spec.partition(':')[0])
+    if engine in _engine_entry_points():
+        return source_hash(
+                _engine_entry_points()[engine].value.partition(':')[0])
+    if engine in BUILTIN_ENGINES:
+        return source_hash(BUILTIN_ENGINES[engine].partition(':')[0],
+                            *SHARED_ENGINE_MODULES)
+    return ''
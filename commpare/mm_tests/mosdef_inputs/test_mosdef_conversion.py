@@ -49,20 +49,9 @@ class TestMosdefConversion(BaseTest):
             reason="foyer package not installed")
     @pytest.mark.parametrize("smiles", load_smiles())
     def test_oplsaa(self, smiles):
-        import foyer
-        import mbuild as mb
         # These tests are smiles strings 
-        cmpd = mb.load(smiles, smiles=True) 
-        ff = commpare.identify_forcefields()['OPLSAA']
-        structure = ff.apply(cmpd)
-        # Enlarge box to avoid cutoff issues
-        bbox = cmpd.boundingbox
-        bbox.lengths *= 10
-        if any(bbox.lengths < 10):
-            bbox.lengths = [100, 100, 100]
-
-        structure.box = [bbox.lengths[0], bbox.lengths[1], bbox.lengths[2],
-                            90, 90, 90]
+        structure = commpare.parametrize_smiles(smiles, 'OPLSAA',
+                cache=True)
         energies = commpare.spawn_engine_simulations(structure,
                 hoomd_kwargs={'ref_distance':10, 'ref_energy':1/4.184})
         print(smiles)
@@ -74,20 +63,9 @@ class TestMosdefConversion(BaseTest):
             reason="foyer or gaff package not installed")
     @pytest.mark.parametrize("smiles", load_smiles())
     def test_gaff(self, smiles):
-        import foyer
-        import mbuild as mb
         # These tests are smiles strings 
-        cmpd = mb.load(smiles, smiles=True) 
-        ff = commpare.identify_forcefields()['GAFF'] 
-        structure = ff.apply(cmpd)
-        # Enlarge box to avoid cutoff issues
-        bbox = cmpd.boundingbox
-        bbox.lengths *= 10
-        if any(bbox.lengths < 10):
-            bbox.lengths = [100, 100, 100]
-
-        structure.box = [bbox.lengths[0], bbox.lengths[1], bbox.lengths[2],
-                            90, 90, 90]
+        structure = commpare.parametrize_smiles(smiles, 'GAFF',
+                cache=True)
         energies = commpare.spawn_engine_simulations(structure,
                 hoomd_kwargs={'ref_distance':10, 'ref_energy':1/4.184})
         print(smiles)
@@ -103,23 +81,29 @@ class TestMosdefConversion(BaseTest):
         from mbuild.examples import (Alkane, Methane, Ethane, 
                 PMPCLayer, AlkaneMonolayer)
         import foyer
-        for i in range(4,20):
-            my_alkane = Alkane(n=i)
-            ff = foyer.Forcefield(name='oplsaa')
-            structure = ff.apply(my_alkane)
-            bbox = my_alkane.boundingbox
-            bbox.lengths *= 10
-            if any(bbox.lengths < 10):
-                bbox.lengths = [100, 100, 100]
-
-            structure.box = [bbox.lengths[0], bbox.lengths[1], bbox.lengths[2],
-                                90, 90, 90]
-            structure.combining_rule = 'lorentz'
-            energies = commpare.spawn_engine_simulations(structure,
+        ff = foyer.Forcefield(name='oplsaa')
+        def alkanes():
+            for i in range(4,20):
+                my_alkane = Alkane(n=i)
+                structure = ff.apply(my_alkane)
+                bbox = my_alkane.boundingbox
+                bbox.lengths *= 10
+                if any(bbox.lengths < 10):
+                    bbox.lengths = [100, 100, 100]
+
+                structure.box = [bbox.lengths[0], bbox.lengths[1], 
+                                    bbox.lengths[2], 90, 90, 90]
+                structure.combining_rule = 'lorentz'
+                yield 'Alkane, n={}'.format(i), structure
+
+        records = commpare.spawn_engine_simulations_batch(alkanes(),
                     hoomd_kwargs={'ref_distance':10, 'ref_energy':1/4.184})
-            print('Alkane, n={}'.format(i))
-            print(energies)
-            print('='*20)
+        energies = commpare.collect_energies(records)
+        print(energies)
+        deviations = commpare.compare_energies(energies)
+        print(commpare.summarize_deviations(deviations))
+        print(commpare.worst_offenders(deviations))
+        print('='*20)
 
         eth = Ethane()
         structure = ff.apply(eth)
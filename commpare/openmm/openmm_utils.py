@@ -1,85 +1,301 @@
+import os
+import copy
+import time
 import warnings
 import pandas as pd
+import parmed
 import simtk.openmm as openmm
 import simtk.unit as unit
 
+from commpare.utils import get_frame_coordinates
+from commpare.structure_arrays import get_structure_arrays
+from commpare.timing import timed
+from commpare.cache import atomic_path
+
+# Nonbonded cutoff (nm), matching rvdw/rcoulomb of the gromacs mdp
+OMM_NONBONDED_CUTOFF = 2
+
+# Force groups of the split nonbonded forces, and of any force
+# that does not map onto a canonical energy term
+OMM_LJ_GROUP = 13
+OMM_QQ_GROUP = 14
+OMM_OTHER_GROUP = 31
+
+# Platforms considered by `select_omm_platform`
+OMM_AUTO_PLATFORMS = ['Reference', 'CPU', 'CUDA', 'OpenCL']
+_omm_auto_platforms = {}
+
 # After having written this, it looks like ParmEd already
 # did something similar for OpenMM energy decompositions
-def build_run_measure_openmm(structure, **kwargs):
-    """ Build OpenMM simulation from a parmed.Structure """
-    omm_system = structure.createSystem()
+def build_run_measure_openmm(structure, input_cache=None, platform=None,
+        platform_properties=None, timer=None, **kwargs):
+    """ Build OpenMM simulation from a parmed.Structure 
+    
+    Parameters
+    ----------
+    structure : parmed.Structure
+    input_cache : commpare.ArtifactCache, optional
+        Reuse the serialized System of a previously seen topology
+    platform : str, optional
+        OpenMM platform name, e.g. 'Reference', 'CPU', 'CUDA'.
+        'auto' picks the fastest platform for the system size, see 
+        `select_omm_platform`. Defaults to OpenMM's own choice
+    platform_properties : dict, optional
+        Platform properties, e.g. {'Threads': 2} for the CPU platform
+        or {'Precision': 'double'} for CUDA and OpenCL
+    timer : commpare.StageTimer, optional
+        Times the 'create_system', 'create_context', and 'energies' stages
+    """
+    with timed(timer, 'create_system'):
+        omm_system = create_omm_system(structure, input_cache=input_cache)
 
-    integrator = openmm.VerletIntegrator(1.0)
-    omm_context = openmm.Context(omm_system, integrator)
-    omm_context.setPositions(structure.positions)
-
-    set_omm_force_groups(omm_context)
-    omm_force_groups = get_omm_force_groups(omm_context)
-
-    # To decompose OpenMM's nonbonded force into LJ, QQ, and total energies
-    # This requires updating the particle parameters to "zero out"
-    # charges to get the LJ energy. 
-    # The QQ energy is then the total nonbond energy minus LJ energy
-    energies_total = {'openmm': {key: get_omm_energy(key, 
-                                                omm_force_groups, 
-                                                omm_context)._value
-                                                for key in omm_force_groups}}
-
-    original_particle_parameters = zero_out_qq(omm_system, omm_context, 
-            original_particle_parameters=None)
-    energies_lj = {'openmm': {key: get_omm_energy(key, 
-                                                omm_force_groups, 
-                                                omm_context)._value
-                                                for key in omm_force_groups}}
-
-    energies_total['openmm']['LJ'] = energies_lj['openmm']['nonbond']
-    energies_total['openmm']['QQ'] = (energies_total['openmm']['nonbond'] - 
-            energies_total['openmm']['LJ'])
-    df = pd.DataFrame.from_dict(energies_total, orient='index')
+    positions = get_structure_arrays(structure).coordinates * unit.angstrom
+    with timed(timer, 'create_context'):
+        omm_context = create_omm_context(omm_system, positions,
+                platform=platform, platform_properties=platform_properties)
+
+    with timed(timer, 'energies'):
+        omm_force_groups = get_omm_force_groups(omm_system)
+        energies = {'openmm': get_omm_energies(omm_force_groups, 
+                                                omm_context)}
+    df = pd.DataFrame.from_dict(energies, orient='index')
+    df = df[['bond', 'angle', 'dihedral', 'LJ', 'QQ', 'nonbond', 'all']]
+
+    return df
+
+def build_run_measure_openmm_frames(structure, frames, input_cache=None,
+        platform=None, platform_properties=None, timer=None, **kwargs):
+    """ Measure OpenMM energies for many frames of one topology
+
+    The System and Context are built once, and only the positions 
+    (and box, if provided) change between frames
+
+    Parameters
+    ----------
+    structure : parmed.Structure
+        Topology and parameters shared by every frame
+    frames : array-like or mdtraj.Trajectory
+        Coordinates of shape (n_frames, n_atoms, 3) in Angstrom,
+        or an mdtraj.Trajectory
+    input_cache : commpare.ArtifactCache, optional
+        Reuse the serialized System of a previously seen topology
+    platform, platform_properties, timer : 
+        See `build_run_measure_openmm`
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Indexed by frame with canonicalized energy columns
+    """
+    xyz, boxes = get_frame_coordinates(frames)
+    if xyz.shape[1] != len(structure.atoms):
+        raise ValueError("Frames have {} atoms, structure has {}".format(
+                            xyz.shape[1], len(structure.atoms)))
+
+    with timed(timer, 'create_system'):
+        omm_system = create_omm_system(structure, input_cache=input_cache)
+    with timed(timer, 'create_context'):
+        omm_context = create_omm_context(omm_system, xyz[0] * unit.angstrom,
+                platform=platform, platform_properties=platform_properties)
+
+    energies = {}
+    with timed(timer, 'energies'):
+        omm_force_groups = get_omm_force_groups(omm_system)
+        for frame, positions in enumerate(xyz):
+            if boxes is not None:
+                omm_context.setPeriodicBoxVectors(
+                    *parmed.geometry.box_lengths_and_angles_to_vectors(
+                        *boxes[frame]))
+            omm_context.setPositions(positions * unit.angstrom)
+            energies[frame] = get_omm_energies(omm_force_groups, omm_context)
+    df = pd.DataFrame.from_dict(energies, orient='index')
     df = df[['bond', 'angle', 'dihedral', 'LJ', 'QQ', 'nonbond', 'all']]
+    df.index.name = 'frame'
 
     return df
 
-def zero_out_qq(omm_system, omm_context,
-        original_particle_parameters=None):
-    """ For all OpenMM particle parameters, set charge to 0 """
-    build_original_pparams = False
-    if original_particle_parameters is None:
-        original_particle_parameters = []
-        build_original_pparams = True
-    for force in omm_context.getSystem().getForces():
-        if isinstance(force, openmm.NonbondedForce):
-            for i in range(force.getNumParticles()):
-                if build_original_pparams:
-                    original_particle_parameters.append(
-                            force.getParticleParameters(i))
-                force.setParticleParameters(i,
-                        0.0,
-                        original_particle_parameters[i][1],
-                        original_particle_parameters[i][2])
-            force.updateParametersInContext(omm_context)
-
-    return original_particle_parameters
-
-def get_omm_energy(key, omm_force_groups, omm_context):
-    """ Calculate energy for a set of openmm force groups 
+def create_omm_system(structure, input_cache=None):
+    """ Create an OpenMM System ready for energy decomposition
+
+    Nonbonded forces are split into LJ and electrostatic forces, and 
+    every force is assigned to its canonical force group. 
+    For known topologies, the prepared System is reused from 
+    `input_cache` as serialized XML, on disk and in memory, 
+    and its periodic box is updated from the structure
+    """
+    if input_cache is None:
+        omm_system = structure.createSystem()
+        set_omm_force_groups(omm_system)
+        return omm_system
+
+    key = input_cache.key(structure, OMM_NONBONDED_CUTOFF)
+    xml = input_cache.recall('openmm', key)
+    xml_file = input_cache.path('openmm', key, 'system.xml')
+    if xml is None and os.path.exists(xml_file):
+        with open(xml_file) as f:
+            xml = f.read()
+    if xml is None:
+        omm_system = create_omm_system(structure)
+        xml = openmm.XmlSerializer.serialize(omm_system)
+        with atomic_path(xml_file) as tmp_file, open(tmp_file, 'w') as f:
+            f.write(xml)
+    else:
+        omm_system = openmm.XmlSerializer.deserialize(xml)
+        if structure.box_vectors is not None:
+            omm_system.setDefaultPeriodicBoxVectors(*structure.box_vectors)
+    input_cache.remember('openmm', key, xml)
+
+    return omm_system
+
+def create_omm_context(omm_system, positions, platform=None, 
+        platform_properties=None):
+    """ Create an OpenMM Context on a chosen platform
+
+    Parameters
+    ----------
+    omm_system : openmm.System
+    positions : simtk.unit.Quantity
+        Initial positions, also used to benchmark platforms for 'auto'
+    platform : str, optional
+        Platform name, 'auto', or None for OpenMM's default choice
+    platform_properties : dict, optional
+        Platform properties. Values are converted to strings, and
+        properties a platform does not support are dropped
+    """
+    integrator = openmm.VerletIntegrator(1.0)
+    if platform == 'auto':
+        platform = select_omm_platform(omm_system, positions, 
+                platform_properties)
+    if platform is None:
+        omm_context = openmm.Context(omm_system, integrator)
+    else:
+        omm_platform = openmm.Platform.getPlatformByName(platform)
+        properties = _omm_platform_properties(omm_platform, 
+                platform_properties)
+        omm_context = openmm.Context(omm_system, integrator, omm_platform, 
+                properties)
+    omm_context.setPositions(positions)
+
+    return omm_context
+
+def select_omm_platform(omm_system, positions, platform_properties=None):
+    """ Name of the fastest OpenMM platform for this size of system
+
+    The available platforms are benchmarked (context creation plus 
+    one energy evaluation per force group) the first time a system
+    of a given size class is seen with given platform properties.
+    Size classes are powers of two in particle count, and the choice
+    is cached for the process
+    """
+    size_class = max(omm_system.getNumParticles(), 1).bit_length()
+    key = (size_class, frozenset((name, str(value)) for name, value
+            in (platform_properties or {}).items()))
+    if key in _omm_auto_platforms:
+        return _omm_auto_platforms[key]
+
+    groups = set().union(*get_omm_force_groups(omm_system).values())
+    timings = {}
+    for i in range(openmm.Platform.getNumPlatforms()):
+        omm_platform = openmm.Platform.getPlatform(i)
+        if omm_platform.getName() not in OMM_AUTO_PLATFORMS:
+            continue
+        properties = _omm_platform_properties(omm_platform, 
+                platform_properties)
+        try:
+            start = time.perf_counter()
+            omm_context = openmm.Context(omm_system, 
+                    openmm.VerletIntegrator(1.0), omm_platform, properties)
+            omm_context.setPositions(positions)
+            for group in groups:
+                get_omm_energy(group, omm_context)
+            timings[omm_platform.getName()] = time.perf_counter() - start
+            del omm_context
+        except Exception:
+            continue
+
+    platform = min(timings, key=timings.get) if timings else None
+    _omm_auto_platforms[key] = platform
+
+    return platform
+
+def _omm_platform_properties(omm_platform, platform_properties):
+    if not platform_properties:
+        return {}
+    supported = set(omm_platform.getPropertyNames())
+    return {key: str(value) for key, value in platform_properties.items()
+            if key in supported}
+
+def split_omm_nonbonded(omm_system):
+    """ Split each NonbondedForce into separate LJ and QQ forces
+
+    The original force keeps the LJ terms, with particle charges and
+    exception charge products zeroed. A copy keeps the electrostatics,
+    with LJ epsilons (including exceptions) zeroed and no dispersion
+    correction. The sum of the two is the original nonbonded energy.
+    The LJ and QQ forces are put in their own force groups, and forces
+    already in those groups are not split again
+    """
+    for force in list(omm_system.getForces()):
+        if (not isinstance(force, openmm.NonbondedForce) or
+                force.getForceGroup() in (OMM_LJ_GROUP, OMM_QQ_GROUP)):
+            continue
+        qq_force = copy.deepcopy(force)
+        qq_force.setUseDispersionCorrection(False)
+        for i in range(force.getNumParticles()):
+            charge, sigma, epsilon = force.getParticleParameters(i)
+            force.setParticleParameters(i, 0.0, sigma, epsilon)
+            qq_force.setParticleParameters(i, charge, sigma, 0.0)
+        for i in range(force.getNumExceptions()):
+            p1, p2, chargeprod, sigma, epsilon = force.getExceptionParameters(i)
+            force.setExceptionParameters(i, p1, p2, 0.0, sigma, epsilon)
+            qq_force.setExceptionParameters(i, p1, p2, chargeprod, sigma, 0.0)
+        force.setForceGroup(OMM_LJ_GROUP)
+        qq_force.setForceGroup(OMM_QQ_GROUP)
+        omm_system.addForce(qq_force)
+
+    return omm_system
+
+def get_omm_energies(omm_force_groups, omm_context):
+    """ Canonicalized energies from one evaluation per force group
+
+    Parameters
+    ----------
+    omm_force_groups : dict
+        From `get_omm_force_groups`
+    omm_context : openmm.Context
+
+    Returns
+    -------
+    energies : dict
+        Canonical name : energy (kJ/mol)
+    """
+    group_energies = {group: get_omm_energy(group, omm_context)
+            for group in set().union(*omm_force_groups.values())}
+    energies = {key: sum(group_energies[group] for group in groups)
+            for key, groups in omm_force_groups.items()}
+    energies['nonbond'] = energies['LJ'] + energies['QQ']
+    energies['all'] = sum(group_energies.values())
+
+    return energies
+
+def get_omm_energy(group, omm_context):
+    """ Calculate energy (kJ/mol) of a single openmm force group 
     
     Notes
     ----
     Default OpenMM energy units are kJ/mol"""
-    if key == 'all':
-        return (omm_context.getState(getEnergy=True).getPotentialEnergy())
-    if len(omm_force_groups[key]) == 0:
-        return 0 * unit.kilojoule_per_mole
-    return (omm_context.getState(getEnergy=True, groups=omm_force_groups[key])
-                        .getPotentialEnergy())
-
-
-def get_omm_force_groups(omm_context):
-    """ Get force groups associated with the openmm forces """
-    omm_force_groups = {'bond':set(), 'angle':set(), 
-            'dihedral':set(), 'nonbond':set(), 'all':{-1}}
-    for force in omm_context.getSystem().getForces():
+    return (omm_context.getState(getEnergy=True, groups={group})
+                        .getPotentialEnergy()
+                        .value_in_unit(unit.kilojoule_per_mole))
+
+def get_omm_force_groups(omm_system):
+    """ Get force groups associated with the openmm forces 
+    
+    Forces that are not canonicalized are reported under 'other',
+    and only contribute to the 'all' energy"""
+    omm_force_groups = {'bond':set(), 'angle':set(), 'dihedral':set(), 
+            'LJ':set(), 'QQ':set(), 'other':set()}
+    for force in omm_system.getForces():
         if isinstance(force, openmm.HarmonicBondForce):
             omm_force_groups['bond'].add(force.getForceGroup())
         elif isinstance(force, openmm.HarmonicAngleForce):
@@ -89,15 +305,39 @@ def get_omm_force_groups(omm_context):
         elif isinstance(force, openmm.PeriodicTorsionForce):
             omm_force_groups['dihedral'].add(force.getForceGroup())
         elif isinstance(force, openmm.NonbondedForce):
-            omm_force_groups['nonbond'].add(force.getForceGroup())
+            if force.getForceGroup() == OMM_QQ_GROUP:
+                omm_force_groups['QQ'].add(force.getForceGroup())
+            else:
+                omm_force_groups['LJ'].add(force.getForceGroup())
+        elif is_omm_lj_force(force):
+            omm_force_groups['LJ'].add(force.getForceGroup())
         else:
-            warnings.warn("OMM Force {} unrecognized, ignoring".format(force))
+            omm_force_groups['other'].add(force.getForceGroup())
 
     return omm_force_groups
 
-def set_omm_force_groups(omm_context):
-    """ Separate OpenMM forces into separate groups for computation """
-    for force in omm_context.getSystem().getForces():
+def is_omm_lj_force(force):
+    """ Whether a force is one of ParmEd's LJ CustomNonbondedForces
+
+    ParmEd moves the LJ terms out of the NonbondedForce into a
+    CustomNonbondedForce for geometric combining rules (per-particle
+    epsilon and sigma) and for NBFIX (tabulated acoef and bcoef)"""
+    if not isinstance(force, openmm.CustomNonbondedForce):
+        return False
+    parameters = {force.getPerParticleParameterName(i)
+            for i in range(force.getNumPerParticleParameters())}
+    functions = {force.getTabulatedFunctionName(i)
+            for i in range(force.getNumTabulatedFunctions())}
+    return (parameters == {'epsilon', 'sigma'} or
+            {'acoef', 'bcoef'} <= functions)
+
+def set_omm_force_groups(omm_system):
+    """ Separate OpenMM forces into separate groups for computation 
+    
+    Must be called before the Context is created. Nonbonded forces
+    are split into LJ and QQ groups by `split_omm_nonbonded`"""
+    split_omm_nonbonded(omm_system)
+    for force in omm_system.getForces():
         if isinstance(force, openmm.HarmonicBondForce):
             force.setForceGroup(0)
         elif isinstance(force, openmm.HarmonicAngleForce):
@@ -107,8 +347,10 @@ def set_omm_force_groups(omm_context):
         elif isinstance(force, openmm.PeriodicTorsionForce):
             force.setForceGroup(12)
         elif isinstance(force, openmm.NonbondedForce):
-            force.setForceGroup(11)
-            force.setCutoffDistance(2)
+            force.setCutoffDistance(OMM_NONBONDED_CUTOFF)
+        elif is_omm_lj_force(force):
+            force.setForceGroup(OMM_LJ_GROUP)
+            force.setCutoffDistance(OMM_NONBONDED_CUTOFF)
         else:
+            force.setForceGroup(OMM_OTHER_GROUP)
             warnings.warn("OMM Force {} unrecognized, ignoring".format(force))
-
@@ -0,0 +1,3 @@
+from .reference_utils import *
+from .neighbors import *
+from .ewald import *
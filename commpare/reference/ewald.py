@@ -0,0 +1,250 @@
+import math
+import warnings
+import numpy as np
+from scipy.special import erf, erfc
+
+from commpare.reference.neighbors import (NeighborList, box_matrix,
+                                        minimum_image)
+
+# Ewald summation of electrostatics, for attributing QQ discrepancies
+# between engines to the individual Ewald terms
+
+# Coulomb constant (kJ/mol * angstrom / e^2), same value as OpenMM
+COULOMB_CONSTANT = 1389.35456
+
+EWALD_TERMS = ['real', 'reciprocal', 'self', 'exclusion', 'background']
+
+def ewald_alpha(cutoff, ewald_rtol=1e-5):
+    """ Splitting parameter (1/angstrom) such that
+    erfc(alpha * cutoff) = ewald_rtol, as chosen by GROMACS
+    (`ewald_rtol`) and Cassandra (`coul ewald <cutoff> <tolerance>`)
+    """
+    low, high = 0.0, 5.0
+    while erfc(high * cutoff) > ewald_rtol:
+        high *= 2
+    # Bisection, erfc is monotonic
+    for _ in range(100):
+        alpha = 0.5 * (low + high)
+        if erfc(alpha * cutoff) > ewald_rtol:
+            low = alpha
+        else:
+            high = alpha
+    return 0.5 * (low + high)
+
+def pme_grid_size(box, fourier_spacing=1.0, pme_order=4):
+    """ PME grid dimensions with at most `fourier_spacing` (angstrom)
+    between grid points along each box vector, rounded up to
+    FFT-friendly sizes """
+    lengths = np.linalg.norm(box_matrix(box), axis=1)
+    return tuple(_fft_size(max(pme_order, math.ceil(length /
+                                                    fourier_spacing)))
+                for length in lengths)
+
+def ewald_energies(xyz, charges, box, cutoff, exclusions=None,
+        method='pme', ewald_rtol=1e-5, alpha=None, fourier_spacing=1.0,
+        pme_order=4, grid_size=None, kmax=None, neighbor_list=None):
+    """ Ewald electrostatic energy, term by term (kJ/mol)
+
+    Parameters
+    ----------
+    xyz : np.ndarray
+        (n_atoms, 3) coordinates (angstrom)
+    charges : np.ndarray
+        (n_atoms,) charges (e)
+    box : array-like
+        (a, b, c, alpha, beta, gamma)
+    cutoff : float
+        Real space cutoff (angstrom)
+    exclusions : np.ndarray, optional
+        (n_pairs, 2) atom indices whose interaction is removed entirely.
+        Scaled 1-4 pairs belong here too, their scaled Coulomb
+        interaction is added separately by the caller
+    method : str
+        'pme' for smooth particle mesh Ewald, or 'ewald' for a direct
+        reciprocal sum, which scales with n_atoms * kmax^3 and is meant
+        for small systems
+    ewald_rtol : float
+        Relative strength of the real space interaction at the cutoff,
+        determines `alpha`, see `ewald_alpha`
+    alpha : float, optional
+        Splitting parameter (1/angstrom), overrides `ewald_rtol`
+    fourier_spacing : float
+        PME grid spacing (angstrom), like the GROMACS mdp option
+        (which is in nm)
+    pme_order : int
+        B-spline interpolation order
+    grid_size : tuple of int, optional
+        PME grid dimensions, overrides `fourier_spacing`
+    kmax : tuple of int, optional
+        Largest reciprocal vector index along each box vector for
+        method='ewald'. Defaults to a value consistent with `ewald_rtol`
+    neighbor_list : commpare.reference.NeighborList, optional
+        Reused for the real space sum
+
+    Returns
+    -------
+    energies : dict
+        'real', 'reciprocal', 'self', 'exclusion', 'background', and
+        their sum, 'total'. 'exclusion' removes the reciprocal space
+        interaction of excluded pairs, 'background' is the neutralizing
+        plasma correction for a system with net charge
+    """
+    xyz = np.asarray(xyz, dtype=np.float64)
+    charges = np.asarray(charges, dtype=np.float64)
+    if exclusions is None:
+        exclusions = np.zeros((0, 2), dtype=np.int64)
+    exclusions = np.asarray(exclusions, dtype=np.int64).reshape(-1, 2)
+    if alpha is None:
+        alpha = ewald_alpha(cutoff, ewald_rtol)
+    h = box_matrix(box)
+    volume = abs(np.linalg.det(h))
+
+    if neighbor_list is None:
+        neighbor_list = NeighborList(cutoff, skin=0.0, exclusions=exclusions)
+    i, j, r = neighbor_list.get_pairs(xyz, box)
+
+    energies = {}
+    energies['real'] = np.sum(charges[i] * charges[j] * erfc(alpha * r) / r)
+    if method == 'pme':
+        if grid_size is None:
+            grid_size = pme_grid_size(box, fourier_spacing, pme_order)
+        energies['reciprocal'] = pme_reciprocal(xyz, charges, h, alpha,
+                grid_size, pme_order)
+    elif method == 'ewald':
+        if kmax is None:
+            kmax = _ewald_kmax(h, alpha, ewald_rtol)
+        energies['reciprocal'] = ewald_reciprocal(xyz, charges, h, alpha,
+                kmax)
+    else:
+        raise ValueError("Unknown Ewald method {}, "
+                        "use 'pme' or 'ewald'".format(method))
+    energies['self'] = -alpha / np.sqrt(np.pi) * np.sum(charges**2)
+    i, j = exclusions.T
+    r = np.linalg.norm(minimum_image(xyz[j] - xyz[i], h), axis=1)
+    energies['exclusion'] = -np.sum(charges[i] * charges[j] *
+                                    erf(alpha * r) / r)
+    energies['background'] = (-np.pi * np.sum(charges)**2 /
+                                (2 * volume * alpha**2))
+
+    energies = {key: float(COULOMB_CONSTANT * energies[key])
+                for key in EWALD_TERMS}
+    energies['total'] = sum(energies.values())
+    return energies
+
+def ewald_reciprocal(xyz, charges, h, alpha, kmax):
+    """ Reciprocal space energy (e^2/angstrom) from a direct sum over
+    reciprocal vectors m with |m_k| <= kmax[k], m != 0 """
+    recip = np.linalg.inv(h).T
+    fractional = xyz @ np.linalg.inv(h)
+    volume = abs(np.linalg.det(h))
+    m = [np.arange(-k, k + 1) for k in kmax]
+    # Per-dimension phases, exp(2 pi i m_k s_k)
+    phases = [np.exp(2j * np.pi * np.outer(fractional[:, k], m[k]))
+                for k in range(3)]
+
+    energy = 0.0
+    for a, m1 in enumerate(m[0]):
+        # Structure factors of every (m1, m2, m3) in this slab
+        s = np.einsum('n,n,nj,nk->jk', charges, phases[0][:, a],
+                        phases[1], phases[2])
+        m_vec = (m1 * recip[0] + m[1][:, None, None] * recip[1] +
+                m[2][None, :, None] * recip[2])
+        m2 = np.sum(m_vec**2, axis=-1)
+        if m1 == 0:
+            m2[kmax[1], kmax[2]] = np.inf
+        energy += np.sum(np.exp(-np.pi**2 * m2 / alpha**2) / m2 *
+                        np.abs(s)**2)
+    return energy / (2 * np.pi * volume)
+
+def pme_reciprocal(xyz, charges, h, alpha, grid_size, pme_order=4):
+    """ Reciprocal space energy (e^2/angstrom) by smooth particle
+    mesh Ewald (Essmann et al., J. Chem. Phys. 103, 8577 (1995)) """
+    grid_size = np.asarray(grid_size)
+    recip = np.linalg.inv(h).T
+    volume = abs(np.linalg.det(h))
+    fractional = xyz @ np.linalg.inv(h)
+    u = (fractional - np.floor(fractional)) * grid_size
+
+    # Spread charges with B-splines, each atom touches pme_order^3 points
+    base = np.floor(u).astype(int)
+    offsets = np.arange(pme_order)
+    weights = [bspline(u[:, k, None] - base[:, k, None] + offsets,
+                        pme_order) for k in range(3)]
+    points = [(base[:, k, None] - offsets) % grid_size[k] for k in range(3)]
+    flat = (points[0][:, :, None, None] * grid_size[1] * grid_size[2] +
+            points[1][:, None, :, None] * grid_size[2] +
+            points[2][:, None, None, :])
+    spread = (charges[:, None, None, None] *
+            weights[0][:, :, None, None] * weights[1][:, None, :, None] *
+            weights[2][:, None, None, :])
+    q_grid = np.bincount(flat.ravel(), weights=spread.ravel(),
+                        minlength=np.prod(grid_size)).reshape(grid_size)
+
+    structure_factor = np.abs(np.fft.rfftn(q_grid))**2
+
+    m = [np.fft.fftfreq(grid_size[0], 1 / grid_size[0]),
+        np.fft.fftfreq(grid_size[1], 1 / grid_size[1]),
+        np.arange(grid_size[2] // 2 + 1)]
+    m_vec = (m[0][:, None, None, None] * recip[0] +
+            m[1][None, :, None, None] * recip[1] +
+            m[2][None, None, :, None] * recip[2])
+    m2 = np.sum(m_vec**2, axis=-1)
+    m2[0, 0, 0] = np.inf
+    b2 = (_bspline_moduli(grid_size[0], pme_order)[:, None, None] *
+        _bspline_moduli(grid_size[1], pme_order)[None, :, None] *
+        _bspline_moduli(grid_size[2], pme_order)[None, None, :len(m[2])])
+    # The real FFT only stores half of the m3 axis
+    multiplicity = np.full(len(m[2]), 2.0)
+    multiplicity[0] = 1
+    if grid_size[2] % 2 == 0:
+        multiplicity[-1] = 1
+
+    energy = np.sum(multiplicity * np.exp(-np.pi**2 * m2 / alpha**2) / m2 *
+                    b2 * structure_factor)
+    return energy / (2 * np.pi * volume)
+
+def bspline(x, order):
+    """ Cardinal B-spline M_n(x) of order n, nonzero for 0 < x < n """
+    x = np.asarray(x, dtype=np.float64)
+    result = np.zeros_like(x)
+    for k in range(order + 1):
+        result += ((-1)**k * math.comb(order, k) *
+                    np.clip(x - k, 0, None)**(order - 1))
+    return result / math.factorial(order - 1)
+
+def _bspline_moduli(n_grid, order):
+    """ |b(m)|^2 of the Euler exponential spline """
+    m = np.arange(n_grid)
+    k = np.arange(order - 1)
+    denominator = np.abs(np.sum(bspline(k + 1, order)[None, :] *
+                        np.exp(2j * np.pi * np.outer(m, k) / n_grid),
+                        axis=1))**2
+    # Odd orders vanish at m = n_grid / 2, interpolate over the gap
+    small = denominator < 1e-10
+    if np.any(small):
+        denominator[small] = 0.5 * (np.roll(denominator, 1)[small] +
+                                    np.roll(denominator, -1)[small])
+    return 1 / denominator
+
+def _ewald_kmax(h, alpha, ewald_rtol):
+    """ Reciprocal vector indices beyond which exp(-pi^2 m^2 / alpha^2)
+    falls below `ewald_rtol` """
+    widths = abs(np.linalg.det(h)) / np.linalg.norm(
+            np.cross(h[[1, 2, 0]], h[[2, 0, 1]]), axis=1)
+    mmax = alpha * np.sqrt(-np.log(ewald_rtol)) / np.pi
+    kmax = tuple(int(math.ceil(mmax * width)) for width in widths)
+    if np.prod([2 * k + 1 for k in kmax]) > 1e6:
+        warnings.warn("Direct Ewald sum over {} reciprocal vectors, "
+                    "consider method='pme'".format(kmax))
+    return kmax
+
+def _fft_size(n):
+    """ Smallest integer >= n with no prime factors above 7 """
+    while True:
+        remainder = n
+        for prime in [2, 3, 5, 7]:
+            while remainder % prime == 0:
+                remainder //= prime
+        if remainder == 1:
+            return n
+        n += 1
@@ -0,0 +1,269 @@
+import itertools
+import numpy as np
+import parmed
+
+# Neighbor search for nonbonded pairs, linear in the number of atoms
+
+# Number of candidate pairs screened at once
+PAIR_BLOCK_SIZE = 2**22
+
+def box_matrix(box):
+    """ Box vectors as rows of a matrix (angstrom)
+
+    Parameters
+    ----------
+    box : array-like or None
+        parmed box, (a, b, c, alpha, beta, gamma)
+
+    Returns
+    -------
+    h : np.ndarray or None
+        (3, 3) matrix of box vectors
+    """
+    if box is None:
+        return None
+    vectors = parmed.geometry.box_lengths_and_angles_to_vectors(*box)
+    return np.array([vec.value_in_unit(parmed.unit.angstrom)
+                    for vec in vectors])
+
+def minimum_image(dr, h=None):
+    """ Wrap displacement vectors into the box given by matrix `h` """
+    if h is None:
+        return dr
+    fractional = dr @ np.linalg.inv(h)
+    fractional -= np.round(fractional)
+    return fractional @ h
+
+def bond_graph_pairs(n_atoms, bonds, max_separation=3):
+    """ Atom pairs separated by up to `max_separation` bonds
+
+    Parameters
+    ----------
+    n_atoms : int
+    bonds : np.ndarray
+        (n_bonds, 2) atom indices
+    max_separation : int
+
+    Returns
+    -------
+    pairs : dict
+        int : np.ndarray
+        Number of bonds separating a pair : (n_pairs, 2) indices, i < j.
+        Each pair appears only at its shortest separation
+    """
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+
+    # Compressed adjacency of the bond graph
+    directed = np.concatenate([bonds, bonds[:, ::-1]])
+    directed = directed[np.argsort(directed[:, 0], kind='stable')]
+    neighbors = directed[:, 1]
+    degree = np.bincount(directed[:, 0], minlength=n_atoms)
+    start = np.concatenate([[0], np.cumsum(degree)[:-1]])
+
+    # Walk outwards from every atom at once
+    pairs = {}
+    origin = np.arange(n_atoms, dtype=np.int64)
+    current = origin
+    seen = origin * n_atoms + current
+    for separation in range(1, max_separation + 1):
+        counts = degree[current]
+        origin = np.repeat(origin, counts)
+        current = neighbors[_expand(start[current], counts)]
+        codes = np.unique(origin * n_atoms + current)
+        codes = codes[~np.isin(codes, seen, assume_unique=True)]
+        seen = np.union1d(seen, codes)
+        origin, current = np.divmod(codes, n_atoms)
+        upper = origin < current
+        pairs[separation] = np.stack([origin[upper], current[upper]], axis=1)
+
+    return pairs
+
+def cell_list_pairs(xyz, cutoff, box=None):
+    """ Atom pairs closer than `cutoff`, found with a cell list
+
+    Atoms are binned into cells at least `cutoff` wide, so only
+    neighboring cells need to be searched.
+    Triclinic boxes are binned in fractional coordinates
+
+    Parameters
+    ----------
+    xyz : np.ndarray
+        (n_atoms, 3) coordinates (angstrom)
+    cutoff : float
+        Angstrom
+    box : array-like, optional
+        parmed box, (a, b, c, alpha, beta, gamma).
+        Distances are minimum image if given, otherwise non-periodic
+
+    Returns
+    -------
+    i, j : np.ndarray
+        Atom indices, i < j
+    r : np.ndarray
+        Pair distances
+    """
+    xyz = np.asarray(xyz, dtype=np.float64)
+    h = box_matrix(box)
+    if h is None:
+        lower = xyz.min(axis=0)
+        extent = xyz.max(axis=0) - lower
+        n_cells = np.maximum(1, np.floor(extent / cutoff)).astype(int)
+        fractional = (xyz - lower) / np.where(extent > 0, extent, 1)
+    else:
+        volume = abs(np.linalg.det(h))
+        widths = volume / np.linalg.norm(np.cross(h[[1, 2, 0]],
+                                                    h[[2, 0, 1]]), axis=1)
+        if cutoff > widths.min() / 2:
+            raise ValueError("Cutoff {} is larger than half the smallest "
+                    "box width {}".format(cutoff, widths.min()))
+        n_cells = np.maximum(1, np.floor(widths / cutoff)).astype(int)
+        fractional = xyz @ np.linalg.inv(h)
+        fractional -= np.floor(fractional)
+
+    cells = np.minimum((fractional * n_cells).astype(int), n_cells - 1)
+    cell = np.ravel_multi_index(cells.T, n_cells)
+    order = np.argsort(cell, kind='stable')
+    count = np.bincount(cell, minlength=np.prod(n_cells))
+    start = np.concatenate([[0], np.cumsum(count)[:-1]])
+
+    cell_a, cell_b = _neighbor_cells(n_cells, periodic=h is not None)
+    occupied = (count[cell_a] > 0) & (count[cell_b] > 0)
+    cell_a, cell_b = cell_a[occupied], cell_b[occupied]
+
+    found_i, found_j, found_r = [], [], []
+    for a, b in _cell_pair_blocks(cell_a, cell_b, count):
+        n_b = count[b]
+        n_pairs = count[a] * n_b
+        pair = np.repeat(np.arange(len(a)), n_pairs)
+        local = np.arange(n_pairs.sum()) - np.repeat(
+                np.cumsum(n_pairs) - n_pairs, n_pairs)
+        local_a, local_b = np.divmod(local, n_b[pair])
+        # Within a cell, each pair is only listed once
+        keep = (a[pair] != b[pair]) | (local_a < local_b)
+        i = order[start[a[pair]] + local_a][keep]
+        j = order[start[b[pair]] + local_b][keep]
+        r = np.linalg.norm(minimum_image(xyz[j] - xyz[i], h), axis=1)
+        within = r < cutoff
+        found_i.append(i[within])
+        found_j.append(j[within])
+        found_r.append(r[within])
+
+    if len(found_i) == 0:
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int),
+                np.zeros(0))
+    i, j, r = (np.concatenate(found) for found in [found_i, found_j, found_r])
+    return np.minimum(i, j), np.maximum(i, j), r
+
+def _neighbor_cells(n_cells, periodic=True):
+    """ Unique pairs of neighboring cells (a <= b), including each
+    cell with itself. Cells are only wrapped if `periodic` """
+    grid = np.indices(n_cells).reshape(3, -1).T
+    cell_a, cell_b = [], []
+    for shift in itertools.product([-1, 0, 1], repeat=3):
+        neighbor = grid + shift
+        if periodic:
+            neighbor %= n_cells
+            valid = np.ones(len(grid), dtype=bool)
+        else:
+            valid = np.all((neighbor >= 0) & (neighbor < n_cells), axis=1)
+        cell_a.append(np.ravel_multi_index(grid[valid].T, n_cells))
+        cell_b.append(np.ravel_multi_index(neighbor[valid].T, n_cells))
+    cell_a = np.concatenate(cell_a)
+    cell_b = np.concatenate(cell_b)
+    # Small periodic grids reach the same neighbor through several shifts
+    n_total = np.prod(n_cells)
+    codes = np.unique(np.minimum(cell_a, cell_b) * n_total +
+                        np.maximum(cell_a, cell_b))
+    return np.divmod(codes, n_total)
+
+def _cell_pair_blocks(cell_a, cell_b, count):
+    """ Split cell pairs into blocks of about `PAIR_BLOCK_SIZE`
+    candidate atom pairs """
+    n_pairs = np.cumsum(count[cell_a] * count[cell_b])
+    block = n_pairs // PAIR_BLOCK_SIZE
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(block)) + 1,
+                            [len(cell_a)]])
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        yield cell_a[lo:hi], cell_b[lo:hi]
+
+def _expand(starts, counts):
+    """ Concatenated ranges starts[k] : starts[k] + counts[k] """
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                    counts)
+    return np.repeat(starts, counts) + offsets
+
+
+class NeighborList(object):
+    """ Verlet list of atom pairs, reusable across frames
+
+    Pairs within `cutoff + skin` are found with `cell_list_pairs` and
+    kept until an atom has moved more than half the skin, or the box
+    changes. Until then, only the listed pairs are screened
+
+    Parameters
+    ----------
+    cutoff : float
+        Angstrom
+    skin : float
+        Angstrom, buffer beyond the cutoff
+    exclusions : np.ndarray, optional
+        (n_pairs, 2) atom indices, i < j, never listed
+    """
+    def __init__(self, cutoff, skin=2.0, exclusions=None):
+        self.cutoff = cutoff
+        self.skin = skin
+        self.exclusions = exclusions
+        self.pairs = None
+        self.n_builds = 0
+        self._xyz = None
+        self._box = None
+
+    def build(self, xyz, box=None):
+        """ Rebuild the list of pairs within `cutoff + skin` """
+        xyz = np.asarray(xyz, dtype=np.float64)
+        i, j, _ = cell_list_pairs(xyz, self.cutoff + self.skin, box)
+        if self.exclusions is not None and len(self.exclusions) > 0:
+            n_atoms = len(xyz)
+            exclusions = np.asarray(self.exclusions, dtype=np.int64)
+            keep = ~np.isin(i * n_atoms + j,
+                        exclusions[:, 0] * n_atoms + exclusions[:, 1])
+            i, j = i[keep], j[keep]
+        self.pairs = np.stack([i, j], axis=1)
+        self.n_builds += 1
+        self._xyz = xyz.copy()
+        self._box = None if box is None else np.array(box, dtype=np.float64)
+        return self
+
+    def needs_rebuild(self, xyz, box=None):
+        if self.pairs is None or len(xyz) != len(self._xyz):
+            return True
+        if (box is None) != (self._box is None):
+            return True
+        if box is not None and not np.allclose(box, self._box):
+            return True
+        shift = minimum_image(np.asarray(xyz) - self._xyz, box_matrix(box))
+        return np.max(np.linalg.norm(shift, axis=1), initial=0) > self.skin / 2
+
+    def update(self, xyz, box=None):
+        """ Rebuild if atoms moved too far since the last build """
+        if self.needs_rebuild(xyz, box):
+            self.build(xyz, box)
+        return self
+
+    def get_pairs(self, xyz, box=None):
+        """ Pairs within the cutoff at these coordinates
+
+        Returns
+        -------
+        i, j : np.ndarray
+            Atom indices, i < j
+        r : np.ndarray
+            Minimum image distances
+        """
+        xyz = np.asarray(xyz, dtype=np.float64)
+        self.update(xyz, box)
+        i, j = self.pairs.T
+        r = np.linalg.norm(minimum_image(xyz[j] - xyz[i], box_matrix(box)),
+                            axis=1)
+        within = r < self.cutoff
+        return i[within], j[within], r[within]
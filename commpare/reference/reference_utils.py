@@ -0,0 +1,431 @@
+import warnings
+import numpy as np
+import pandas as pd
+
+from commpare.utils import get_frame_coordinates
+from commpare.structure_arrays import StructureArrays, get_structure_arrays
+from commpare.reference.neighbors import (NeighborList, box_matrix,
+                                        minimum_image)
+from commpare.reference.ewald import ewald_energies
+from commpare.timing import timed
+
+# Unit conversions, parmed works in kcal/mol and angstroms
+KCAL_TO_KJ = 4.184
+# Coulomb constant (kJ/mol * angstrom / e^2), same value as OpenMM
+COULOMB_CONSTANT = 1389.35456
+
+# Number of atom pairs evaluated at once without a cutoff
+PAIR_BLOCK_SIZE = 2**22
+
+# Verlet buffer (angstrom) of neighbor lists reused across frames
+NEIGHBOR_SKIN = 2.0
+
+def build_run_measure_numpy(structure, cutoff=None, coulomb='cutoff',
+        ewald_kwargs=None, timer=None, **kwargs):
+    """ Measure energies of a parmed.Structure directly with NumPy
+
+    A reference engine with no external dependencies. Every term is
+    evaluated as a batched operation over index arrays of the
+    structure's bonds, angles, dihedrals, and atom pairs,
+    see `commpare.StructureArrays`
+
+    Parameters
+    ----------
+    structure : parmed.Structure
+    cutoff : float, optional
+        Nonbonded cutoff (angstrom), LJ and Coulomb are truncated beyond
+        it using minimum image distances.
+        Defaults to no cutoff and no periodic images,
+        matching the OpenMM engine.
+        Pairs within the cutoff are found with a cell list
+    coulomb : str
+        'cutoff' for truncated Coulomb, or 'pme' / 'ewald' for Ewald
+        summation with `cutoff` as the real space cutoff,
+        see `commpare.reference.ewald_energies`
+    ewald_kwargs : dict, optional
+        Passed to `commpare.reference.ewald_energies`, e.g.
+        {'ewald_rtol': 1e-6, 'fourier_spacing': 1.0, 'pme_order': 4}
+        to mirror the GROMACS mdp
+    timer : commpare.StageTimer, optional
+        Times the 'arrays', 'bonded', 'neighbor_search' (with a cutoff),
+        and 'nonbonded' stages
+
+    Returns
+    -------
+    energies : pandas.DataFrame
+        Canonical energy columns (kJ/mol), indexed by 'numpy'
+    """
+    _warn_unsupported(structure)
+    energies = {'numpy': get_numpy_energies(structure, cutoff=cutoff,
+                                            coulomb=coulomb,
+                                            ewald_kwargs=ewald_kwargs,
+                                            timer=timer)}
+    df = pd.DataFrame.from_dict(energies, orient='index')
+    df = df[['bond', 'angle', 'dihedral', 'LJ', 'QQ', 'nonbond', 'all']]
+
+    return df
+
+def build_run_measure_numpy_frames(structure, frames, cutoff=None,
+        coulomb='cutoff', ewald_kwargs=None, skin=NEIGHBOR_SKIN, timer=None,
+        **kwargs):
+    """ Measure NumPy reference energies for many frames of one topology
+
+    Parameters and exceptions are extracted once. With a cutoff,
+    a single neighbor list is reused until atoms move more than
+    half of `skin`
+
+    Parameters
+    ----------
+    structure : parmed.Structure
+        Topology and parameters shared by every frame
+    frames : array-like or mdtraj.Trajectory
+        Coordinates of shape (n_frames, n_atoms, 3) in Angstrom,
+        or an mdtraj.Trajectory
+    cutoff, coulomb, ewald_kwargs, timer :
+        See `build_run_measure_numpy`, stages accumulate over frames
+    skin : float
+        Verlet buffer (angstrom) of the neighbor list
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Indexed by frame with canonicalized energy columns
+    """
+    xyz, boxes = get_frame_coordinates(frames)
+    if xyz.shape[1] != len(structure.atoms):
+        raise ValueError("Frames have {} atoms, structure has {}".format(
+                            xyz.shape[1], len(structure.atoms)))
+
+    _warn_unsupported(structure)
+    with timed(timer, 'arrays'):
+        arrays = get_structure_arrays(structure)
+    neighbor_list = None
+    if cutoff is not None:
+        neighbor_list = NeighborList(cutoff, skin=skin,
+                exclusions=arrays.exceptions[0])
+
+    energies = {}
+    for frame, positions in enumerate(xyz):
+        box = arrays.box if boxes is None else boxes[frame]
+        energies[frame] = get_numpy_energies(arrays, cutoff=cutoff,
+                coulomb=coulomb, ewald_kwargs=ewald_kwargs,
+                xyz=positions, box=box, neighbor_list=neighbor_list,
+                timer=timer)
+    df = pd.DataFrame.from_dict(energies, orient='index')
+    df = df[['bond', 'angle', 'dihedral', 'LJ', 'QQ', 'nonbond', 'all']]
+    df.index.name = 'frame'
+
+    return df
+
+def get_numpy_energies(structure, cutoff=None, coulomb='cutoff',
+        ewald_kwargs=None, xyz=None, box=None, neighbor_list=None,
+        timer=None):
+    """ Canonical energies of a parmed.Structure (kJ/mol)
+
+    Parameters
+    ----------
+    structure : parmed.Structure or commpare.StructureArrays
+    cutoff, coulomb, ewald_kwargs :
+        See `build_run_measure_numpy`
+    xyz : np.ndarray, optional
+        (n_atoms, 3) coordinates (angstrom),
+        defaults to the structure's coordinates
+    box : array-like, optional
+        (a, b, c, alpha, beta, gamma), defaults to the structure's box
+    neighbor_list : commpare.reference.NeighborList, optional
+        Reused between calls with the same structure and cutoff
+    timer : commpare.StageTimer, optional
+        See `build_run_measure_numpy`
+
+    Returns
+    -------
+    energies : dict
+        str : float
+        Keys are 'bond', 'angle', 'dihedral', 'LJ', 'QQ', 'nonbond', 'all'
+    """
+    with timed(timer, 'arrays'):
+        arrays = get_structure_arrays(structure)
+        if xyz is None:
+            xyz = arrays.coordinates
+        xyz = np.asarray(xyz, dtype=np.float64)
+        if box is None:
+            box = arrays.box
+        h = box_matrix(box)
+
+    energies = {}
+    with timed(timer, 'bonded'):
+        energies['bond'] = (bond_energy(arrays, xyz, h) +
+                            urey_bradley_energy(arrays, xyz, h))
+        energies['angle'] = angle_energy(arrays, xyz, h)
+        energies['dihedral'] = (dihedral_energy(arrays, xyz, h) +
+                                rb_torsion_energy(arrays, xyz, h) +
+                                improper_energy(arrays, xyz, h))
+    if cutoff is not None:
+        # Pairs are found here, so the search is timed on its own
+        with timed(timer, 'neighbor_search'):
+            if neighbor_list is None:
+                neighbor_list = NeighborList(cutoff, skin=0.0,
+                        exclusions=arrays.exceptions[0])
+            neighbor_list.update(xyz, box)
+    with timed(timer, 'nonbonded'):
+        lj, qq = nonbonded_energy(arrays, xyz, box, cutoff=cutoff,
+                coulomb=coulomb, ewald_kwargs=ewald_kwargs,
+                neighbor_list=neighbor_list)
+    energies['LJ'] = lj
+    energies['QQ'] = qq
+    energies['nonbond'] = lj + qq
+    energies['all'] = (energies['bond'] + energies['angle'] +
+                        energies['dihedral'] + energies['nonbond'])
+
+    return {key: float(val) for key, val in energies.items()}
+
+def bond_energy(structure, xyz, h=None):
+    """ Harmonic bonds, k (r - req)^2
+
+    Bonded terms take a parmed.Structure or commpare.StructureArrays,
+    and the box as matrix `h` (see `commpare.reference.box_matrix`),
+    for minimum image vectors """
+    arrays = get_structure_arrays(structure)
+    return _harmonic_distance_energy(arrays.bonds, arrays.bond_params, xyz, h)
+
+def urey_bradley_energy(structure, xyz, h=None):
+    """ Urey-Bradley 1-3 terms, k (r - req)^2 """
+    arrays = get_structure_arrays(structure)
+    return _harmonic_distance_energy(arrays.urey_bradleys,
+                                    arrays.urey_bradley_params, xyz, h)
+
+def angle_energy(structure, xyz, h=None):
+    """ Harmonic angles, k (theta - theteq)^2 """
+    arrays = get_structure_arrays(structure)
+    idx, (k, theteq) = _typed(arrays.angles, arrays.angle_params)
+    if len(idx) == 0:
+        return 0.0
+    theta = _angles(xyz, idx, h)
+    return KCAL_TO_KJ * np.sum(k * (theta - np.deg2rad(theteq))**2)
+
+def dihedral_energy(structure, xyz, h=None):
+    """ Periodic dihedrals (proper and improper),
+    phi_k (1 + cos(per phi - phase)) summed over each dihedral's terms """
+    arrays = get_structure_arrays(structure)
+    if len(arrays.dihedral_terms) == 0:
+        return 0.0
+    phi_k, per, phase = arrays.dihedral_term_params.T
+    phi = _dihedrals(xyz, arrays.dihedrals[arrays.dihedral_terms], h)
+    return KCAL_TO_KJ * np.sum(phi_k *
+            (1 + np.cos(per * phi - np.deg2rad(phase))))
+
+def rb_torsion_energy(structure, xyz, h=None):
+    """ Ryckaert-Bellemans torsions, sum_n c_n cos^n(psi), psi = phi - 180 """
+    arrays = get_structure_arrays(structure)
+    idx, c = _typed(arrays.rb_torsions, arrays.rb_params)
+    if len(idx) == 0:
+        return 0.0
+    cos_psi = -np.cos(_dihedrals(xyz, idx, h))
+    powers = cos_psi[:, np.newaxis] ** np.arange(6)
+    return KCAL_TO_KJ * np.sum(c.T * powers)
+
+def improper_energy(structure, xyz, h=None):
+    """ Harmonic (CHARMM) impropers, psi_k (psi - psi_eq)^2 """
+    arrays = get_structure_arrays(structure)
+    idx, (psi_k, psi_eq) = _typed(arrays.impropers, arrays.improper_params)
+    if len(idx) == 0:
+        return 0.0
+    dpsi = _dihedrals(xyz, idx, h) - np.deg2rad(psi_eq)
+    dpsi = (dpsi + np.pi) % (2 * np.pi) - np.pi
+    return KCAL_TO_KJ * np.sum(psi_k * dpsi**2)
+
+def nonbonded_energy(structure, xyz, box=None, cutoff=None,
+        coulomb='cutoff', ewald_kwargs=None, neighbor_list=None):
+    """ LJ and Coulomb energies (kJ/mol)
+
+    Exclusions and 1-4 scaling follow `commpare.StructureArrays.exceptions`.
+    Excluded and scaled pairs are never cut off
+
+    Parameters
+    ----------
+    structure : parmed.Structure or commpare.StructureArrays
+    xyz : np.ndarray
+        (n_atoms, 3) coordinates (angstrom)
+    box : array-like, optional
+        (a, b, c, alpha, beta, gamma)
+    cutoff : float, optional
+        Angstrom. Without a cutoff, all pairs are evaluated 
+        without periodic images
+    coulomb : str
+        'cutoff', 'pme', or 'ewald'
+    ewald_kwargs : dict, optional
+        Passed to `commpare.reference.ewald_energies`
+    neighbor_list : commpare.reference.NeighborList, optional
+        Built from the exceptions and `cutoff` if not given
+
+    Returns
+    -------
+    lj, qq : float
+    """
+    arrays = get_structure_arrays(structure)
+    n_atoms = arrays.n_atoms
+    if n_atoms == 0:
+        return 0.0, 0.0
+    charge = arrays.charges
+    sigma = arrays.sigma
+    epsilon = np.abs(arrays.epsilon)
+    if cutoff is not None and box is None:
+        warnings.warn("Cutoff without a box, using non-periodic distances")
+    if coulomb not in ['cutoff', 'pme', 'ewald']:
+        raise ValueError("Unknown coulomb method {}, use 'cutoff', "
+                        "'pme', or 'ewald'".format(coulomb))
+    ewald = coulomb != 'cutoff'
+    if ewald and (cutoff is None or box is None):
+        raise ValueError("Ewald summation needs a cutoff and a box")
+
+    exception_pairs, _ = arrays.exceptions
+    if cutoff is None:
+        exception_codes = (exception_pairs[:, 0].astype(np.int64) * n_atoms +
+                            exception_pairs[:, 1])
+        blocks = ((i, j, np.linalg.norm(xyz[j] - xyz[i], axis=1))
+                    for i, j in _pair_blocks(n_atoms, exception_codes))
+    else:
+        if neighbor_list is None:
+            neighbor_list = NeighborList(cutoff, skin=0.0,
+                    exclusions=exception_pairs)
+        blocks = [neighbor_list.get_pairs(xyz, box)]
+
+    lj, qq = 0.0, 0.0
+    for i, j, r in blocks:
+        lj += np.sum(_lj(r, _combine_sigma(arrays.combining_rule,
+                                            sigma[i], sigma[j]),
+                            np.sqrt(epsilon[i] * epsilon[j])))
+        if not ewald:
+            qq += np.sum(_coulomb(r, charge[i] * charge[j]))
+
+    r, (chgprod, sigprod, epsprod) = _scaled_pairs(arrays, xyz, box)
+    lj += np.sum(_lj(r, sigprod, epsprod))
+    if ewald:
+        qq = get_ewald_terms(arrays, cutoff, method=coulomb, xyz=xyz,
+                box=box, neighbor_list=neighbor_list,
+                **(ewald_kwargs or {}))['total']
+    else:
+        qq += np.sum(_coulomb(r, chgprod))
+
+    return lj, qq
+
+def get_ewald_terms(structure, cutoff, method='pme', xyz=None, box=None,
+        neighbor_list=None, **kwargs):
+    """ Electrostatic energy of a parmed.Structure by Ewald summation,
+    term by term (kJ/mol)
+
+    Parameters
+    ----------
+    structure : parmed.Structure or commpare.StructureArrays
+    cutoff : float
+        Real space cutoff (angstrom)
+    method : str
+        'pme' or 'ewald'
+    xyz, box : optional
+        Default to the structure's coordinates and box
+    neighbor_list : commpare.reference.NeighborList, optional
+        Reused for the real space sum
+    **kwargs
+        Passed to `commpare.reference.ewald_energies`, e.g. 
+        ewald_rtol, fourier_spacing, pme_order
+
+    Returns
+    -------
+    energies : dict
+        The terms of `commpare.reference.ewald_energies`, 'scaled' for
+        the Coulomb interaction of scaled 1-4 pairs, and 'total'
+    """
+    arrays = get_structure_arrays(structure)
+    if xyz is None:
+        xyz = arrays.coordinates
+    if box is None:
+        box = arrays.box
+
+    energies = ewald_energies(xyz, arrays.charges, box, cutoff,
+            exclusions=arrays.exceptions[0], method=method,
+            neighbor_list=neighbor_list, **kwargs)
+    r, (chgprod, _, _) = _scaled_pairs(arrays, xyz, box)
+    energies['scaled'] = float(np.sum(_coulomb(r, chgprod)))
+    energies['total'] += energies['scaled']
+    return energies
+
+def _warn_unsupported(structure):
+    if isinstance(structure, StructureArrays):
+        return
+    if len(structure.cmaps) > 0 or len(structure.trigonal_angles) > 0:
+        warnings.warn("CMAP and trigonal angle terms are not supported by "
+                "the numpy engine, ignoring")
+    if structure.has_NBFIX():
+        warnings.warn("NBFIX terms are not supported by the numpy engine, "
+                    "using combining rules")
+
+def _typed(idx, params):
+    """ Terms that have a type, and their parameters as rows """
+    typed = ~np.any(np.isnan(params), axis=1)
+    return idx[typed], params[typed].T
+
+def _harmonic_distance_energy(idx, params, xyz, h=None):
+    idx, (k, req) = _typed(idx, params)
+    if len(idx) == 0:
+        return 0.0
+    r = np.linalg.norm(_displacement(xyz, idx[:, 0], idx[:, 1], h), axis=1)
+    return KCAL_TO_KJ * np.sum(k * (r - req)**2)
+
+def _lj(r, sigma, epsilon):
+    """ 12-6 Lennard-Jones, kJ/mol """
+    sr6 = (sigma / r)**6
+    return 4 * KCAL_TO_KJ * epsilon * (sr6 * sr6 - sr6)
+
+def _coulomb(r, chgprod):
+    """ Coulomb, kJ/mol """
+    return COULOMB_CONSTANT * chgprod / r
+
+def _combine_sigma(combining_rule, sigma1, sigma2):
+    if combining_rule == 'geometric':
+        return np.sqrt(sigma1 * sigma2)
+    return 0.5 * (sigma1 + sigma2)
+
+def _scaled_pairs(arrays, xyz, box):
+    """ Distances and (chgprod, sigma, epsilon) rows of the
+    scaled exceptions """
+    pairs, params = arrays.exceptions
+    scaled = ~np.isnan(params[:, 0])
+    i, j = pairs[scaled].T
+    r = np.linalg.norm(_displacement(xyz, i, j, box_matrix(box)), axis=1)
+    return r, params[scaled].T
+
+def _pair_blocks(n_atoms, exception_codes):
+    """ Yield (i, j) index arrays of all pairs i < j, other than
+    exceptions, in blocks of about `PAIR_BLOCK_SIZE` pairs """
+    rows = max(1, PAIR_BLOCK_SIZE // n_atoms)
+    for start in range(0, n_atoms - 1, rows):
+        i = np.arange(start, min(start + rows, n_atoms - 1))
+        i, j = np.meshgrid(i, np.arange(n_atoms), indexing='ij')
+        i, j = i[j > i], j[j > i]
+        keep = ~np.isin(i * n_atoms + j, exception_codes, assume_unique=True)
+        yield i[keep], j[keep]
+
+def _displacement(xyz, i, j, h=None):
+    """ Vectors from atoms i to atoms j, minimum image if box
+    matrix `h` is given """
+    return minimum_image(xyz[j] - xyz[i], h)
+
+def _angles(xyz, idx, h=None):
+    """ Angles (radians) of (n, 3) atom index triplets """
+    v1 = _displacement(xyz, idx[:, 1], idx[:, 0], h)
+    v2 = _displacement(xyz, idx[:, 1], idx[:, 2], h)
+    cos_theta = (np.sum(v1 * v2, axis=1) /
+            (np.linalg.norm(v1, axis=1) * np.linalg.norm(v2, axis=1)))
+    return np.arccos(np.clip(cos_theta, -1, 1))
+
+def _dihedrals(xyz, idx, h=None):
+    """ Dihedral angles (radians, IUPAC sign convention)
+    of (n, 4) atom index quadruplets """
+    b1 = _displacement(xyz, idx[:, 0], idx[:, 1], h)
+    b2 = _displacement(xyz, idx[:, 1], idx[:, 2], h)
+    b3 = _displacement(xyz, idx[:, 2], idx[:, 3], h)
+    n1 = np.cross(b1, b2)
+    n2 = np.cross(b2, b3)
+    x = np.sum(n1 * n2, axis=1)
+    y = np.sum(np.cross(n1, n2) * b2, axis=1) / np.linalg.norm(b2, axis=1)
+    return np.arctan2(y, x)
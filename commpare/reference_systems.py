@@ -1,4 +1,4 @@
-import importlib
+from commpare.mm_engines import module_available
 
 ### Identify the reference systems for which to evaluate energy
 def identify_reference_systems():
@@ -13,22 +13,10 @@ def identify_reference_systems():
     return reference_systems
 
 def detect_validate():
-    try:
-        importlib.import_module('validate')
-        return True
-    except ModuleNotFoundError:
-        return False
+    return module_available('validate')
 
 def detect_foyer():
-    try:
-        importlib.import_module('foyer')
-        return True
-    except ModuleNotFoundError:
-        return False
+    return module_available('foyer')
 
 def detect_mbuild():
-    try:
-        importlib.import_module('mbuild')
-        return True
-    except ModuleNotFoundError:
-        return False
+    return module_available('mbuild')
@@ -0,0 +1,337 @@
+import contextlib
+import datetime
+import fcntl
+import os
+import uuid
+
+from commpare.utils import default_cache_dir
+
+# On-disk history of energy results, as a Parquet dataset partitioned by
+# engine (hive-style engine=<name>/ directories), appended to by
+# `spawn_engine_simulations(..., result_store=...)` and queried without
+# loading the whole history. Requires pyarrow
+
+# Columns with a fixed type, other columns are inferred
+RESULT_STRING_COLUMNS = ['structure', 'engine', 'forcefield', 'error',
+        'structure_hash', 'settings_hash', 'engine_version']
+# Columns written on every row, null when unknown
+RESULT_METADATA_COLUMNS = ['forcefield', 'structure_hash', 'settings_hash',
+        'engine_version']
+RESULT_FLOAT_COLUMNS = ['bond', 'angle', 'dihedral', 'LJ', 'QQ', 'nonbond',
+        'all']
+
+
+def _parquet_files(directory, filenames):
+    return [os.path.join(directory, name) for name in sorted(filenames)
+            if name.endswith('.parquet') and not name.startswith('.')]
+
+@contextlib.contextmanager
+def _partition_lock(directory):
+    """ Exclusive lock on a dataset directory, yielding False without
+    waiting if another process holds it. Released if the process dies """
+    # Hidden from dataset discovery
+    lock_file = os.path.join(directory, '.compact.lock')
+    with open(lock_file, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ResultStore(object):
+    """ Append-only Parquet dataset of energy results
+
+    Each row is one (structure, engine) result: the canonical energies,
+    any `time_<stage>_wall/_cpu` timings or error, a `timestamp`, and
+    the `RESULT_METADATA_COLUMNS`: the structure and settings hashes,
+    the engine version, and the forcefield, null when not given
+
+    Parameters
+    ----------
+    path : str, optional
+        Dataset directory, defaults to `results` in
+        `commpare.utils.default_cache_dir()`
+    metadata : dict, optional
+        Columns added to every appended row, e.g. {'forcefield': 'OPLSAA'}
+    partition_by : list of str
+        Columns partitioning the dataset into directories.
+        Queries on these columns skip the other directories entirely
+    buffer_size : int
+        Rows buffered in memory before they are written as a new file
+    max_files : int, optional
+        Partitions holding more files than this after a flush are
+        merged into one file, see `compact`. None to never compact
+
+    Examples
+    --------
+    >>> with ResultStore('results', metadata={'forcefield': 'OPLSAA'}) as store:
+    ...     spawn_engine_simulations(structure, result_store=store)
+    >>> ResultStore('results').query(engine='gromacs', forcefield='OPLSAA')
+    """
+    def __init__(self, path=None, metadata=None, partition_by=('engine',),
+            buffer_size=1000, max_files=32):
+        _require_pyarrow()
+        if path is None:
+            path = os.path.join(default_cache_dir(), 'results')
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.metadata = dict(metadata or {})
+        self.partition_by = list(partition_by)
+        self.buffer_size = buffer_size
+        self.max_files = max_files
+        self._buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, records, **metadata):
+        """ Buffer result rows, writing them out every `buffer_size` rows
+
+        Parameters
+        ----------
+        records : dict, list of dict, or pandas.DataFrame
+            Records as yielded by `spawn_engine_simulations_batch`, or
+            energies as returned by `spawn_engine_simulations` or
+            `collect_energies`
+        **metadata
+            Columns added to these rows, on top of `self.metadata`
+        """
+        timestamp = datetime.datetime.now(datetime.timezone.utc)
+        for record in _as_records(records):
+            row = dict.fromkeys(RESULT_METADATA_COLUMNS)
+            row.update(self.metadata)
+            row.update(metadata)
+            row.update(record)
+            row.setdefault('timestamp', timestamp)
+            self._buffer.append(row)
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """ Write buffered rows as a new file of each partition,
+        compacting partitions with more than `max_files` files """
+        if len(self._buffer) == 0:
+            return
+        import pyarrow.dataset as ds
+        table = _to_table(self._buffer, self.partition_by)
+        ds.write_dataset(table, self.path, format='parquet',
+                partitioning=self.partition_by or None,
+                partitioning_flavor='hive',
+                basename_template=uuid.uuid4().hex + '-{i}.parquet',
+                existing_data_behavior='overwrite_or_ignore')
+        self._buffer = []
+        if self.max_files is not None:
+            self.compact(min_files=self.max_files + 1)
+
+    def compact(self, min_files=2):
+        """ Merge the files of each partition into a single file
+
+        Every flush adds a file to each partition it touches, and every
+        query reads the footer of every file, so many small appends
+        slow queries down. Each partition is locked while it is merged,
+        and partitions another process is merging are skipped. Queries
+        are not locked out: one running concurrently may see the rows
+        of a merged partition twice, or fail on a file removed under it,
+        and can simply be retried
+
+        Parameters
+        ----------
+        min_files : int
+            Only merge partitions with at least this many files
+        """
+        self.flush()
+        min_files = max(min_files, 2)
+        for root, _, filenames in os.walk(self.path):
+            if len(_parquet_files(root, filenames)) < min_files:
+                continue
+            with _partition_lock(root) as locked:
+                if locked:
+                    self._compact_partition(root, min_files)
+
+    def _compact_partition(self, root, min_files):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        # Listed again under the lock, as a merge by another process
+        # may have completed in between
+        files = _parquet_files(root, os.listdir(root))
+        if len(files) < min_files:
+            return
+        tables = [pq.ParquetFile(filename).read() for filename in files]
+        try:
+            try:
+                table = pa.concat_tables(tables, promote_options='permissive')
+            except TypeError:
+                table = pa.concat_tables(tables, promote=True)
+        except pa.ArrowException:
+            # Conflicting column types, left as separate files
+            return
+        name = uuid.uuid4().hex + '-0.parquet'
+        # Hidden from dataset discovery until complete
+        tmp = os.path.join(root, '.' + name)
+        pq.write_table(table, tmp)
+        os.replace(tmp, os.path.join(root, name))
+        for filename in files:
+            os.remove(filename)
+
+    def close(self):
+        self.flush()
+
+    def dataset(self):
+        """ The stored results as a pyarrow.dataset.Dataset, with the
+        columns of every file. Buffered rows are not included """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        dataset = ds.dataset(self.path, format='parquet', partitioning='hive')
+        schemas = [dataset.schema] + [fragment.physical_schema
+                                    for fragment in dataset.get_fragments()]
+        try:
+            schema = pa.unify_schemas(schemas, promote_options='permissive')
+        except TypeError:
+            schema = pa.unify_schemas(schemas)
+        return ds.dataset(self.path, schema=schema, format='parquet',
+                        partitioning='hive')
+
+    def query(self, engine=None, forcefield=None, structure=None,
+            since=None, columns=None, filter=None):
+        """ Load the results matching every given condition
+
+        Conditions are pushed down to the dataset: partitions that can not
+        match are skipped, and row groups are skipped using their
+        statistics, so only matching data is read. Conditions on a
+        column no stored row has match nothing
+
+        Parameters
+        ----------
+        engine, forcefield, structure : str or list of str, optional
+            Keep rows with any of these values
+        since : datetime.datetime, optional
+            Keep rows appended at or after this time (UTC if naive)
+        columns : list of str, optional
+            Columns to load, defaults to all
+        filter : pyarrow.compute.Expression, optional
+            Any other condition, e.g. `pyarrow.dataset.field('all') < 0`
+
+        Returns
+        -------
+        results : pandas.DataFrame
+        """
+        import pyarrow.dataset as ds
+        self.flush()
+        if not _has_files(self.path):
+            import pandas as pd
+            return pd.DataFrame(columns=columns)
+        dataset = self.dataset()
+        conditions = [] if filter is None else [filter]
+        for name, values in [('engine', engine), ('forcefield', forcefield),
+                            ('structure', structure)]:
+            if values is None:
+                continue
+            if name not in dataset.schema.names:
+                # No stored row has a value to match
+                import pandas as pd
+                return pd.DataFrame(columns=columns or dataset.schema.names)
+            if isinstance(values, str):
+                values = [values]
+            conditions.append(ds.field(name).isin([str(value)
+                                                for value in values]))
+        if since is not None:
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=datetime.timezone.utc)
+            conditions.append(ds.field('timestamp') >= since)
+        expression = None
+        for condition in conditions:
+            expression = (condition if expression is None
+                            else expression & condition)
+        return dataset.to_table(columns=columns,
+                                filter=expression).to_pandas()
+
+    def __len__(self):
+        self.flush()
+        if not _has_files(self.path):
+            return 0
+        return self.dataset().count_rows()
+
+def open_result_store(result_store):
+    """ A ResultStore, from a ResultStore, a path, or True for the
+    default location. None if `result_store` is None or False """
+    if result_store is None or result_store is False:
+        return None
+    if result_store is True:
+        return ResultStore()
+    if isinstance(result_store, str):
+        return ResultStore(result_store)
+    return result_store
+
+def _as_records(records):
+    if isinstance(records, dict):
+        return [records]
+    if hasattr(records, 'to_dict'):
+        df = records
+        if 'engine' not in df:
+            df = df.reset_index()
+            names = list(records.index.names)
+            if len(names) == 2:
+                df = df.rename(columns={df.columns[0]: 'structure',
+                                        df.columns[1]: 'engine'})
+            else:
+                df = df.rename(columns={df.columns[0]: 'engine'})
+        return df.to_dict('records')
+    return list(records)
+
+def _to_table(rows, partition_by=()):
+    import pyarrow as pa
+    columns = list(dict.fromkeys(name for row in rows for name in row))
+    arrays = []
+    for name in columns:
+        values = [row.get(name) for row in rows]
+        if name in RESULT_STRING_COLUMNS or name in partition_by:
+            arrays.append(pa.array([_to_str(value) for value in values],
+                                    type=pa.string()))
+        elif name in RESULT_FLOAT_COLUMNS or name.startswith('time_'):
+            arrays.append(pa.array([_to_float(value) for value in values],
+                                    type=pa.float64()))
+        elif name == 'timestamp':
+            arrays.append(pa.array(values, type=pa.timestamp('us', tz='UTC')))
+        else:
+            try:
+                arrays.append(pa.array(values))
+            except (pa.ArrowException, TypeError, ValueError):
+                # Mixed types, stored as strings
+                arrays.append(pa.array([_to_str(value) for value in values],
+                                        type=pa.string()))
+    return pa.Table.from_arrays(arrays, names=columns)
+
+def _to_str(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    return str(value)
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        # e.g. 'N/A' for terms an engine does not report
+        return None
+
+def _has_files(path):
+    for _, _, filenames in os.walk(path):
+        if any(name.endswith('.parquet') for name in filenames):
+            return True
+    return False
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+    except ImportError:
+        raise ImportError("ResultStore requires pyarrow, "
+                        "install it with `conda install pyarrow` "
+                        "or `pip install pyarrow`")
@@ -0,0 +1,213 @@
+import asyncio
+import collections
+import concurrent.futures
+import os
+import shlex
+import time
+
+# Execution of external engine binaries (GROMACS, Cassandra) with
+# timeouts and a bound on the number of concurrent processes
+
+# Default timeout (seconds) of every command, no timeout if unset
+DEFAULT_TIMEOUT = (float(os.environ['COMMPARE_COMMAND_TIMEOUT'])
+                    if os.environ.get('COMMPARE_COMMAND_TIMEOUT') else None)
+
+_CommandResult = collections.namedtuple('CommandResult',
+        'cmd returncode stdout stderr duration timed_out')
+
+class CommandResult(_CommandResult):
+    """ Outcome of an external command
+
+    Attributes
+    ----------
+    cmd : list of str
+    returncode : int or None
+        None if the command timed out or could not be started
+    stdout, stderr : str
+    duration : float
+        Wall time (seconds)
+    timed_out : bool
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def check(self):
+        """ Raise EngineCommandError unless the command succeeded """
+        if not self.ok:
+            raise EngineCommandError(self)
+        return self
+
+
+class EngineCommandError(RuntimeError):
+    """ An external engine command failed or timed out
+
+    The CommandResult is available as the `result` attribute
+    """
+    def __init__(self, result):
+        self.result = result
+        if result.timed_out:
+            reason = "timed out after {:.1f} s".format(result.duration)
+        else:
+            reason = "failed with exit code {}".format(result.returncode)
+        message = "Command '{}' {}".format(' '.join(result.cmd), reason)
+        stderr = result.stderr.strip().splitlines()[-5:]
+        if stderr:
+            message += ":\n" + "\n".join(stderr)
+        super(EngineCommandError, self).__init__(message)
+
+def run_command(cmd, cwd=None, timeout=None, log_prefix=None, env=None):
+    """ Run an external command to completion
+
+    Parameters
+    ----------
+    cmd : str or list of str
+        Program and arguments. A str is split with `shlex.split`,
+        no shell is involved
+    cwd : str, optional
+        Working directory, defaults to the current directory
+    timeout : float, optional
+        Seconds before the command is killed, defaults to
+        `DEFAULT_TIMEOUT` (the COMMPARE_COMMAND_TIMEOUT environment
+        variable)
+    log_prefix : str, optional
+        Stream stdout and stderr to `log_prefix`.out and `log_prefix`.err
+        while the command runs
+    env : dict, optional
+        Environment of the command, defaults to the current one
+
+    Returns
+    -------
+    result : CommandResult
+        Failures are returned rather than raised, see `CommandResult.check`
+    """
+    coroutine = run_command_async(cmd, cwd=cwd, timeout=timeout,
+            log_prefix=log_prefix, env=env)
+    return _run_coroutine(coroutine)
+
+def run_commands(commands, max_concurrent=None, timeout=None):
+    """ Run many external commands, at most `max_concurrent` at a time
+
+    Parameters
+    ----------
+    commands : list
+        Each a command (str or list of str), or a dict of keyword
+        arguments to `run_command`, e.g. {'cmd': ..., 'cwd': ...}.
+        Give each command its own `cwd` and `log_prefix`, they
+        run at the same time
+    max_concurrent : int, optional
+        Defaults to the CPU count
+    timeout : float, optional
+        Per-command timeout, unless given in the command's dict
+
+    Returns
+    -------
+    results : list of CommandResult
+        In the order of `commands`
+    """
+    return _run_coroutine(run_commands_async(commands,
+            max_concurrent=max_concurrent, timeout=timeout))
+
+async def run_commands_async(commands, max_concurrent=None, timeout=None):
+    """ Coroutine version of `run_commands` """
+    if max_concurrent is None:
+        max_concurrent = os.cpu_count() or 1
+    semaphore = asyncio.Semaphore(max(1, max_concurrent))
+    tasks = []
+    for command in commands:
+        if isinstance(command, dict):
+            kwargs = dict(command)
+        else:
+            kwargs = {'cmd': command}
+        kwargs.setdefault('timeout', timeout)
+        tasks.append(run_command_async(semaphore=semaphore, **kwargs))
+    return list(await asyncio.gather(*tasks))
+
+async def run_command_async(cmd, cwd=None, timeout=None, log_prefix=None,
+        env=None, semaphore=None):
+    """ Coroutine version of `run_command`
+
+    Parameters
+    ----------
+    semaphore : asyncio.Semaphore, optional
+        Held while the command runs, to bound concurrency
+
+    Notes
+    -----
+    If the awaiting task is cancelled, the process is killed before
+    the cancellation propagates
+    """
+    if isinstance(cmd, str):
+        cmd = shlex.split(cmd)
+    cmd = [str(arg) for arg in cmd]
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+    if semaphore is None:
+        return await _run_process(cmd, cwd, timeout, log_prefix, env)
+    async with semaphore:
+        return await _run_process(cmd, cwd, timeout, log_prefix, env)
+
+async def _run_process(cmd, cwd, timeout, log_prefix, env):
+    start = time.perf_counter()
+    try:
+        process = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, env=env,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        return CommandResult(cmd, None, '', str(e),
+                time.perf_counter() - start, False)
+
+    logs = [None, None]
+    if log_prefix is not None:
+        logs = [open(log_prefix + '.out', 'w'), open(log_prefix + '.err', 'w')]
+    stdout, stderr = [], []
+    timed_out = False
+    try:
+        readers = asyncio.gather(_stream(process.stdout, stdout, logs[0]),
+                                _stream(process.stderr, stderr, logs[1]),
+                                process.wait())
+        try:
+            await asyncio.wait_for(readers, timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+    finally:
+        if process.returncode is None:
+            _kill(process)
+            # Reap the killed process
+            await asyncio.shield(process.wait())
+        for log in logs:
+            if log is not None:
+                log.close()
+
+    return CommandResult(cmd, None if timed_out else process.returncode,
+            ''.join(stdout), ''.join(stderr),
+            time.perf_counter() - start, timed_out)
+
+async def _stream(pipe, lines, log=None):
+    """ Collect lines of a pipe, copying them to `log` as they arrive """
+    while True:
+        line = await pipe.readline()
+        if not line:
+            return
+        line = line.decode(errors='replace')
+        lines.append(line)
+        if log is not None:
+            log.write(line)
+            log.flush()
+
+def _kill(process):
+    try:
+        process.kill()
+    except ProcessLookupError:
+        pass
+
+def _run_coroutine(coroutine):
+    """ Run a coroutine to completion, also from inside a running event
+    loop (e.g. a Jupyter notebook), where it gets a thread of its own """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
@@ -0,0 +1,453 @@
+import hashlib
+import weakref
+import numpy as np
+
+# Array view of a parmed.Structure, extracted once and reused by the
+# engines, hashing, molecule detection, and coordinate handling
+
+_structure_arrays = weakref.WeakKeyDictionary()
+
+def get_structure_arrays(structure, refresh=False):
+    """ Cached StructureArrays of a parmed.Structure
+
+    Topology and parameters are extracted on first use, and reused
+    while the number of atoms and terms is unchanged. Coordinates and
+    box are re-read on every call
+
+    Parameters
+    ----------
+    structure : parmed.Structure or StructureArrays
+        StructureArrays are returned as is
+    refresh : bool
+        Re-extract everything, needed after editing parameters in place
+
+    Returns
+    -------
+    arrays : StructureArrays
+    """
+    if isinstance(structure, StructureArrays):
+        return structure
+    arrays = _structure_arrays.get(structure)
+    if (refresh or arrays is None or
+            arrays.signature != _structure_signature(structure)):
+        arrays = StructureArrays(structure)
+        _structure_arrays[structure] = arrays
+    else:
+        arrays.update_coordinates(structure)
+    return arrays
+
+def round_structure(structure, decimals=None):
+    """ Copy of a parmed.Structure with rounded coordinates
+
+    The input structure is never modified, and is returned as is
+    if `decimals` is None
+    """
+    if decimals is None:
+        return structure
+    arrays = get_structure_arrays(structure)
+    rounded = structure.copy(type(structure))
+    rounded.coordinates = np.round(arrays.coordinates, decimals)
+    return rounded
+
+def find_molecules(structure):
+    """ Molecule of each atom, from the connected components of the
+    bond graph. Molecules are numbered by their first atom
+
+    Parameters
+    ----------
+    structure : parmed.Structure or commpare.StructureArrays
+
+    Returns
+    -------
+    labels : np.ndarray
+        (n_atoms,) molecule index of each atom
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    arrays = get_structure_arrays(structure)
+    n_atoms = arrays.n_atoms
+    bonds = arrays.bonds
+    graph = coo_matrix((np.ones(len(bonds)), (bonds[:, 0], bonds[:, 1])),
+                        shape=(n_atoms, n_atoms))
+    _, labels = connected_components(graph, directed=False)
+    _, first = np.unique(labels, return_index=True)
+    # Renumber in order of appearance
+    order = np.empty(len(first), dtype=np.int64)
+    order[np.argsort(first)] = np.arange(len(first))
+    return order[labels]
+
+def unique_molecules(structure):
+    """ Group the molecules of a parmed.Structure into identical copies
+
+    Molecules are identical if their atoms (names, types, charges,
+    masses, LJ parameters, residues), and their bonded terms,
+    1-4 adjustments, and exclusions match, with atom indices taken
+    relative to the first atom of the molecule
+
+    Returns
+    -------
+    molecules : list of (np.ndarray, list of int)
+        Atom indices of the first copy of each unique molecule, and the
+        molecule numbers of all its copies, in order of first appearance.
+        None if molecules are not contiguous blocks of atoms, or have
+        terms (e.g. CMAPs) that are not compared
+    """
+    # Re-extracted, parameters may have been edited since the last lookup
+    arrays = get_structure_arrays(structure, refresh=True)
+    if len(structure.cmaps) > 0 or len(structure.trigonal_angles) > 0:
+        return None
+    labels = find_molecules(arrays)
+    if np.any(np.diff(labels) < 0):
+        return None
+    n_molecules = labels.max() + 1 if len(labels) > 0 else 0
+    starts = np.searchsorted(labels, np.arange(n_molecules))
+    sizes = np.bincount(labels, minlength=n_molecules)
+
+    atoms = structure.atoms
+    names = _codes([atom.name for atom in atoms])
+    residue_names = _codes([atom.residue.name for atom in atoms])
+    residues = np.array([atom.residue.idx for atom in atoms])
+    local_residues = residues - residues[starts][labels]
+    atom_rows = np.column_stack([names, residue_names, local_residues,
+            arrays.atom_types, arrays.charges, arrays.masses,
+            arrays.atomic_numbers])
+
+    term_sections = [
+        (arrays.bonds, arrays.bond_params),
+        (arrays.angles, arrays.angle_params),
+        (arrays.urey_bradleys, arrays.urey_bradley_params),
+        (arrays.dihedrals, np.column_stack([arrays.dihedral_improper,
+                arrays.dihedral_ignore_end, arrays.dihedral_scaling])),
+        (arrays.dihedrals[arrays.dihedral_terms], arrays.dihedral_term_params),
+        (arrays.rb_torsions, np.column_stack([arrays.rb_params,
+                arrays.rb_ignore_end, arrays.rb_scaling])),
+        (arrays.impropers, arrays.improper_params),
+        (arrays.adjusts, arrays.adjust_params),
+        (arrays.exclusion_partners,
+            np.zeros((len(arrays.exclusion_partners), 0))),
+    ]
+    sections = [np.split(atom_rows, starts[1:])]
+    for idx, params in term_sections:
+        owner = labels[idx[:, 0]]
+        if np.any(labels[idx] != owner[:, None]):
+            # Term between molecules
+            return None
+        rows = np.column_stack([idx - starts[owner][:, None], params])
+        order = np.argsort(owner, kind='stable')
+        counts = np.bincount(owner, minlength=n_molecules)
+        sections.append(np.split(rows[order], np.cumsum(counts)[:-1]))
+
+    molecules = {}
+    for i in range(n_molecules):
+        key = tuple(section[i].astype(np.float64).tobytes()
+                    for section in sections)
+        if key not in molecules:
+            molecules[key] = (np.arange(starts[i], starts[i] + sizes[i]), [])
+        molecules[key][1].append(i)
+    return list(molecules.values())
+
+def _structure_signature(structure):
+    return (len(structure.atoms), len(structure.bonds), len(structure.angles),
+            len(structure.urey_bradleys), len(structure.dihedrals),
+            len(structure.rb_torsions), len(structure.impropers),
+            len(structure.adjusts), structure.combining_rule,
+            structure.nrexcl)
+
+
+class StructureArrays(object):
+    """ Contiguous arrays of a parmed.Structure's coordinates,
+    parameters, and connectivity
+
+    Units are those of parmed, angstrom, kcal/mol, and degrees.
+    Index arrays are int32, and terms without a type have NaN parameters
+
+    Attributes
+    ----------
+    coordinates : np.ndarray
+        (n_atoms, 3), or None
+    box : np.ndarray
+        (a, b, c, alpha, beta, gamma), or None
+    charges, masses : np.ndarray
+        (n_atoms,)
+    atomic_numbers, atom_types : np.ndarray
+        (n_atoms,), atom types index `type_names` and `type_params`
+    type_names : np.ndarray
+        (n_types,) atom type names
+    type_params : np.ndarray
+        (n_types, 4) epsilon, rmin, epsilon_14, rmin_14
+    bonds, urey_bradleys : np.ndarray
+        (n, 2) atom indices, with (n, 2) k, req in
+        `bond_params` and `urey_bradley_params`
+    angles : np.ndarray
+        (n, 3) atom indices, with (n, 2) k, theteq in `angle_params`
+    dihedrals : np.ndarray
+        (n, 4) atom indices, with `dihedral_improper`,
+        `dihedral_ignore_end` and `dihedral_scaling` (scee, scnb).
+        Multi-term dihedrals are flattened into `dihedral_terms`,
+        indexing `dihedrals`, with (n_terms, 3) phi_k, per, phase in
+        `dihedral_term_params`
+    rb_torsions : np.ndarray
+        (n, 4) atom indices, with (n, 6) c0-c5 in `rb_params`,
+        `rb_ignore_end` and `rb_scaling`
+    impropers : np.ndarray
+        (n, 4) atom indices, with (n, 2) psi_k, psi_eq
+        in `improper_params`
+    adjusts : np.ndarray
+        (n, 2) atom indices, with (n, 3) sigma, epsilon, chgscale
+        in `adjust_params`
+    """
+    def __init__(self, structure):
+        self.signature = _structure_signature(structure)
+        self.combining_rule = structure.combining_rule
+        self.nrexcl = structure.nrexcl
+        self.n_atoms = len(structure.atoms)
+        self.update_coordinates(structure)
+
+        atoms = structure.atoms
+        self.charges = np.array([a.charge for a in atoms], dtype=np.float64)
+        self.masses = np.array([a.mass for a in atoms], dtype=np.float64)
+        self.atomic_numbers = np.array([a.atomic_number for a in atoms],
+                                        dtype=np.int32)
+        atom_types = [(str(a.type), a.epsilon, a.rmin, a.epsilon_14,
+                        a.rmin_14) for a in atoms]
+        types = {}
+        self.atom_types = np.array([types.setdefault(t, len(types))
+                                    for t in atom_types], dtype=np.int32)
+        self.type_names = np.array([t[0] for t in types], dtype=str)
+        self.type_params = np.array([t[1:] for t in types],
+                                    dtype=np.float64).reshape(-1, 4)
+
+        self.bonds, self.bond_params = _terms(structure.bonds, 2,
+                ['k', 'req'])
+        self.urey_bradleys, self.urey_bradley_params = _terms(
+                structure.urey_bradleys, 2, ['k', 'req'])
+        self.angles, self.angle_params = _terms(structure.angles, 3,
+                ['k', 'theteq'])
+        self.impropers, self.improper_params = _terms(structure.impropers, 4,
+                ['psi_k', 'psi_eq'])
+        self.rb_torsions, self.rb_params = _terms(structure.rb_torsions, 4,
+                ['c0', 'c1', 'c2', 'c3', 'c4', 'c5'])
+        self.rb_ignore_end = np.array([rb.ignore_end
+                        for rb in structure.rb_torsions], dtype=bool)
+        self.rb_scaling = np.array([_scaling(rb.type)
+                        for rb in structure.rb_torsions]).reshape(-1, 2)
+
+        self.dihedrals = _terms(structure.dihedrals, 4)[0]
+        self.dihedral_improper = np.array([d.improper
+                        for d in structure.dihedrals], dtype=bool)
+        self.dihedral_ignore_end = np.array([d.ignore_end
+                        for d in structure.dihedrals], dtype=bool)
+        self.dihedral_scaling = np.array([_scaling(d.type)
+                        for d in structure.dihedrals]).reshape(-1, 2)
+        terms, params = [], []
+        for i, dihedral in enumerate(structure.dihedrals):
+            if dihedral.type is None:
+                continue
+            for term in (dihedral.type if isinstance(dihedral.type, list)
+                            else [dihedral.type]):
+                terms.append(i)
+                params.append((term.phi_k, term.per, term.phase))
+        self.dihedral_terms = np.array(terms, dtype=np.int32)
+        self.dihedral_term_params = np.array(params,
+                                            dtype=np.float64).reshape(-1, 3)
+
+        self.adjusts, self.adjust_params = _terms(structure.adjusts, 2,
+                ['sigma', 'epsilon', 'chgscale'])
+        self.exclusion_partners = np.array(
+                [(atom.idx, partner.idx) for atom in atoms
+                    for partner in atom.exclusion_partners],
+                dtype=np.int32).reshape(-1, 2)
+        self._exceptions = None
+
+    def update_coordinates(self, structure):
+        """ Re-read coordinates and box from a parmed.Structure """
+        coordinates = structure.coordinates
+        if coordinates is not None:
+            coordinates = np.ascontiguousarray(coordinates, dtype=np.float64)
+        self.coordinates = coordinates
+        self.box = (None if structure.box is None
+                    else np.array(structure.box, dtype=np.float64))
+
+    @property
+    def sigma(self):
+        """ Per-atom LJ sigma (angstrom) """
+        return self.type_params[self.atom_types, 1] * 2**(5 / 6)
+
+    @property
+    def epsilon(self):
+        """ Per-atom LJ epsilon (kcal/mol) """
+        return self.type_params[self.atom_types, 0]
+
+    @property
+    def sigma_14(self):
+        return self.type_params[self.atom_types, 3] * 2**(5 / 6)
+
+    @property
+    def epsilon_14(self):
+        return self.type_params[self.atom_types, 2]
+
+    @property
+    def exceptions(self):
+        """ Excluded and scaled nonbonded pairs
+
+        1-2 and 1-3 pairs (out to nrexcl - 1 bonds) are excluded, and 1-4
+        pairs are scaled by `adjusts`, or by the scee/scnb of dihedrals,
+        following `parmed.Structure.createSystem`
+
+        Returns
+        -------
+        pairs : np.ndarray
+            (n_pairs, 2) atom indices, i < j
+        params : np.ndarray
+            (n_pairs, 3) chgprod, sigma, epsilon (kcal/mol) of scaled
+            pairs, NaN for excluded pairs
+        """
+        if self._exceptions is None:
+            self._exceptions = self._get_exceptions()
+        return self._exceptions
+
+    def _get_exceptions(self):
+        from commpare.reference.neighbors import bond_graph_pairs
+        n_atoms = self.n_atoms
+        # Later entries override earlier ones for the same pair
+        pairs, params = [], []
+        excluded = bond_graph_pairs(n_atoms, self.bonds,
+                                    max_separation=self.nrexcl - 1)
+        for separation_pairs in excluded.values():
+            pairs.append(separation_pairs)
+            params.append(np.full((len(separation_pairs), 3), np.nan))
+
+        if len(self.adjusts) == 0:
+            torsions = np.concatenate([self.dihedrals, self.rb_torsions])
+            scaling = np.concatenate([self.dihedral_scaling, self.rb_scaling])
+            ignore_end = np.concatenate([self.dihedral_ignore_end,
+                                        self.rb_ignore_end])
+            torsions, scaling = torsions[~ignore_end], scaling[~ignore_end]
+            if np.any(scaling == 0) or np.any(np.isnan(scaling)):
+                raise ValueError('Detected scaling constants of 0 for '
+                                'dihedral containing 1-4 info!')
+            i, j = torsions[:, 0], torsions[:, 3]
+            sigma_14, epsilon_14 = self.sigma_14, self.epsilon_14
+            if self.combining_rule == 'geometric':
+                sigprod = np.sqrt(sigma_14[i] * sigma_14[j])
+            else:
+                sigprod = 0.5 * (sigma_14[i] + sigma_14[j])
+            epsprod = np.sqrt(np.abs(epsilon_14[i] * epsilon_14[j]))
+            pairs.append(torsions[:, [0, 3]])
+            params.append(np.stack([self.charges[i] * self.charges[j] /
+                                    scaling[:, 0], sigprod,
+                                    epsprod / scaling[:, 1]], axis=1))
+
+        i, j = self.adjusts.T
+        pairs.append(self.adjusts)
+        params.append(np.stack([self.charges[i] * self.charges[j] *
+                                self.adjust_params[:, 2],
+                                self.adjust_params[:, 0],
+                                self.adjust_params[:, 1]], axis=1))
+        pairs.append(self.exclusion_partners)
+        params.append(np.full((len(self.exclusion_partners), 3), np.nan))
+
+        pairs = np.sort(np.concatenate(pairs).astype(np.int64), axis=1)
+        params = np.concatenate(params)
+        distinct = pairs[:, 0] != pairs[:, 1]
+        pairs, params = pairs[distinct], params[distinct]
+        codes = pairs[:, 0] * n_atoms + pairs[:, 1]
+        # Keep the last entry for each pair
+        _, last = np.unique(codes[::-1], return_index=True)
+        last = len(codes) - 1 - last
+        return pairs[last].astype(np.int32), params[last]
+
+    def hash(self, coordinates=True):
+        """ Content hash of the topology and parameters
+
+        Parameters
+        ----------
+        coordinates : bool
+            Include coordinates and box
+
+        Returns
+        -------
+        digest : str
+        """
+        h = hashlib.sha256()
+        h.update(repr((self.combining_rule, self.nrexcl,
+                        self.type_names.tolist())).encode())
+        for name in self._array_names(coordinates=coordinates):
+            value = getattr(self, name)
+            h.update(name.encode())
+            if value is None:
+                h.update(b'None')
+            else:
+                h.update(repr(value.shape).encode())
+                h.update(np.ascontiguousarray(value).tobytes())
+        return h.hexdigest()
+
+    def save(self, filename):
+        """ Write every array to a compressed .npz file """
+        arrays = {name: getattr(self, name) for name in self._array_names()
+                    if getattr(self, name) is not None}
+        np.savez_compressed(filename, combining_rule=self.combining_rule,
+                nrexcl=self.nrexcl, type_names=self.type_names, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """ StructureArrays written by `save` """
+        arrays = cls.__new__(cls)
+        with np.load(filename) as data:
+            for name in arrays._array_names():
+                setattr(arrays, name, data[name] if name in data else None)
+            arrays.type_names = data['type_names']
+            arrays.combining_rule = str(data['combining_rule'])
+            arrays.nrexcl = int(data['nrexcl'])
+        arrays.n_atoms = len(arrays.charges)
+        arrays.signature = None
+        arrays._exceptions = None
+        return arrays
+
+    def _array_names(self, coordinates=True):
+        names = ['charges', 'masses', 'atomic_numbers', 'atom_types',
+                'type_params', 'bonds', 'bond_params', 'urey_bradleys',
+                'urey_bradley_params', 'angles', 'angle_params',
+                'dihedrals', 'dihedral_improper', 'dihedral_ignore_end',
+                'dihedral_scaling', 'dihedral_terms', 'dihedral_term_params',
+                'rb_torsions', 'rb_params', 'rb_ignore_end', 'rb_scaling',
+                'impropers', 'improper_params', 'adjusts', 'adjust_params',
+                'exclusion_partners']
+        if coordinates:
+            names += ['coordinates', 'box']
+        return names
+
+
+def _terms(terms, n_atoms, param_names=None):
+    """ (n, n_atoms) int32 atom indices and (n, n_params) parameters
+    of a parmed TrackedList of valence terms """
+    attrs = ['atom{}'.format(i + 1) for i in range(n_atoms)]
+    idx = np.array([[getattr(term, attr).idx for attr in attrs]
+                    for term in terms], dtype=np.int32).reshape(-1, n_atoms)
+    if not param_names:
+        return idx, None
+    params = np.array([[getattr(term.type, name) for name in param_names]
+                        if term.type is not None
+                        else [np.nan] * len(param_names)
+                        for term in terms],
+                        dtype=np.float64).reshape(-1, len(param_names))
+    return idx, params
+
+def _scaling(dihedral_type):
+    """ 1-4 (scee, scnb) of a dihedral type, the first nonzero pair
+    for multi-term dihedrals, as in `parmed.Structure.createSystem` """
+    if dihedral_type is None:
+        return (np.nan, np.nan)
+    if isinstance(dihedral_type, list):
+        scee = scnb = 0
+        for term in dihedral_type:
+            scee, scnb = term.scee, term.scnb
+            if scee != 0 and scnb != 0:
+                break
+        return (scee, scnb)
+    return (dihedral_type.scee, dihedral_type.scnb)
+
+def _codes(values):
+    """ Integer code of each value, equal codes for equal values """
+    _, codes = np.unique(np.array(values, dtype=str), return_inverse=True)
+    return codes
@@ -0,0 +1,192 @@
+import pytest
+import mbuild as mb
+import foyer
+from mbuild.examples import Ethane, Alkane
+
+import commpare
+from commpare.tests.base_test import BaseTest
+
+
+class TestEnergyCache(BaseTest):
+    def test_hash(self):
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(Alkane(n=4))
+        digest = commpare.structure_hash(structure)
+        topology = commpare.topology_hash(structure)
+        assert digest == commpare.structure_hash(structure)
+
+        structure.atoms[0].xx += 0.1
+        assert digest != commpare.structure_hash(structure)
+        assert topology == commpare.topology_hash(structure)
+
+    def test_put_get(self):
+        cache = commpare.EnergyCache('energies.sqlite')
+        cache.put('key', 'gromacs', {'bond': 1.0, 'all': 2.0})
+        assert cache.get('key') == {'bond': 1.0, 'all': 2.0}
+        assert cache.get('missing') is None
+
+    def test_eviction(self):
+        cache = commpare.EnergyCache('energies.sqlite', max_entries=2)
+        for i in range(5):
+            cache.put(str(i), 'openmm', {'all': float(i)})
+        assert len(cache) == 2
+        assert cache.get('4') == {'all': 4.0}
+        assert cache.get('0') is None
+
+        cache = commpare.EnergyCache('energies.sqlite', max_age=0)
+        assert len(cache) == 0
+
+    def test_spawn_with_cache(self):
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(Alkane(n=4))
+        structure.box = [50, 50, 50, 90, 90, 90]
+        cache = commpare.EnergyCache('energies.sqlite')
+        first = commpare.spawn_engine_simulations(structure,
+                engines=['openmm'], cache=cache)
+        assert len(cache) == 1
+        second = commpare.spawn_engine_simulations(structure,
+                engines=['openmm'], cache=cache)
+        assert (first.values == second.values).all()
+
+    def test_key_digest(self):
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(Alkane(n=4))
+        cache = commpare.EnergyCache('energies.sqlite')
+        key = cache.key(structure, 'numpy', settings={'cutoff': 10})
+        digest = commpare.structure_hash(structure)
+        assert key == cache.key(structure, 'numpy', settings={'cutoff': 10},
+                                digest=digest)
+
+    def test_spawn_hashes_once(self, monkeypatch):
+        import commpare.cache
+        import commpare.conversion
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(Alkane(n=4))
+        structure.box = [50, 50, 50, 90, 90, 90]
+        extracted = []
+        def counting(structure, refresh=False,
+                     original=commpare.cache.get_structure_arrays):
+            if refresh and not isinstance(structure,
+                                          commpare.StructureArrays):
+                extracted.append(structure)
+            return original(structure, refresh=refresh)
+        monkeypatch.setattr(commpare.cache, 'get_structure_arrays', counting)
+        monkeypatch.setattr(commpare.conversion, 'get_structure_arrays',
+                            counting)
+        commpare.spawn_engine_simulations(structure,
+                engines=['numpy', 'openmm'], cache='energies.sqlite',
+                input_cache='artifacts', result_store='results')
+        assert len(extracted) == 1
+
+    def test_settings_hash_source(self, monkeypatch):
+        import commpare.mm_engines
+        digest = commpare.settings_hash('numpy', {'cutoff': 10})
+        assert digest == commpare.settings_hash('numpy', {'cutoff': 10})
+        assert commpare.get_engine_source_hash('numpy') != ''
+        monkeypatch.setattr(commpare.mm_engines, 'get_engine_source_hash',
+                            lambda engine: 'changed')
+        assert digest != commpare.settings_hash('numpy', {'cutoff': 10})
+
+    def test_cassandra_version(self, monkeypatch):
+        import os
+        import commpare.mm_engines
+        monkeypatch.setenv('PATH', os.getcwd())
+        commpare.mm_engines.get_engine_version.cache_clear()
+        assert commpare.get_engine_version('cassandra') == ''
+
+        with open('cassandra.exe', 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod('cassandra.exe', 0o755)
+        commpare.mm_engines.get_engine_version.cache_clear()
+        version = commpare.get_engine_version('cassandra')
+        assert version.startswith('cassandra.exe:')
+
+        with open('cassandra.exe', 'a') as f:
+            f.write('exit 0\n')
+        commpare.mm_engines.get_engine_version.cache_clear()
+        assert commpare.get_engine_version('cassandra') != version
+        commpare.mm_engines.get_engine_version.cache_clear()
+
+    def test_numpy_version(self, monkeypatch):
+        import commpare.cache
+        import commpare.mm_engines
+        commpare.mm_engines.get_engine_version.cache_clear()
+        version = commpare.get_engine_version('numpy')
+        assert version.startswith('commpare.reference:')
+        monkeypatch.setattr(commpare.cache, 'source_hash',
+                            lambda *modules: 'changed')
+        commpare.mm_engines.get_engine_version.cache_clear()
+        assert commpare.get_engine_version('numpy') != version
+        commpare.mm_engines.get_engine_version.cache_clear()
+
+
+class TestArtifactCache(BaseTest):
+    def test_store(self):
+        cache = commpare.ArtifactCache('artifacts')
+        with open('topol.tpr', 'w') as f:
+            f.write('tpr')
+        cached = cache.store('gromacs', 'key', 'topol.tpr', 'topol.tpr')
+        with open(cached) as f:
+            assert f.read() == 'tpr'
+        assert cached == cache.path('gromacs', 'key', 'topol.tpr')
+
+    def test_atomic_path(self):
+        import os
+        with commpare.atomic_path('out.txt') as tmp, open(tmp, 'w') as f:
+            f.write('done')
+        with pytest.raises(ValueError):
+            with commpare.atomic_path('out.txt') as tmp, open(tmp, 'w') as f:
+                f.write('partial')
+                raise ValueError()
+        with open('out.txt') as f:
+            assert f.read() == 'done'
+
+        for content in ['first', 'second']:
+            with commpare.atomic_path('library') as tmp:
+                os.makedirs(tmp)
+                with open(os.path.join(tmp, 'frag'), 'w') as f:
+                    f.write(content)
+        # A directory already in place is kept
+        with open(os.path.join('library', 'frag')) as f:
+            assert f.read() == 'first'
+        assert sorted(os.listdir('.')) == ['library', 'out.txt']
+
+    def test_open_artifact_cache(self):
+        assert commpare.open_artifact_cache(None) is None
+        assert commpare.open_artifact_cache(False) is None
+        cache = commpare.open_artifact_cache('artifacts')
+        assert cache.directory == 'artifacts'
+        assert commpare.open_artifact_cache(cache) is cache
+
+    def test_memory(self):
+        cache = commpare.ArtifactCache('artifacts', max_memory_entries=2)
+        for i in range(3):
+            cache.remember('hoomd', str(i), i)
+        assert cache.recall('hoomd', '0') is None
+        assert cache.recall('hoomd', '2') == 2
+
+    def test_known_topology(self):
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(Alkane(n=4))
+        cache = commpare.ArtifactCache('artifacts')
+        key = cache.key(structure, 'settings')
+        assert key == cache.key(structure, 'settings',
+                                digest=commpare.topology_hash(structure))
+        with cache.known_topology(structure, 'known'):
+            assert cache.key(structure, 'settings') == cache.key(
+                    structure, 'settings', digest='known')
+        assert cache.key(structure, 'settings') == key
+
+    def test_openmm_coordinates_only(self):
+        import commpare.openmm
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(Alkane(n=4))
+        structure.box = [50, 50, 50, 90, 90, 90]
+        cache = commpare.ArtifactCache('artifacts')
+        commpare.openmm.build_run_measure_openmm(structure, input_cache=cache)
+
+        structure.atoms[0].xx += 0.1
+        cached = commpare.openmm.build_run_measure_openmm(structure,
+                input_cache=cache)
+        fresh = commpare.openmm.build_run_measure_openmm(structure)
+        assert cached.values == pytest.approx(fresh.values)
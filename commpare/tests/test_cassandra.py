@@ -0,0 +1,136 @@
+import os
+import sys
+
+import numpy as np
+import mbuild as mb
+import foyer
+from mbuild.examples import Ethane, Methane
+
+import commpare
+from commpare.cassandra.cassandra_utils import (write_cassandra_inp,
+        get_inp_section, set_inp_section, fraglib_hash,
+        prepare_cassandra_fraglib, cassandra_species, write_cassandra_inputs,
+        cassandra_cutoff)
+from commpare.tests.base_test import BaseTest
+
+# Stands in for library_setup.py: writes a fragment library per species
+# holding its MCF, fills in the Fragment_Files section, and logs the
+# number of species it built
+FAKE_FRAGLIB_SETUP = """import os, sys
+with open(sys.argv[2]) as f:
+    inp = f.read()
+molecule_files = inp.split('# Molecule_Files\\n')[1].split('!')[0]
+lines = []
+for i, line in enumerate(molecule_files.split('\\n')[:-1]):
+    os.makedirs('species{}/fragments'.format(i + 1))
+    with open(line.split()[0]) as f:
+        mcf = f.read()
+    with open('species{}/fragments/frag_1_1.dat'.format(i + 1), 'w') as f:
+        f.write(mcf)
+    lines.append('species{}/fragments/frag_1_1.dat {}'.format(i + 1, i + 1))
+with open(sys.argv[2], 'w') as f:
+    f.write(inp.replace('# Fragment_Files\\n',
+            '# Fragment_Files\\n' + '\\n'.join(lines) + '\\n'))
+with open(os.path.join(os.path.dirname(sys.argv[0]), 'runs'), 'a') as f:
+    f.write(str(len(lines)))
+"""
+
+
+class TestCassandra(BaseTest):
+    def test_inp_sections(self):
+        inp_file, _ = write_cassandra_inp()
+        assert get_inp_section(inp_file, 'Molecule_Files') == 'structure.mcf 1'
+        assert get_inp_section(inp_file, 'Fragment_Files') == ''
+
+        set_inp_section(inp_file, 'Box_Info', '1\ncubic\n50.')
+        assert get_inp_section(inp_file, 'Box_Info') == '1\ncubic\n50.'
+        assert get_inp_section(inp_file, 'Temperature_Info') == '300.0'
+
+    def test_cutoff(self):
+        assert cassandra_cutoff() == 19.99
+        assert cassandra_cutoff([50, 40, 60, 90, 90, 90]) == 19.99
+        assert cassandra_cutoff([30, 20, 30, 90, 90, 90]) == 9.99
+
+        inp_file, _ = write_cassandra_inp()
+        assert get_inp_section(inp_file, 'VDW_Style') == 'lj cut 19.99'
+
+    def test_small_box(self):
+        ff = foyer.Forcefield(name='oplsaa')
+        compound = mb.fill_box(Ethane(), n_compounds=10, box=[2, 2, 2])
+        structure = ff.apply(compound)
+        structure.box = [20, 20, 20, 90, 90, 90]
+        inp_file, _, _, _ = write_cassandra_inputs(structure)
+        assert get_inp_section(inp_file, 'VDW_Style') == 'lj cut 9.99'
+        assert get_inp_section(inp_file, 'Charge_Style') == \
+                'coul ewald 9.99 1e-5'
+
+    def test_fraglib_hash(self):
+        with open('structure.mcf', 'w') as f:
+            f.write('mcf')
+        inp_file, _ = write_cassandra_inp()
+        digest = fraglib_hash(inp_file, 'structure.mcf')
+
+        set_inp_section(inp_file, 'Box_Info', '1\ncubic\n50.')
+        set_inp_section(inp_file, 'Molecule_Files', 'structure.mcf 10')
+        assert fraglib_hash(inp_file, 'structure.mcf') == digest
+        set_inp_section(inp_file, 'Temperature_Info', '350.0')
+        assert fraglib_hash(inp_file, 'structure.mcf') != digest
+        set_inp_section(inp_file, 'Temperature_Info', '300.0')
+        with open('structure.mcf', 'w') as f:
+            f.write('other mcf')
+        assert fraglib_hash(inp_file, 'structure.mcf') != digest
+
+    def test_fraglib_cache(self):
+        with open('library_setup.py', 'w') as f:
+            f.write(FAKE_FRAGLIB_SETUP)
+        fraglib_setup = os.path.abspath('library_setup.py')
+        cache = commpare.ArtifactCache(os.path.abspath('cache'))
+        top = os.getcwd()
+        runs = [[('a', 3)], [('a', 5), ('b', 2)], [('b', 1), ('a', 1)]]
+        for run, species in enumerate(runs):
+            os.mkdir(str(run))
+            os.chdir(str(run))
+            for name, _ in species:
+                for ext in ['mcf', 'pdb']:
+                    with open('{}.{}'.format(name, ext), 'w') as f:
+                        f.write(name)
+            inp_file, _ = write_cassandra_inp(
+                    [(name + '.mcf', count) for name, count in species])
+            prepare_cassandra_fraglib(sys.executable, fraglib_setup,
+                    'cassandra', inp_file,
+                    [name + '.mcf' for name, _ in species],
+                    [name + '.pdb' for name, _ in species],
+                    '.', input_cache=cache)
+            for i, (name, _) in enumerate(species):
+                with open('species{}/fragments/frag_1_1.dat'.format(i + 1)) as f:
+                    assert f.read() == name
+            assert get_inp_section(inp_file, 'Fragment_Files') == '\n'.join(
+                    'species{0}/fragments/frag_1_1.dat {0}'.format(i + 1)
+                    for i in range(len(species)))
+            assert not os.path.exists('fraglib_setup')
+            os.chdir(top)
+        # Only species not seen before are built
+        with open('runs') as f:
+            assert f.read() == '11'
+
+    def test_species(self):
+        ff = foyer.Forcefield(name='oplsaa')
+        compound = mb.fill_box([Ethane(), Methane()], n_compounds=[3, 2],
+                            box=[4, 4, 4])
+        structure = ff.apply(compound)
+        structure.box = [40, 40, 40, 90, 90, 90]
+        species = cassandra_species(structure)
+        assert [(len(molecule.atoms), count) 
+                for molecule, count, _ in species] == [(8, 3), (5, 2)]
+        order = np.concatenate([atoms for _, _, atoms in species])
+        assert sorted(order) == list(range(len(structure.atoms)))
+
+        inp_file, _, mcf_files, pdb_files = write_cassandra_inputs(structure)
+        assert mcf_files == ['species1.mcf', 'species2.mcf']
+        assert all(os.path.exists(pdb_file) for pdb_file in pdb_files)
+        assert get_inp_section(inp_file, 'Nbr_Species') == '2'
+        assert get_inp_section(inp_file, 'Molecule_Files') == \
+                'species1.mcf 3\nspecies2.mcf 2'
+        assert get_inp_section(inp_file, 'Box_Info') == '1\ncubic\n40.0'
+        assert get_inp_section(inp_file, 'Start_Type') == \
+                'read_config 3 2 structure.xyz'
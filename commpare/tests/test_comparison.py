@@ -0,0 +1,87 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import commpare
+from commpare.tests.base_test import BaseTest
+
+
+def _energies(n_structures, engines, seed=0):
+    rng = np.random.default_rng(seed)
+    terms = commpare.CANONICAL_COLUMNS
+    base = rng.normal(100, 50, (n_structures, 1, len(terms)))
+    values = np.repeat(base, len(engines), axis=1)
+    index = pd.MultiIndex.from_product([range(n_structures), engines],
+                                        names=['structure', 'engine'])
+    return pd.DataFrame(values.reshape(-1, len(terms)), index=index,
+                        columns=terms)
+
+class TestComparison(BaseTest):
+    def test_deviations(self):
+        energies = _energies(3, ['gromacs', 'openmm', 'numpy'])
+        energies.loc[(1, 'openmm'), 'bond'] += 1.0
+        deviations = commpare.compare_energies(energies)
+        # 3 structures, 7 terms, 3 engine pairs
+        assert len(deviations) == 3 * 7 * 3
+
+        flagged = deviations[deviations['flagged']]
+        assert len(flagged) == 2
+        assert set(flagged['structure']) == {1}
+        assert set(flagged['term']) == {'bond'}
+        assert np.allclose(flagged['abs_deviation'], 1.0)
+        assert 'openmm' in set(flagged['engine']) | set(flagged['other_engine'])
+
+    def test_reference(self):
+        energies = _energies(2, ['gromacs', 'openmm', 'numpy'])
+        deviations = commpare.compare_energies(energies, reference='numpy')
+        assert set(deviations['engine']) == {'numpy'}
+        assert set(deviations['other_engine']) == {'gromacs', 'openmm'}
+        with pytest.raises(ValueError):
+            commpare.compare_energies(energies, reference='hoomd')
+
+    def test_tolerances(self):
+        energies = _energies(1, ['gromacs', 'openmm'])
+        energies.loc[(0, 'openmm'), 'LJ'] += 0.5
+        deviations = commpare.compare_energies(energies)
+        assert deviations['flagged'].sum() == 1
+        deviations = commpare.compare_energies(energies, 
+                tolerances={'LJ': 1.0})
+        assert deviations['flagged'].sum() == 0
+
+    def test_missing_energies(self):
+        energies = _energies(2, ['gromacs', 'cassandra'])
+        energies.loc[(slice(None), 'cassandra'), 'bond'] = np.nan
+        energies['error'] = None
+        deviations = commpare.compare_energies(energies)
+        assert 'bond' not in set(deviations['term'])
+        assert len(deviations) == 2 * 6
+
+    def test_single_structure(self):
+        energies = _energies(1, ['gromacs', 'openmm']).loc[0]
+        deviations = commpare.compare_energies(energies)
+        assert len(deviations) == 7
+
+    def test_worst_offenders(self):
+        energies = _energies(50, ['gromacs', 'openmm'])
+        energies.loc[(10, 'openmm'), 'angle'] += 5
+        energies.loc[(20, 'openmm'), 'QQ'] += 50
+        deviations = commpare.compare_energies(energies)
+        offenders = commpare.worst_offenders(deviations)
+        assert list(offenders['structure']) == [10, 20]
+        assert len(commpare.worst_offenders(deviations, n=5,
+                                            flagged_only=False)) == 5
+
+        summary = commpare.summarize_deviations(deviations)
+        assert summary.loc[('gromacs', 'openmm', 'angle'), 'flagged'] == 1
+        assert summary['compared'].sum() == 50 * 7
+
+    def test_large(self):
+        engines = ['gromacs', 'openmm', 'hoomd', 'numpy', 'cassandra']
+        energies = _energies(20000, engines)
+        start = time.perf_counter()
+        deviations = commpare.compare_energies(energies)
+        commpare.worst_offenders(deviations)
+        assert time.perf_counter() - start < 1.0
+        assert len(deviations) == 20000 * 7 * 10
@@ -18,3 +18,67 @@ class TestConversion(BaseTest):
         df = commpare.spawn_engine_simulations(structure,
                 hoomd_kwargs={'ref_distance':10, 'ref_energy':1/4.184})
         assert df is not None
+
+    def test_parallel_conversions(self):
+        # Engines fanned out to worker processes should agree with serial
+        eth = Alkane(n=10)
+        cmpd = mb.fill_box(eth, n_compounds=10, box=[10,10,10])
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(cmpd)
+
+        hoomd_kwargs = {'ref_distance':10, 'ref_energy':1/4.184}
+        serial = commpare.spawn_engine_simulations(structure,
+                hoomd_kwargs=hoomd_kwargs)
+        parallel = commpare.spawn_engine_simulations(structure,
+                hoomd_kwargs=hoomd_kwargs, parallel=True, max_workers=2)
+        assert list(parallel.index) == list(serial.index)
+        if 'error' not in parallel:
+            assert parallel['all'].values == pytest.approx(
+                    serial['all'].values)
+
+    def test_parallel_engine_failure(self):
+        eth = Alkane(n=10)
+        cmpd = mb.fill_box(eth, n_compounds=10, box=[10,10,10])
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(cmpd)
+
+        # HOOMD without its kwargs still runs, but a bogus kwarg raises
+        df = commpare.spawn_engine_simulations(structure, engines=['hoomd'],
+                hoomd_kwargs={'not_a_kwarg': 1}, parallel=True)
+        assert 'hoomd' in df.index
+        assert 'error' in df
+
+    def test_batch_conversions(self):
+        structures = {}
+        ff = foyer.Forcefield(name='oplsaa')
+        for n in [3, 4]:
+            cmpd = mb.fill_box(Alkane(n=n), n_compounds=5, box=[5,5,5])
+            structures['Alkane, n={}'.format(n)] = ff.apply(cmpd)
+
+        records = list(commpare.spawn_engine_simulations_batch(structures,
+                hoomd_kwargs={'ref_distance':10, 'ref_energy':1/4.184}))
+        for record in records:
+            assert record['structure'] in structures
+            assert 'engine' in record
+
+        df = commpare.collect_energies(records)
+        assert len(df) == len(records)
+        assert df.index.names == ['structure', 'engine']
+
+    @pytest.mark.parametrize("parallel", [False, True])
+    def test_duplicate_engines(self, parallel):
+        import parmed as pmd
+        structure = pmd.Structure()
+        for i in range(2):
+            structure.add_atom(pmd.Atom(name='Ar', charge=0,
+                                        atomic_number=18), 'AR', i + 1)
+        structure.coordinates = [[0, 0, 0], [4, 0, 0]]
+        structure.box = [20, 20, 20, 90, 90, 90]
+
+        df = commpare.spawn_engine_simulations(structure,
+                engines=['numpy', 'numpy'], parallel=parallel)
+        assert list(df.index) == ['numpy']
+        records = list(commpare.spawn_engine_simulations_batch(
+                {'argon': structure}, engines=['numpy', 'numpy'],
+                parallel=parallel))
+        assert [record['engine'] for record in records] == ['numpy']
@@ -0,0 +1,49 @@
+import itertools
+import pytest
+import numpy as np
+
+from commpare.reference.ewald import (COULOMB_CONSTANT, ewald_alpha,
+        ewald_energies, pme_grid_size)
+from commpare.tests.base_test import BaseTest
+
+MADELUNG_NACL = 1.747565
+
+def rock_salt(n_cells, spacing):
+    """ NaCl lattice of n_cells^3 conventional cells """
+    sites = np.array(list(itertools.product(range(2 * n_cells), repeat=3)))
+    charges = np.where(sites.sum(axis=1) % 2 == 0, 1.0, -1.0)
+    box = [2 * n_cells * spacing] * 3 + [90, 90, 90]
+    return sites * spacing, charges, box
+
+class TestEwald(BaseTest):
+    @pytest.mark.parametrize('method', ['ewald', 'pme'])
+    def test_madelung(self, method):
+        spacing = 2.82
+        xyz, charges, box = rock_salt(3, spacing)
+        energies = ewald_energies(xyz, charges, box, cutoff=8.0, 
+                method=method, ewald_rtol=1e-6, fourier_spacing=0.5,
+                pme_order=6)
+        expected = -len(xyz) / 2 * MADELUNG_NACL * COULOMB_CONSTANT / spacing
+        assert energies['total'] == pytest.approx(expected, rel=1e-4)
+        assert energies['background'] == pytest.approx(0)
+
+    def test_methods_agree(self):
+        rng = np.random.default_rng(0)
+        xyz = rng.uniform(0, 25, (200, 3))
+        charges = rng.uniform(-1, 1, 200)
+        box = [25, 25, 25, 90, 90, 90]
+        exclusions = [[0, 1], [2, 3]]
+        ewald = ewald_energies(xyz, charges, box, 9.0, exclusions, 
+                method='ewald')
+        pme = ewald_energies(xyz, charges, box, 9.0, exclusions,
+                method='pme', fourier_spacing=0.5, pme_order=6)
+        for term in ['real', 'self', 'exclusion', 'background']:
+            assert ewald[term] == pytest.approx(pme[term])
+        assert ewald['reciprocal'] == pytest.approx(pme['reciprocal'],
+                                                    rel=1e-5)
+
+    def test_parameters(self):
+        from scipy.special import erfc
+        alpha = ewald_alpha(10, 1e-5)
+        assert erfc(alpha * 10) == pytest.approx(1e-5)
+        assert pme_grid_size([31, 40, 22, 90, 90, 90], 1.0) == (32, 40, 24)
@@ -0,0 +1,70 @@
+import os
+import pytest
+import foyer
+
+import commpare
+import commpare.forcefields
+from commpare.tests.base_test import BaseTest
+
+
+class TestForcefields(BaseTest):
+    @pytest.fixture(autouse=True)
+    def clear_memo(self):
+        commpare.forcefields._forcefields.clear()
+        yield
+        commpare.forcefields._forcefields.clear()
+
+    def test_identify_is_lazy(self):
+        forcefields = commpare.identify_forcefields()
+        assert 'OPLSAA' in forcefields
+        assert 'OPLSAA' in list(forcefields)
+        assert len(commpare.forcefields._forcefields) == 0
+
+    def test_names_found_once(self, monkeypatch):
+        found = []
+        def counting(name, original=commpare.forcefields.forcefield_xml):
+            found.append(name)
+            return original(name)
+        monkeypatch.setattr(commpare.forcefields, 'forcefield_xml', counting)
+        forcefields = commpare.identify_forcefields()
+        for _ in range(3):
+            assert 'OPLSAA' in forcefields
+            assert len(forcefields) == len(list(forcefields))
+        assert len(found) == len(commpare.forcefields.FOYER_FORCEFIELDS)
+
+    def test_memoized(self):
+        ff = commpare.get_forcefield('OPLSAA')
+        assert isinstance(ff, foyer.Forcefield)
+        assert commpare.get_forcefield('OPLSAA') is ff
+        assert commpare.identify_forcefields()['OPLSAA'] is ff
+
+    def test_unknown(self):
+        with pytest.raises(KeyError):
+            commpare.get_forcefield('not-a-forcefield')
+        with pytest.raises(KeyError):
+            commpare.identify_forcefields()['not-a-forcefield']
+
+    def test_disk_cache(self):
+        cache = commpare.ArtifactCache('cache')
+        ff = commpare.get_forcefield('OPLSAA', cache=cache)
+        pickles = [os.path.join(root, name)
+                    for root, _, names in os.walk('cache') for name in names
+                    if name == 'forcefield.pkl']
+        assert len(pickles) == 1
+
+        commpare.forcefields._forcefields.clear()
+        loaded = commpare.get_forcefield('OPLSAA', cache=cache)
+        assert loaded is not ff
+        assert loaded.atomTypeDefinitions == ff.atomTypeDefinitions
+
+    def test_parametrize_smiles(self):
+        cache = commpare.ArtifactCache('cache')
+        structure = commpare.parametrize_smiles('CCO', 'OPLSAA', cache=cache)
+        assert len(structure.atoms) == 9
+        assert structure.box is not None
+
+        cached = commpare.parametrize_smiles('CCO', 'OPLSAA', cache=cache)
+        assert cached is not structure
+        assert (commpare.get_structure_arrays(cached).hash() ==
+                commpare.get_structure_arrays(structure).hash())
+        assert list(cached.box) == list(structure.box)
@@ -1,3 +1,4 @@
+import pytest
 import mbuild as mb
 import foyer
 from mbuild.examples import Ethane, Alkane
@@ -17,3 +18,114 @@ class TestGromacs(BaseTest):
         assert 'angle' in df
         assert 'dihedral' in df
         assert 'nonbond' in df
+
+    def test_frames(self):
+        import numpy as np
+        eth = Alkane(n=10)
+        cmpd = mb.fill_box(eth, n_compounds=10, box=[10,10,10])
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(cmpd)
+        single = commpare.gromacs.build_run_measure_gromacs(structure)
+
+        xyz = np.array([structure.coordinates] * 3)
+        xyz[1] += 0.01
+        df = commpare.gromacs.build_run_measure_gromacs_frames(structure, xyz)
+        assert len(df) == 3
+        assert df.loc[0, 'bond'] == pytest.approx(single.loc['gromacs', 'bond'],
+                                                    rel=1e-4)
+        assert df.loc[2, 'all'] == pytest.approx(df.loc[0, 'all'])
+
+    def test_edr(self):
+        import numpy as np
+        from commpare.gromacs.gromacs_utils import (GMX_ENERGY_TERMS,
+                write_gmx_trr, prepare_gmx_tpr, detect_gmx_binaries,
+                run_mdrun)
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(Alkane(n=6))
+        structure.box = [20, 20, 20, 90, 90, 90]
+        xyz = np.array([structure.coordinates] * 4)
+        write_gmx_trr('frames.trr', xyz, np.tile(structure.box, (4, 1)))
+        grompp, mdrun = detect_gmx_binaries()
+        output = prepare_gmx_tpr(structure, grompp)
+        output = run_mdrun(mdrun, output=output, rerun='frames.trr')
+
+        names = commpare.gromacs.read_edr_names(output + '.edr')
+        assert 'Potential' in names
+        with commpare.gromacs.EdrReader(output + '.edr',
+                terms=GMX_ENERGY_TERMS + ['not a term']) as reader:
+            assert 'not a term' not in reader.terms
+            assert set(reader.terms) <= set(names)
+            times, energies = reader.read()
+        assert energies.shape == (4, len(reader.terms))
+        assert np.allclose(energies, energies[0])
+
+        streamed = list(commpare.gromacs.iter_edr_frames(output + '.edr',
+                                                        terms=['Potential']))
+        assert len(streamed) == 4
+        first = commpare.gromacs.get_gmx_energy(output + '.edr')
+        assert streamed[0][1][0] == pytest.approx(first['gromacs']['all'])
+
+    def test_compact_topology(self):
+        from mbuild.examples import Ethane
+        ff = foyer.Forcefield(name='oplsaa')
+        cmpd = mb.fill_box([Alkane(n=4), Ethane()], n_compounds=[20, 10],
+                            box=[4, 4, 4])
+        structure = ff.apply(cmpd)
+        molecules = commpare.unique_molecules(structure)
+        assert sorted(len(copies) for _, copies in molecules) == [10, 20]
+
+        commpare.gromacs.write_gmx_top(structure, 'structure.top')
+        with open('structure.top') as f:
+            top = f.read()
+        assert top.count('[ moleculetype ]') == 2
+        counts = [int(line.split()[1]) for line in
+                    top.split('[ molecules ]')[1].splitlines()
+                    if line.strip() and not line.startswith(';')]
+        assert sum(counts) == 30
+
+        df = commpare.gromacs.build_run_measure_gromacs(structure)
+        assert 'all' in df
+
+    def test_tpr_key_box(self):
+        from commpare.gromacs.gromacs_utils import _tpr_key
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(Alkane(n=4))
+        structure.box = [40, 40, 40, 90, 90, 90]
+        cache = commpare.ArtifactCache('artifacts')
+        key = _tpr_key(cache, structure, 'gmx')
+
+        structure.atoms[0].xx += 0.1
+        assert _tpr_key(cache, structure, 'gmx') == key
+        # grompp sizes the PME grid from the box
+        structure.box = [50, 50, 50, 90, 90, 90]
+        assert _tpr_key(cache, structure, 'gmx') != key
+
+    def test_default_boxes(self):
+        import numpy as np
+        import mdtraj
+        from commpare.gromacs.gromacs_utils import (_default_gmx_boxes,
+                                                    write_gmx_trr)
+        xyz = np.zeros((2, 3, 3))
+        xyz[:, 1] = [10, 20, 30]
+        xyz[1] *= 2
+        boxes = _default_gmx_boxes(xyz)
+        assert boxes.tolist() == [[15, 25, 35, 90, 90, 90],
+                                  [25, 45, 65, 90, 90, 90]]
+        write_gmx_trr('frames.trr', xyz, boxes)
+        with mdtraj.formats.TRRTrajectoryFile('frames.trr') as trr:
+            _, _, _, box_vectors, _ = trr.read()
+        assert np.diagonal(box_vectors, axis1=1, axis2=2) == (
+                pytest.approx(boxes[:, :3] / 10))
+
+    def test_edr_block_frames(self):
+        import os
+        # From pyedr's test data, frames holding only restraint data
+        # blocks are interleaved with the energy frames
+        edrfile = os.path.join(os.path.dirname(__file__), 'files',
+                                'blocks.edr')
+        times, energies = commpare.gromacs.EdrReader(edrfile).read()
+        assert len(times) == 11
+        assert energies.shape[1] == len(
+                commpare.gromacs.read_edr_names(edrfile))
+        df = commpare.gromacs.get_gmx_energy(edrfile, all_frames=True)
+        assert len(df) == 11
@@ -1,6 +1,8 @@
+import pytest
 import mbuild as mb
 import foyer
 from mbuild.examples import Ethane, Alkane
+import commpare
 import commpare.hoomd
 
 from commpare.tests.base_test import BaseTest
@@ -18,3 +20,25 @@ class TestHoomd(BaseTest):
         assert 'angle' in df
         assert 'dihedral' in df
         assert 'nonbond' in df
+
+    @pytest.mark.parametrize("shift_coords", [True, False])
+    def test_context_reuse(self, shift_coords):
+        eth = Alkane(n=10)
+        cmpd = mb.fill_box(eth, n_compounds=10, box=[10,10,10])
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(cmpd)
+        cache = commpare.ArtifactCache('artifacts')
+        commpare.hoomd.build_run_measure_hoomd(structure, input_cache=cache,
+                ref_energy=1/4.184, ref_distance=10,
+                shift_coords=shift_coords)
+
+        structure.atoms[0].xx += 0.1
+        cached = commpare.hoomd.build_run_measure_hoomd(structure, 
+                input_cache=cache, ref_energy=1/4.184, ref_distance=10,
+                shift_coords=shift_coords)
+        fresh = commpare.hoomd.build_run_measure_hoomd(structure, 
+                ref_energy=1/4.184, ref_distance=10,
+                shift_coords=shift_coords)
+        assert cached.values == pytest.approx(fresh.values)
+        assert cached['nonbond'].values == pytest.approx(
+                (cached['LJ'] + cached['QQ']).values)
@@ -1,8 +1,53 @@
+import os
+import sys
+import subprocess
+import pandas as pd
+import parmed
 import commpare
+import commpare.mm_engines
 from commpare.tests.base_test import BaseTest
+
+
+def constant_engine(structure, input_cache=None, **kwargs):
+    return pd.DataFrame.from_dict({'constant': {'all': kwargs.get('value',
+                                                                    0.0)}},
+                                    orient='index')
+
 class TestEngines(BaseTest):
 
     def test_check(self):
         found_engines = commpare.identify_engines()
         assert found_engines is not None
 
+    def test_detection_does_not_import(self):
+        code = ("import sys, commpare; commpare.identify_engines(); "
+                "print(any(m in sys.modules for m in "
+                "['simtk', 'openmm', 'hoomd', 'mbuild', 'foyer']))")
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(
+                                    os.path.dirname(commpare.__file__)))
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                    env=env, universal_newlines=True)
+        assert out.strip() == 'False'
+
+    def test_cached(self):
+        engines = commpare.identify_engines()
+        engines.append('not an engine')
+        assert 'not an engine' not in commpare.identify_engines()
+
+    def test_registry(self):
+        assert commpare.mm_engines.get_engine('not an engine') is None
+        assert callable(commpare.mm_engines.get_engine('numpy'))
+
+        try:
+            commpare.mm_engines.register_engine('constant', constant_engine)
+            df = commpare.spawn_engine_simulations(parmed.Structure(),
+                    engines=['constant'])
+            assert df.loc['constant', 'all'] == 0.0
+
+            commpare.mm_engines.register_engine('constant',
+                    'commpare.tests.test_md_engines:constant_engine')
+            engine = commpare.mm_engines.get_engine('constant')
+            assert engine.__name__ == 'constant_engine'
+        finally:
+            commpare.mm_engines._registered_engines.pop('constant', None)
+            commpare.mm_engines.get_engine.cache_clear()
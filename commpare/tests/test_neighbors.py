@@ -0,0 +1,53 @@
+import pytest
+import numpy as np
+
+from commpare.reference.neighbors import (NeighborList, bond_graph_pairs,
+        box_matrix, cell_list_pairs, minimum_image)
+from commpare.tests.base_test import BaseTest
+
+
+def brute_force_pairs(xyz, cutoff, box=None):
+    i, j = np.triu_indices(len(xyz), 1)
+    r = np.linalg.norm(minimum_image(xyz[j] - xyz[i], box_matrix(box)), 
+                        axis=1)
+    return set(zip(i[r < cutoff], j[r < cutoff]))
+
+class TestNeighbors(BaseTest):
+    @pytest.mark.parametrize('box', [[30, 30, 30, 90, 90, 90],
+                                    [30, 25, 28, 70, 80, 100],
+                                    [12, 12, 12, 90, 90, 90],
+                                    None])
+    def test_cell_list(self, box):
+        xyz = np.random.default_rng(0).uniform(-5, 35, (1000, 3))
+        i, j, r = cell_list_pairs(xyz, 5.0, box)
+        assert np.all(i < j)
+        assert set(zip(i, j)) == brute_force_pairs(xyz, 5.0, box)
+
+    def test_cutoff_too_large(self):
+        xyz = np.zeros((2, 3))
+        with pytest.raises(ValueError):
+            cell_list_pairs(xyz, 6.0, [10, 10, 10, 90, 90, 90])
+
+    def test_bond_graph(self):
+        # Five-membered ring with a branch
+        bonds = [[0, 1], [1, 2], [2, 3], [3, 4], [4, 0], [2, 5]]
+        pairs = bond_graph_pairs(6, bonds)
+        assert len(pairs[1]) == 6
+        assert set(map(tuple, pairs[2].tolist())) == {(0, 2), (0, 3), 
+                (1, 3), (1, 4), (1, 5), (2, 4), (3, 5)}
+        assert set(map(tuple, pairs[3].tolist())) == {(0, 5), (4, 5)}
+
+    def test_neighbor_list_reuse(self):
+        rng = np.random.default_rng(0)
+        box = [30, 30, 30, 90, 90, 90]
+        xyz = rng.uniform(0, 30, (1000, 3))
+        neighbor_list = NeighborList(6.0, skin=2.0, exclusions=[[0, 1]])
+        for _ in range(3):
+            xyz = xyz + rng.normal(0, 0.05, xyz.shape)
+            i, j, r = neighbor_list.get_pairs(xyz, box)
+        assert neighbor_list.n_builds == 1
+        expected = brute_force_pairs(xyz, 6.0, box) - {(0, 1)}
+        assert set(zip(i, j)) == expected
+
+        neighbor_list.get_pairs(xyz + 1.5, box)
+        assert neighbor_list.n_builds == 2
@@ -1,3 +1,4 @@
+import pytest
 import mbuild as mb
 import foyer
 from mbuild.examples import Ethane, Alkane
@@ -17,3 +18,90 @@ class TestOpenMM(BaseTest):
         assert 'angle' in df
         assert 'dihedral' in df
         assert 'nonbond' in df
+
+    def test_frames(self):
+        import numpy as np
+        eth = Alkane(n=10)
+        cmpd = mb.fill_box(eth, n_compounds=10, box=[10,10,10])
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(cmpd)
+        single = commpare.openmm.build_run_measure_openmm(structure)
+
+        xyz = np.array([structure.coordinates] * 3)
+        xyz[1] += 0.01
+        df = commpare.openmm.build_run_measure_openmm_frames(structure, xyz)
+        assert len(df) == 3
+        assert df.loc[0, 'all'] == pytest.approx(single.loc['openmm', 'all'])
+        assert df.loc[2, 'all'] == pytest.approx(df.loc[0, 'all'])
+
+    def test_decomposition(self):
+        eth = Alkane(n=10)
+        cmpd = mb.fill_box(eth, n_compounds=10, box=[10,10,10])
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(cmpd)
+        first = commpare.openmm.build_run_measure_openmm(structure)
+        assert first.loc['openmm', 'nonbond'] == pytest.approx(
+                first.loc['openmm', 'LJ'] + first.loc['openmm', 'QQ'])
+
+        # Repeated evaluations on one context must agree
+        import simtk.openmm as openmm
+        omm_system = commpare.openmm.create_omm_system(structure)
+        omm_context = openmm.Context(omm_system, openmm.VerletIntegrator(1.0))
+        omm_context.setPositions(structure.positions)
+        groups = commpare.openmm.get_omm_force_groups(omm_system)
+        energies = commpare.openmm.get_omm_energies(groups, omm_context)
+        again = commpare.openmm.get_omm_energies(groups, omm_context)
+        assert energies == again
+        assert energies['all'] == pytest.approx(first.loc['openmm', 'all'])
+
+    @pytest.mark.parametrize("combining_rule", ['geometric', 'lorentz'])
+    def test_decomposition_independent(self, combining_rule):
+        import parmed
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(Alkane(n=4))
+        structure.box = [50, 50, 50, 90, 90, 90]
+        structure.combining_rule = combining_rule
+        df = commpare.openmm.build_run_measure_openmm(structure)
+
+        # LJ and QQ against systems without charges or without epsilons,
+        # where everything but the bonded terms is a single component
+        no_charges = structure.copy(parmed.Structure)
+        for atom in no_charges.atoms:
+            atom.charge = 0.0
+        no_epsilons = structure.copy(parmed.Structure)
+        for atom in no_epsilons.atoms:
+            atom.epsilon = 0.0
+            atom.epsilon_14 = 0.0
+        for term, other, copied in [('LJ', 'QQ', no_charges),
+                                    ('QQ', 'LJ', no_epsilons)]:
+            single = commpare.openmm.build_run_measure_openmm(copied)
+            single = single.loc['openmm']
+            assert single[other] == pytest.approx(0.0, abs=1e-6)
+            assert df.loc['openmm', term] == pytest.approx(single['all']
+                    - single['bond'] - single['angle'] - single['dihedral'])
+
+    @pytest.mark.parametrize("platform", ['Reference', 'auto'])
+    def test_platform(self, platform):
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(Alkane(n=4))
+        structure.box = [50, 50, 50, 90, 90, 90]
+        default = commpare.openmm.build_run_measure_openmm(structure)
+        df = commpare.openmm.build_run_measure_openmm(structure,
+                platform=platform, platform_properties={'Threads': 1})
+        assert df.loc['openmm', 'all'] == pytest.approx(
+                default.loc['openmm', 'all'], rel=1e-4)
+
+    def test_platform_cache_properties(self, monkeypatch):
+        import simtk.openmm as openmm
+        import simtk.unit as unit
+        import commpare.openmm.openmm_utils as openmm_utils
+        monkeypatch.setattr(openmm_utils, '_omm_auto_platforms', {})
+        omm_system = openmm.System()
+        omm_system.addParticle(1.0)
+        positions = [[0, 0, 0]] * unit.nanometer
+        for properties in [None, {'Threads': 1}, {'Threads': '1'},
+                           {'Threads': 2}]:
+            commpare.openmm.select_omm_platform(omm_system, positions,
+                                                properties)
+        # Benchmarked once per distinct set of platform properties
+        assert len(openmm_utils._omm_auto_platforms) == 3
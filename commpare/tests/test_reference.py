@@ -0,0 +1,85 @@
+import pytest
+import mbuild as mb
+import foyer
+from mbuild.examples import Ethane, Alkane
+import commpare
+import commpare.reference
+
+from commpare.tests.base_test import BaseTest
+
+
+class TestReference(BaseTest):
+    def test_opls(self):
+        eth = Alkane(n=10)
+        cmpd = mb.fill_box(eth, n_compounds=10, box=[10,10,10])
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(cmpd)
+        df = commpare.reference.build_run_measure_numpy(structure)
+        assert list(df.index) == ['numpy']
+        assert 'bond' in df
+        assert 'angle' in df
+        assert 'dihedral' in df
+        assert 'nonbond' in df
+        assert df.loc['numpy', 'all'] == pytest.approx(
+                df.loc['numpy', ['bond', 'angle', 'dihedral', 
+                                'nonbond']].sum())
+
+    def test_against_openmm(self):
+        import commpare.openmm
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(Alkane(n=6))
+        reference = commpare.reference.build_run_measure_numpy(structure)
+        omm = commpare.openmm.build_run_measure_openmm(structure)
+        for key in ['bond', 'angle', 'dihedral', 'all']:
+            assert reference.loc['numpy', key] == pytest.approx(
+                    omm.loc['openmm', key], rel=1e-5, abs=1e-3)
+
+    def test_cutoff(self):
+        eth = Alkane(n=10)
+        cmpd = mb.fill_box(eth, n_compounds=10, box=[10,10,10])
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(cmpd)
+        full = commpare.reference.build_run_measure_numpy(structure)
+        cut = commpare.reference.build_run_measure_numpy(structure, 
+                cutoff=1e-3)
+        # Only excluded and 1-4 pairs remain within a vanishing cutoff
+        assert cut.loc['numpy', 'bond'] == pytest.approx(
+                full.loc['numpy', 'bond'])
+        assert cut.loc['numpy', 'LJ'] != pytest.approx(
+                full.loc['numpy', 'LJ'])
+
+    def test_spawn(self):
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(Alkane(n=4))
+        df = commpare.spawn_engine_simulations(structure, engines=['numpy'])
+        assert list(df.index) == ['numpy']
+
+    def test_frames(self):
+        import numpy as np
+        eth = Alkane(n=10)
+        cmpd = mb.fill_box(eth, n_compounds=10, box=[10,10,10])
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(cmpd)
+        single = commpare.reference.build_run_measure_numpy(structure, 
+                cutoff=9)
+
+        xyz = np.array([structure.coordinates] * 3)
+        xyz[1] += 0.01
+        df = commpare.reference.build_run_measure_numpy_frames(structure, 
+                xyz, cutoff=9)
+        assert len(df) == 3
+        assert df.loc[0, 'all'] == pytest.approx(single.loc['numpy', 'all'])
+        assert df.loc[2, 'all'] == pytest.approx(df.loc[0, 'all'])
+
+    def test_ewald(self):
+        eth = Alkane(n=10)
+        cmpd = mb.fill_box(eth, n_compounds=10, box=[10,10,10])
+        ff = foyer.Forcefield(name='oplsaa')
+        structure = ff.apply(cmpd)
+        terms = commpare.reference.get_ewald_terms(structure, 9, 
+                method='ewald')
+        df = commpare.reference.build_run_measure_numpy(structure, cutoff=9,
+                coulomb='pme', ewald_kwargs={'fourier_spacing': 0.5,
+                                            'pme_order': 6})
+        assert df.loc['numpy', 'QQ'] == pytest.approx(terms['total'], 
+                                                        rel=1e-4)
@@ -0,0 +1,168 @@
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+import commpare
+from commpare.tests.base_test import BaseTest
+
+
+def _record(structure, engine, energy=1.0, **extra):
+    record = {'structure': structure, 'engine': engine}
+    record.update({term: energy for term in commpare.CANONICAL_COLUMNS})
+    record.update(extra)
+    return record
+
+class TestResultStore(BaseTest):
+    def test_append_and_query(self):
+        with commpare.ResultStore('results',
+                metadata={'forcefield': 'OPLSAA'}) as store:
+            for engine in ['gromacs', 'openmm', 'numpy']:
+                store.append(_record('ethane', engine),
+                            settings_hash='abc', engine_version='1.0')
+            store.append(_record('propane', 'openmm'), forcefield='GAFF')
+        assert os.path.isdir(os.path.join('results', 'engine=gromacs'))
+
+        store = commpare.ResultStore('results')
+        assert len(store) == 4
+        results = store.query(engine='openmm')
+        assert sorted(results['structure']) == ['ethane', 'propane']
+        results = store.query(engine=['openmm', 'numpy'], forcefield='OPLSAA')
+        assert sorted(results['engine']) == ['numpy', 'openmm']
+        assert (results['settings_hash'] == 'abc').all()
+        results = store.query(structure='propane', columns=['engine', 'all'])
+        assert list(results.columns) == ['engine', 'all']
+        assert len(store.query(engine='hoomd')) == 0
+
+    def test_buffered_appends(self):
+        store = commpare.ResultStore('results', buffer_size=2)
+        store.append(_record(0, 'openmm'))
+        assert not os.path.exists(os.path.join('results', 'engine=openmm'))
+        store.append(_record(1, 'openmm'))
+        assert os.path.exists(os.path.join('results', 'engine=openmm'))
+
+        store.append(_record(2, 'openmm'))
+        # Queries flush buffered rows first
+        results = store.query()
+        assert sorted(results['structure']) == ['0', '1', '2']
+
+    def test_mixed_columns(self):
+        with commpare.ResultStore('results') as store:
+            store.append(_record('a', 'gromacs', time_grompp_wall=0.5))
+        with commpare.ResultStore('results') as store:
+            store.append(_record('a', 'hoomd', energy=np.nan,
+                                error='hoomd failed'))
+            store.append(_record('b', 'hoomd', energy='N/A'))
+
+        results = commpare.ResultStore('results').query()
+        results = results.set_index(['structure', 'engine'])
+        assert results.loc[('a', 'gromacs'), 'time_grompp_wall'] == 0.5
+        assert np.isnan(results.loc[('a', 'hoomd'), 'time_grompp_wall'])
+        assert results.loc[('a', 'hoomd'), 'error'] == 'hoomd failed'
+        assert np.isnan(results.loc[('b', 'hoomd'), 'bond'])
+
+    def test_missing_columns(self):
+        store = commpare.ResultStore('results')
+        store.append(_record('ethane', 'openmm'))
+        results = store.query(forcefield='OPLSAA')
+        assert len(results) == 0
+        assert 'forcefield' in results
+        assert store.query()['forcefield'].isna().all()
+
+        store = commpare.ResultStore('unlabelled', partition_by=())
+        store.append({'engine': 'openmm', 'all': 1.0})
+        assert len(store.query(structure='ethane')) == 0
+
+    def test_compact(self):
+        def n_files():
+            return len([name for _, _, names in os.walk('results')
+                        for name in names if name.endswith('.parquet')])
+        store = commpare.ResultStore('results', max_files=2)
+        for i in range(2):
+            store.append(_record(i, 'openmm'))
+            store.flush()
+        assert n_files() == 2
+        store.append(_record(2, 'openmm', time_run_wall=0.5))
+        store.flush()
+        assert n_files() == 1
+
+        results = store.query().set_index('structure')
+        assert sorted(results.index) == ['0', '1', '2']
+        assert results.loc['2', 'time_run_wall'] == 0.5
+        assert np.isnan(results.loc['0', 'time_run_wall'])
+
+    def test_concurrent_compact(self):
+        import concurrent.futures
+        from commpare.result_store import _partition_lock
+        def n_files():
+            return len([name for _, _, names in os.walk('results')
+                        for name in names if name.endswith('.parquet')])
+        store = commpare.ResultStore('results', max_files=None)
+        for i in range(4):
+            store.append(_record(i, 'openmm'))
+            store.flush()
+        # A partition another process is merging is skipped
+        with _partition_lock(os.path.join('results', 'engine=openmm')):
+            store.compact()
+        assert n_files() == 4
+
+        stores = [commpare.ResultStore('results') for _ in range(4)]
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            list(executor.map(lambda store: store.compact(), stores))
+        assert n_files() == 1
+        assert sorted(store.query()['structure']) == ['0', '1', '2', '3']
+
+    def test_since(self):
+        store = commpare.ResultStore('results')
+        store.append(_record('old', 'openmm'),
+                    timestamp=datetime.datetime(2020, 1, 1,
+                                            tzinfo=datetime.timezone.utc))
+        store.append(_record('new', 'openmm'))
+        results = store.query(since=datetime.datetime(2021, 1, 1))
+        assert results['structure'].tolist() == ['new']
+
+    def test_dataframe(self):
+        energies = pd.DataFrame({term: [1.0, 2.0]
+                                for term in commpare.CANONICAL_COLUMNS},
+                                index=pd.Index(['openmm', 'numpy'],
+                                                name='engine'))
+        collected = pd.concat({'ethane': energies},
+                                names=['structure', 'engine'])
+        store = commpare.ResultStore('results')
+        store.append(energies, structure='methane')
+        store.append(collected)
+        results = store.query(engine='numpy').set_index('structure')
+        assert results.loc['methane', 'all'] == 2.0
+        assert results.loc['ethane', 'all'] == 2.0
+
+    def test_open_result_store(self):
+        assert commpare.open_result_store(None) is None
+        assert commpare.open_result_store(False) is None
+        store = commpare.ResultStore('results')
+        assert commpare.open_result_store(store) is store
+        assert commpare.open_result_store('results').path == 'results'
+
+    def test_spawn(self):
+        import parmed as pmd
+        structure = pmd.Structure()
+        structure.add_atom(pmd.Atom(name='Ar', charge=0,
+                                    atomic_number=18), 'AR', 1)
+        structure.coordinates = [[0, 0, 0]]
+        structure.title = 'argon'
+
+        commpare.spawn_engine_simulations(structure, engines=['numpy'],
+                                        result_store='results')
+        records = list(commpare.spawn_engine_simulations_batch(
+                        {'a': structure, 'b': structure}, engines=['numpy'],
+                        timings=True, result_store='results'))
+        assert len(records) == 2
+
+        results = commpare.ResultStore('results').query(engine='numpy')
+        assert sorted(results['structure']) == ['a', 'argon', 'b']
+        assert results['structure_hash'].nunique() == 1
+        assert results['settings_hash'].notna().all()
+        assert results.set_index('structure').loc['a', 'time_total_wall'] > 0
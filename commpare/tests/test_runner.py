@@ -0,0 +1,61 @@
+import sys
+import time
+import asyncio
+import pytest
+
+from commpare.runner import (CommandResult, EngineCommandError, run_command,
+        run_commands, run_command_async)
+from commpare.tests.base_test import BaseTest
+
+
+def python_cmd(code):
+    return [sys.executable, '-c', code]
+
+class TestRunner(BaseTest):
+    def test_run_command(self):
+        result = run_command(python_cmd("print('hello')"), log_prefix='hello')
+        assert isinstance(result, CommandResult)
+        assert result.ok
+        assert result.stdout.strip() == 'hello'
+        with open('hello.out') as f:
+            assert f.read().strip() == 'hello'
+
+    def test_failure(self):
+        result = run_command(python_cmd(
+            "import sys; sys.stderr.write('broken'); sys.exit(3)"))
+        assert not result.ok
+        assert result.returncode == 3
+        with pytest.raises(EngineCommandError, match='broken'):
+            result.check()
+
+    def test_missing_binary(self):
+        result = run_command(['commpare-no-such-binary'])
+        assert not result.ok
+        assert result.returncode is None
+
+    def test_timeout(self):
+        start = time.time()
+        result = run_command(python_cmd("import time; time.sleep(30)"),
+                timeout=0.5)
+        assert result.timed_out
+        assert not result.ok
+        assert time.time() - start < 10
+
+    def test_concurrency(self):
+        sleep = python_cmd("import time; time.sleep(1)")
+        start = time.time()
+        results = run_commands([sleep] * 4, max_concurrent=4)
+        assert all(result.ok for result in results)
+        assert time.time() - start < 3.5
+
+    def test_cancel(self):
+        async def cancel():
+            task = asyncio.ensure_future(run_command_async(
+                    python_cmd("import time; time.sleep(30)")))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        start = time.time()
+        asyncio.run(cancel())
+        assert time.time() - start < 10
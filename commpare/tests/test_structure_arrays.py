@@ -0,0 +1,96 @@
+import pytest
+import numpy as np
+import mbuild as mb
+import foyer
+from mbuild.examples import Alkane
+import commpare
+from commpare.structure_arrays import (StructureArrays, get_structure_arrays,
+                                        round_structure)
+
+from commpare.tests.base_test import BaseTest
+
+
+def _alkane_structure(n=6):
+    ff = foyer.Forcefield(name='oplsaa')
+    return ff.apply(Alkane(n=n))
+
+class TestStructureArrays(BaseTest):
+    def test_arrays(self):
+        structure = _alkane_structure()
+        arrays = get_structure_arrays(structure)
+        assert arrays.n_atoms == len(structure.atoms)
+        assert arrays.coordinates.shape == (len(structure.atoms), 3)
+        assert arrays.bonds.shape == (len(structure.bonds), 2)
+        assert arrays.bonds.dtype == np.int32
+        assert arrays.angles.shape == (len(structure.angles), 3)
+        assert arrays.rb_torsions.shape == (len(structure.rb_torsions), 4)
+        assert len(arrays.type_names) == len(set(a.type
+                                                for a in structure.atoms))
+        assert np.allclose(arrays.sigma, [a.sigma for a in structure.atoms])
+        assert np.allclose(arrays.charges, [a.charge for a in structure.atoms])
+
+    def test_cached(self):
+        structure = _alkane_structure()
+        arrays = get_structure_arrays(structure)
+        assert get_structure_arrays(structure) is arrays
+        assert get_structure_arrays(arrays) is arrays
+
+        structure.coordinates = structure.coordinates + 1
+        assert get_structure_arrays(structure) is arrays
+        assert np.allclose(arrays.coordinates, structure.coordinates)
+
+        structure.bonds.pop()
+        assert get_structure_arrays(structure) is not arrays
+
+    def test_round(self):
+        structure = _alkane_structure()
+        original = structure.coordinates.copy()
+        rounded = round_structure(structure, 1)
+        assert rounded is not structure
+        assert np.allclose(structure.coordinates, original)
+        assert np.allclose(rounded.coordinates, np.round(original, 1))
+        assert round_structure(structure, None) is structure
+
+    def test_hash(self):
+        structure = _alkane_structure()
+        arrays = get_structure_arrays(structure)
+        digest = arrays.hash()
+        topology = arrays.hash(coordinates=False)
+
+        moved = round_structure(structure, 1)
+        assert get_structure_arrays(moved).hash() != digest
+        assert get_structure_arrays(moved).hash(coordinates=False) == topology
+
+        structure.bonds[0].type.k += 1
+        assert get_structure_arrays(structure, refresh=True).hash(
+                coordinates=False) != topology
+
+    def test_save_load(self):
+        arrays = get_structure_arrays(_alkane_structure())
+        arrays.save('arrays.npz')
+        loaded = StructureArrays.load('arrays.npz')
+        assert loaded.hash() == arrays.hash()
+        assert np.array_equal(loaded.exceptions[0], arrays.exceptions[0])
+
+    def test_exceptions(self):
+        import simtk.openmm as openmm
+        structure = _alkane_structure()
+        pairs, params = get_structure_arrays(structure).exceptions
+        assert np.all(pairs[:, 0] < pairs[:, 1])
+
+        system = structure.createSystem()
+        nonbonded = [force for force in system.getForces()
+                    if isinstance(force, openmm.NonbondedForce)][0]
+        expected = {}
+        for k in range(nonbonded.getNumExceptions()):
+            i, j, chgprod, _, epsilon = nonbonded.getExceptionParameters(k)
+            expected[tuple(sorted([i, j]))] = (chgprod._value,
+                                                epsilon._value)
+        assert len(expected) == len(pairs)
+        for (i, j), (chgprod, _, epsilon) in zip(pairs.tolist(), params):
+            omm_chgprod, omm_epsilon = expected[(i, j)]
+            if np.isnan(chgprod):
+                assert omm_chgprod == 0 and omm_epsilon == 0
+            else:
+                assert chgprod == pytest.approx(omm_chgprod)
+                assert epsilon * 4.184 == pytest.approx(omm_epsilon)
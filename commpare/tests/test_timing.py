@@ -0,0 +1,80 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+import commpare
+from commpare.timing import StageTimer, timed
+from commpare.tests.base_test import BaseTest
+
+
+class TestTiming(BaseTest):
+    def test_stage(self):
+        timer = StageTimer()
+        with timer.stage('sleep'):
+            time.sleep(0.05)
+        with timer.stage('sleep'):
+            time.sleep(0.05)
+        wall, cpu = timer.times['sleep']
+        assert wall >= 0.1
+        assert cpu < wall
+
+    def test_children_cpu(self):
+        timer = StageTimer()
+        with timer.stage('child'):
+            subprocess.run([sys.executable, '-c',
+                            'import time\n'
+                            't = time.process_time()\n'
+                            'while time.process_time() - t < 0.2: pass'])
+        assert timer.times['child'][1] >= 0.15
+
+    def test_columns(self):
+        timer = StageTimer()
+        with timer.stage('write_inputs'):
+            pass
+        with timer.stage('run'):
+            pass
+        assert list(timer.columns()) == ['time_write_inputs_wall',
+                'time_write_inputs_cpu', 'time_run_wall', 'time_run_cpu']
+
+    def test_hook(self):
+        calls = []
+        timer = StageTimer(hook=lambda *args: calls.append(args))
+        with pytest.raises(ValueError):
+            with timer.stage('fails'):
+                raise ValueError()
+        assert [call[0] for call in calls] == ['fails']
+        assert 'fails' in timer.times
+
+    def test_no_timer(self):
+        with timed(None, 'stage'):
+            pass
+
+    def test_spawn_timings(self):
+        import parmed as pmd
+        structure = pmd.Structure()
+        structure.add_atom(pmd.Atom(name='Ar', charge=0, 
+                                    atomic_number=18), 'AR', 1)
+        structure.coordinates = [[0, 0, 0]]
+        calls = []
+        df = commpare.spawn_engine_simulations(structure, engines=['numpy'],
+                timings=True, timing_hook=lambda *args: calls.append(args))
+        assert df.loc['numpy', 'time_total_wall'] > 0
+        assert calls[-1][:2] == ('numpy', 'total')
+
+        df = commpare.spawn_engine_simulations(structure, engines=['numpy'])
+        assert not any(column.startswith('time_') for column in df)
+
+    def test_numpy_stages(self):
+        import parmed as pmd
+        structure = pmd.Structure()
+        for i in range(2):
+            structure.add_atom(pmd.Atom(name='Ar', charge=0,
+                                        atomic_number=18), 'AR', i + 1)
+        structure.coordinates = [[0, 0, 0], [4, 0, 0]]
+        structure.box = [20, 20, 20, 90, 90, 90]
+        df = commpare.spawn_engine_simulations(structure, engines=['numpy'],
+                timings=True, numpy_kwargs={'cutoff': 9.})
+        for stage in ['arrays', 'bonded', 'neighbor_search', 'nonbonded']:
+            assert df.loc['numpy', 'time_{}_wall'.format(stage)] >= 0
@@ -0,0 +1,76 @@
+import collections
+import contextlib
+import os
+import time
+
+# Per-stage timing of the engine paths (writing inputs, running
+# binaries, parsing outputs), reported as extra result columns
+
+# Shared do-nothing context, what `timed` returns without a timer
+_NO_TIMER = contextlib.nullcontext()
+
+def timed(timer, stage):
+    """ Context manager timing `stage` with `timer`, or nothing if
+    `timer` is None
+
+    Examples
+    --------
+    >>> with timed(timer, 'grompp'):
+    ...     run_grompp(...)
+    """
+    if timer is None:
+        return _NO_TIMER
+    return timer.stage(stage)
+
+def cpu_time():
+    """ CPU time (seconds) of this process and its finished children,
+    so that engine binaries run as subprocesses are included """
+    children = os.times()
+    return (time.process_time()
+            + children.children_user + children.children_system)
+
+
+class StageTimer(object):
+    """ Wall and CPU time of named stages
+
+    Parameters
+    ----------
+    hook : callable, optional
+        Called as `hook(stage, wall, cpu)` as each stage ends
+
+    Attributes
+    ----------
+    times : OrderedDict
+        stage : (wall, cpu) in seconds, in order of first use.
+        Repeated stages accumulate
+
+    Notes
+    -----
+    CPU time is process-wide, so stages running concurrently in other
+    threads of the process are counted too
+    """
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.times = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall_start, cpu_start = time.perf_counter(), cpu_time()
+        try:
+            yield self
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = cpu_time() - cpu_start
+            total_wall, total_cpu = self.times.get(name, (0.0, 0.0))
+            self.times[name] = (total_wall + wall, total_cpu + cpu)
+            if self.hook is not None:
+                self.hook(name, wall, cpu)
+
+    def columns(self):
+        """ Stage times as a dict of `time_<stage>_wall` and
+        `time_<stage>_cpu` columns """
+        columns = collections.OrderedDict()
+        for name, (wall, cpu) in self.times.items():
+            columns['time_{}_wall'.format(name)] = wall
+            columns['time_{}_cpu'.format(name)] = cpu
+        return columns
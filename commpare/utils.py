@@ -1,6 +1,9 @@
 import contextlib
 import tempfile
 import shutil
+import os
+
+import numpy as np
 
 # Useful routines to safely build and tear down temporary
 # directories when invoking MM engines
@@ -27,3 +30,48 @@ def temporary_cd(dir_path):
         yield
     finally:
         os.chdir(prev_dir)
+
+def default_cache_dir():
+    """ Directory for commpare's persistent caches
+
+    `COMMPARE_CACHE_DIR` if set, otherwise `commpare` under the
+    XDG cache directory (~/.cache by default)
+    """
+    if os.environ.get('COMMPARE_CACHE_DIR'):
+        return os.environ['COMMPARE_CACHE_DIR']
+    xdg_cache = os.environ.get('XDG_CACHE_HOME',
+                                os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(xdg_cache, 'commpare')
+
+def get_frame_coordinates(frames):
+    """ Normalize a multi-frame input to coordinates and boxes
+
+    Parameters
+    ----------
+    frames : array-like or mdtraj.Trajectory
+        Array of shape (n_frames, n_atoms, 3) in Angstrom, 
+        or an mdtraj.Trajectory (nm, converted here)
+
+    Returns
+    -------
+    xyz : np.ndarray, shape (n_frames, n_atoms, 3)
+        Coordinates in Angstrom
+    boxes : np.ndarray, shape (n_frames, 6) or None
+        Box lengths (Angstrom) and angles (degrees) per frame,
+        None if the frames carry no box information
+    """
+    boxes = None
+    if hasattr(frames, 'xyz'):
+        xyz = np.asarray(frames.xyz, dtype=float) * 10
+        if getattr(frames, 'unitcell_lengths', None) is not None:
+            boxes = np.hstack([np.asarray(frames.unitcell_lengths) * 10,
+                                np.asarray(frames.unitcell_angles)])
+    else:
+        xyz = np.asarray(frames, dtype=float)
+    if xyz.ndim == 2:
+        xyz = xyz[np.newaxis]
+    if xyz.ndim != 3 or xyz.shape[-1] != 3:
+        raise ValueError("Expected frames of shape (n_frames, n_atoms, 3), "
+                         "got {}".format(xyz.shape))
+
+    return xyz, boxes